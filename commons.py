@@ -38,6 +38,13 @@ OP_REC_CACHE_HITMISS = 'OP_REC_CACHE_HITMISS'
 OP_NON_MERGE_CLEAN = 'OP_NON_MERGE_CLEAN'
 OP_CALC_NON_MERGE_GC_DURATION = 'OP_CALC_NON_MERGE_GC_DURATION'
 OP_REC_BW = 'OP_REC_BW'
+# set result arg1 to arg2 in the recorder
+OP_REC_RESULT = 'OP_REC_RESULT'
+# save the state of the simulated SSD to file arg1
+OP_CHECKPOINT = 'OP_CHECKPOINT'
+# continue the simulation in a forked process for each of
+# conf['fork_variants']
+OP_FORK = 'OP_FORK'
 
 TAG_BACKGROUND = "BACKGROUND"
 TAG_FOREGROUND = "FOREGROUND"
@@ -204,6 +204,13 @@ class Config(dict):
             "ftl_type"              : "nkftl2",
             "sector_size"           : 512,
             "sort_block_trace"      : True,
+            # processes used to convert blkparse output to event files
+            "blkparse_workers"      : 1,
+            # convert blkparse output to events while the workload runs and
+            # feed them to the simulator, instead of after the workload
+            "stream_blktrace"       : False,
+            # lines held to sort live blkparse output by timestamp
+            "live_blktrace_reorder_window": 1024,
             "trace_issue_and_complete": False,
 
             ############## For wiscsim ######
@@ -219,6 +226,30 @@ class Config(dict):
 
             "do_gc_after_workload"  : True,
 
+            # merge contiguous requests of the same pid and operation that
+            # are issued within the time window (seconds), up to the size
+            # cap (bytes), before the host queues them
+            "compact_trace"         : False,
+            "compact_trace_time_window": 0.001,
+            "compact_trace_max_size": 512*KB,
+
+            # convert event files to the binary format when they are first
+            # read, later simulations of them read the binary files
+            "binary_event_file"     : False,
+            # read binary event files through a memory map
+            "mmap_event_file"       : True,
+
+            # save the simulated SSD after the mkfs/aging events to this
+            # file, or restore it from this file and skip those events
+            "checkpoint_save_path"  : None,
+            "checkpoint_restore_path": None,
+
+            # a list of config overrides, such as [{'n_gc_procs': 4}]. The
+            # mkfs/aging events are simulated once, then a forked process
+            # simulates the rest for each override. The results of all of
+            # them are in fork-variants.txt in result_dir.
+            "fork_variants"         : None,
+
             'snapshot_valid_ratios' : False,
             'snapshot_erasure_count_dist': False,
             'snapshot_interval': None,
@@ -4,10 +4,12 @@ import collections
 
 from workflow import run_workflow
 import wiscsim
+from wiscsim import checkpoint
 from utilities.utils import *
 from commons import *
 from config import MountOption as MOpt
 from config import LBAGENERATOR
+from resultcache import ResultCache, para_digest
 
 class Experiment(object):
     def __init__(self, para):
@@ -216,7 +218,7 @@ class Experiment(object):
         # dict_for_name = {k:v for k,v in self.para._asdict() if k in ('
         set_exp_metadata(self.conf, save_data = True,
                 expname = self.para.expname,
-                subexpname = 'subexp-' + str(hash(chain_items_as_filename(self.para))))
+                subexpname = subexp_name(self.para))
         runtime_update(self.conf)
 
         self.check_config()
@@ -376,6 +378,39 @@ class ExistingTraceExperiment(Experiment):
         self.conf['lba_workload_configs']['ftlsim_event_path'] = \
                 self.para.ftlsim_path
 
+    def before_running(self):
+        self.setup_checkpoint()
+
+    def setup_checkpoint(self):
+        """
+        With para.checkpoint_dir, subexps that have the same mkfs events and
+        device layout share a checkpoint of the SSD after the mkfs events.
+        The first subexp saves it and the others restore it.
+        """
+        checkpoint_dir = getattr(self.para, 'checkpoint_dir', None)
+        if checkpoint_dir is None or \
+                self.conf['simulator_class'] != 'SimulatorDESNew':
+            return
+
+        # everything that changes the events before the checkpoint, and the
+        # allocation, GC and NCQ settings that change the state they leave
+        prefix = checkpoint.layout_of_conf(self.conf)
+        for key in ('trace_sampling', 'compact_trace',
+                'compact_trace_time_window', 'compact_trace_max_size',
+                'stripe_size', 'segment_bytes', 'n_gc_procs',
+                'GC_high_threshold_ratio', 'GC_low_threshold_ratio',
+                'do_wear_leveling', 'wear_leveling_check_interval',
+                'wear_leveling_factor', 'wear_leveling_diff',
+                'SSDFramework', 'process_queue_depth', 'nkftl'):
+            prefix[key] = self.conf.get(key, None)
+        prefix['mkfs_path'] = self.para.mkfs_path
+        path = os.path.join(checkpoint_dir,
+                'prefix-{}.checkpoint'.format(para_digest(prefix)))
+        if os.path.exists(path):
+            self.conf['checkpoint_restore_path'] = path
+        else:
+            self.conf['checkpoint_save_path'] = path
+
 
 def run_on_real_dev(para):
     Parameters = collections.namedtuple("Parameters", ','.join(para.keys()))
@@ -383,18 +418,57 @@ def run_on_real_dev(para):
     obj.main()
 
 
-def execute_simulation(para):
-    """
-    INPUT: para is a dictionary generated by filesim.ParaDict
+def subexp_name(para):
+    "para is the Parameters namedtuple an Experiment runs with"
+    return 'subexp-' + para_digest(para)
+
 
-    This function is only for simulating blktrace events as LBA workload
+def simulation_parameters(para):
+    """
+    Fill para (a dict from ParaDict) with the shared defaults and return
+    the Parameters namedtuple execute_simulation() runs with.
     """
     default_para = get_shared_nolist_para_dict(None, None)
     default_para.update(para)
     para = default_para
     Parameters = collections.namedtuple("Parameters", ','.join(para.keys()))
-    obj = ExistingTraceExperiment( Parameters(**para) )
-    obj.main()
+    return Parameters(**para)
+
+
+def execute_simulation(para, use_cache = True, cache = None):
+    """
+    INPUT: para is a dictionary generated by filesim.ParaDict
+
+    This function is only for simulating blktrace events as LBA workload.
+    It returns the result dir, or None if another process is simulating
+    the same para. With use_cache, a para that has been simulated before
+    is not simulated again. cache is a ResultCache, the default one is used
+    if it is None.
+    """
+    parameters = simulation_parameters(para)
+    if use_cache is False:
+        obj = ExistingTraceExperiment(parameters)
+        obj.main()
+        return obj.conf['result_dir']
+
+    if cache is None:
+        cache = ResultCache()
+    digest = para_digest(parameters)
+    result_dir = cache.lookup(digest)
+    if result_dir is not None:
+        print 'Skip simulated para, results are in', result_dir
+        return result_dir
+
+    if cache.claim(digest) is False:
+        print 'Skip para being simulated by another process', digest
+        return None
+    try:
+        obj = ExistingTraceExperiment(parameters)
+        obj.main()
+        cache.store(digest, obj.conf['result_dir'], parameters)
+    finally:
+        cache.release(digest)
+    return obj.conf['result_dir']
 
 
 
@@ -0,0 +1,154 @@
+"""
+Content-addressed cache of simulation results.
+
+A parameter combination is identified by para_digest(), which is stable
+across processes and interpreter versions: it is the sha1 of the
+parameters serialized with sorted keys, where trace files are replaced by
+the sha1 of their content. The cache maps a digest to the result dir of a
+finished simulation. A lock file of the digest is locked with flock while
+the digest is being simulated so that parallel workers do not simulate it
+twice. The lock goes away with the process that holds it.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import socket
+
+from utilities import utils
+
+# parameters that do not change the simulation result
+NAMING_ONLY_PARAS = ('expname',)
+
+_checksums = {} # {(path, size, mtime): sha1}
+
+
+def file_checksum(path, chunk_size = 1024 * 1024):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if not key in _checksums:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                sha.update(chunk)
+        _checksums[key] = sha.hexdigest()
+    return _checksums[key]
+
+
+def normalize_para(para):
+    """
+    para is a dict or a namedtuple. Parameters ending with _path that point
+    to files are replaced by the checksums of the files.
+    """
+    if hasattr(para, '_asdict'):
+        para = para._asdict()
+
+    normalized = {}
+    for name, value in para.items():
+        if name in NAMING_ONLY_PARAS:
+            continue
+        if name.endswith('_path') and isinstance(value, basestring) and \
+                os.path.isfile(value):
+            value = 'sha1:' + file_checksum(value)
+        normalized[name] = value
+    return normalized
+
+
+def para_digest(para):
+    s = json.dumps(normalize_para(para), sort_keys = True, default = repr)
+    return hashlib.sha1(s).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir = None):
+        if cache_dir is None:
+            conf = {}
+            utils.set_exp_metadata(conf, save_data = True, expname = None,
+                    subexpname = None)
+            cache_dir = os.path.join(conf['targetdir'], 'result-cache')
+        self.cache_dir = cache_dir
+        self._lock_files = {} # {digest: locked file}
+
+    def _entry_path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.json')
+
+    def _lock_path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.lock')
+
+    def lookup(self, digest):
+        "return the result dir of digest, or None if it is not simulated"
+        entry_path = self._entry_path(digest)
+        if not os.path.exists(entry_path):
+            return None
+        result_dir = utils.load_json(entry_path)['result_dir']
+        if not os.path.exists(os.path.join(result_dir, 'recorder.json')):
+            # the results have been removed
+            return None
+        return result_dir
+
+    def store(self, digest, result_dir, para = None):
+        entry = {'digest': digest, 'result_dir': os.path.abspath(result_dir)}
+        if para is not None:
+            entry['para'] = normalize_para(para)
+        entry_path = self._entry_path(digest)
+        utils.prepare_dir_for_path(entry_path)
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f, indent = 4, sort_keys = True, default = repr)
+        os.rename(tmp_path, entry_path)
+
+    def claim(self, digest):
+        """
+        Return True if this process may simulate digest, until it calls
+        release(). It returns False if another process has claimed it.
+        """
+        lock_path = self._lock_path(digest)
+        utils.prepare_dir_for_path(lock_path)
+        while True:
+            f = open(lock_path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                f.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            if self._is_lock_file(f, lock_path):
+                break
+            # its owner released and removed it after we opened it
+            f.close()
+
+        # for people looking at the cache dir
+        f.truncate(0)
+        f.write('{} {}'.format(socket.gethostname(), os.getpid()))
+        f.flush()
+        self._lock_files[digest] = f
+        return True
+
+    def release(self, digest):
+        "release the claim of this process on digest, if it has one"
+        f = self._lock_files.pop(digest, None)
+        if f is None:
+            return
+        # removed before it is unlocked, see _is_lock_file()
+        self._remove(self._lock_path(digest))
+        f.close()
+
+    def _is_lock_file(self, f, lock_path):
+        try:
+            stat = os.stat(lock_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return os.fstat(f.fileno()).st_ino == stat.st_ino
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
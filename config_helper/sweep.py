@@ -0,0 +1,198 @@
+"""
+Run the subexps of a parameter sweep in a pool of worker processes.
+
+Each subexp runs in its own process so that it can be killed when it runs
+longer than timeout and so that mem_limit_bytes only applies to it. A
+subexp that is in the result cache is skipped, so an interrupted sweep can
+be resumed by running it again. A subexp that another process is
+simulating is reported busy. When all subexps are finished,
+the parameters and results of all of them are merged into one table.
+"""
+import collections
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from experiment import execute_simulation, simulation_parameters
+from resultcache import ResultCache, para_digest
+from utilities import utils
+
+DONE, FAILED, TIMEOUT, SKIPPED, BUSY = ('done', 'failed', 'timeout',
+        'skipped', 'busy')
+
+# exit code of a worker whose subexp is claimed by another process
+BUSY_EXIT_CODE = 75
+
+
+def _run_job(run_func, para, cache, mem_limit_bytes, log_path):
+    "This runs in the worker process"
+    if mem_limit_bytes is not None:
+        resource.setrlimit(resource.RLIMIT_AS,
+                (mem_limit_bytes, mem_limit_bytes))
+
+    if log_path is not None:
+        log = open(log_path, 'w', 0)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+
+    # like execute_simulation(), run_func returns None if another process
+    # is simulating para
+    if run_func(para, cache = cache) is None:
+        sys.exit(BUSY_EXIT_CODE)
+
+
+class SweepJob(object):
+    def __init__(self, para, cache):
+        self.para = para
+        self.cache = cache
+
+        parameters = simulation_parameters(para)
+        self.digest = para_digest(parameters)
+        conf = {}
+        utils.set_exp_metadata(conf, save_data = True,
+                expname = parameters.expname,
+                subexpname = 'subexp-' + self.digest)
+        self.subexpname = conf['subexpname']
+        self.exp_dir = os.path.join(conf['targetdir'], conf['expname'])
+
+        self.status = None
+        self.process = None
+        self.start_time = None
+        self.elapsed = None
+
+    def result_dir(self):
+        return self.cache.lookup(self.digest)
+
+    def is_finished(self):
+        return self.result_dir() is not None
+
+    def log_path(self):
+        return os.path.join(self.exp_dir, self.subexpname + '.log')
+
+
+class SweepRunner(object):
+    """
+    paras are dictionaries generated by rule_parameter.ParaDict.
+
+    timeout is in seconds of wall time for each subexp, mem_limit_bytes is
+    the address space limit of each worker process. None means no limit.
+    """
+    def __init__(self, paras, n_workers = None, timeout = None,
+            mem_limit_bytes = None, run_func = execute_simulation,
+            results_path = None, poll_interval = 1, cache = None):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        assert n_workers > 0
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.mem_limit_bytes = mem_limit_bytes
+        self.run_func = run_func
+        self.poll_interval = poll_interval
+
+        if cache is None:
+            cache = ResultCache()
+        self.cache = cache
+
+        self.jobs = [SweepJob(para, cache) for para in paras]
+        if results_path is None and len(self.jobs) > 0:
+            results_path = os.path.join(self.jobs[0].exp_dir,
+                    'sweep-results.txt')
+        self.results_path = results_path
+
+    def run(self):
+        pending = collections.deque()
+        digests = set()
+        for job in self.jobs:
+            if job.is_finished() or job.digest in digests:
+                # a para may appear more than once in a sweep
+                job.status = SKIPPED
+            else:
+                pending.append(job)
+                digests.add(job.digest)
+
+        print 'Sweep: {} subexps, {} to run, {} workers'.format(
+                len(self.jobs), len(pending), self.n_workers)
+
+        running = []
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.n_workers:
+                job = pending.popleft()
+                self._start(job)
+                running.append(job)
+
+            time.sleep(self.poll_interval)
+
+            for job in list(running):
+                if self._check(job) is True:
+                    running.remove(job)
+                    print 'Sweep: {} {} in {:.1f}s'.format(
+                            job.subexpname, job.status, job.elapsed)
+
+        self.write_results()
+        return self.jobs
+
+    def _start(self, job):
+        log_path = job.log_path()
+        utils.prepare_dir_for_path(log_path)
+        job.process = multiprocessing.Process(target = _run_job,
+                args = (self.run_func, job.para, self.cache,
+                    self.mem_limit_bytes, log_path))
+        job.start_time = time.time()
+        job.process.start()
+
+    def _check(self, job):
+        "return True if job is not running anymore"
+        elapsed = time.time() - job.start_time
+        if job.process.is_alive():
+            if self.timeout is None or elapsed < self.timeout:
+                return False
+            # its claim on the digest goes away with it
+            job.process.terminate()
+            job.process.join()
+            job.status = TIMEOUT
+        else:
+            job.process.join()
+            if job.process.exitcode == 0 and job.is_finished():
+                job.status = DONE
+            elif job.process.exitcode == BUSY_EXIT_CODE:
+                job.status = BUSY
+            else:
+                job.status = FAILED
+        job.elapsed = elapsed
+        return True
+
+    def results_table(self):
+        rows = []
+        for job in self.jobs:
+            row = dict(job.para)
+            row['subexpname'] = job.subexpname
+            row['sweep_status'] = job.status
+            row['elapsed'] = job.elapsed
+            result_dir = job.result_dir()
+            if result_dir is not None:
+                row['result_dir'] = result_dir
+                row.update(utils.flatten_result_dict(utils.load_json(
+                    os.path.join(result_dir, 'recorder.json'))))
+            rows.append(row)
+
+        return utils.rows_to_table(rows)
+
+    def write_results(self):
+        if self.results_path is None:
+            return
+        utils.prepare_dir_for_path(self.results_path)
+        utils.table_to_file(self.results_table(), self.results_path)
+        print 'Sweep results are in', self.results_path
+
+
+def run_sweep(paras, **kwargs):
+    """
+    Simulate all paras (e.g. from rule_parameter.ParaDict) in parallel.
+    kwargs are passed to SweepRunner.
+    """
+    return SweepRunner(paras, **kwargs).run()
+
@@ -1,6 +1,12 @@
+import binascii
+import heapq
+import json
+import multiprocessing
 import os
 import re
+import shutil
 import subprocess
+import tempfile
 import time
 
 from pyreuse.helpers import *
@@ -9,15 +15,19 @@ from pyreuse.macros import *
 class BlktraceResult(object):
     """
     Parse blkparse output
+
+    With n_workers > 1, byte ranges of the raw file are converted by
+    separate processes and the parts are concatenated in order.
     """
     def __init__(self, sector_size, event_file_column_names,
             raw_blkparse_file_path, parsed_output_path,
-            padding_bytes=0, do_sort=True):
+            padding_bytes=0, do_sort=True, n_workers=1):
         self.raw_blkparse_file_path = raw_blkparse_file_path
         self.parsed_output_path = parsed_output_path
         self.sector_size = sector_size
         self.event_file_column_names = event_file_column_names
         self.do_sort = do_sort
+        self.n_workers = n_workers
 
         # event offset + padding_bytes = blktrace addr
         #
@@ -30,75 +40,44 @@ class BlktraceResult(object):
 
     def create_event_file(self):
         prepare_dir_for_path(self.parsed_output_path)
-
+        if self.n_workers <= 1:
+            # no part files to concatenate
+            self._write_event_file([self._event_lines(
+                0, os.path.getsize(self.raw_blkparse_file_path))])
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix='blkparse-parts-',
+                dir=os.path.dirname(os.path.abspath(self.parsed_output_path)))
+        try:
+            shards = [(self.raw_blkparse_file_path, start, end,
+                       self.sector_size, self.padding_bytes,
+                       self.event_file_column_names, tmpdir)
+                      for start, end in shard_byte_ranges(
+                          self.raw_blkparse_file_path, self.n_workers)]
+            part_paths = map_on_workers(_write_event_lines_of_shard,
+                    shards, self.n_workers)
+            self._write_event_file([_lines_of_file(path)
+                for path in part_paths])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _event_lines(self, start, end):
+        return event_lines_of_range(self.raw_blkparse_file_path, start, end,
+                self.sector_size, self.padding_bytes,
+                self.event_file_column_names)
+
+    def _write_event_file(self, line_iters):
+        stats = TraceStatsBuilder(self.parsed_output_path,
+                self.event_file_column_names, self.sector_size)
         out_file = open(self.parsed_output_path, 'w')
-        in_file = open(self.raw_blkparse_file_path, 'r')
-
-        for line in in_file:
-            line = line.strip()
-            if not is_data_line(line):
-                continue
-
-            # get row dict
-            row_dict = self.__line_to_dic(line)
-            row_dict['type'] = 'blkparse'
-
-            line = self.__create_event_line(row_dict)
-            out_file.write( line + '\n' )
-
+        for lines in line_iters:
+            for line in lines:
+                out_file.write(line)
+                stats.add_line(line)
         out_file.flush()
         os.fsync(out_file)
         out_file.close()
-
-
-    def __line_to_dic(self, line):
-        """
-        is_data_line() must be true for this line"\
-        ['8,0', '0', '1', '0.000000000', '440', 'A', 'W', '12912077', '+', '8', '<-', '(8,2)', '606224']"
-        """
-        names = ['devid', 'cpuid', 'seqid', 'timestamp', 'pid', 'action', 'RWBS', 'sector_start', 'ignore1', 'sector_count']
-        #        0        1         2       3        4      5         6       7             8          9
-        items = line.split()
-
-        dic = dict(zip(names, items))
-        assert len(items) >= len(names)
-
-        self.__parse_and_add_operation(dic)
-        self.__parse_and_add_offset_size(dic)
-
-        return dic
-
-    def __parse_and_add_operation(self, row):
-        if 'D' in row['RWBS']:
-            operation = 'discard'
-        elif 'W' in row['RWBS']:
-            operation = 'write'
-        elif 'R' in row['RWBS']:
-            operation = 'read'
-        else:
-            raise RuntimeError('unknow operation ' + row['RWBS'])
-
-        row['operation'] = operation
-
-        if 'S' in row['RWBS']:
-            row['sync'] = 'True'
-        else:
-            row['sync'] = 'False'
-
-    def __parse_and_add_offset_size(self, row):
-        sec_start = int(row['sector_start'])
-        sec_count = int(row['sector_count'])
-        byte_offset = sec_start * self.sector_size - self.padding_bytes
-        byte_size = sec_count * self.sector_size
-
-        row['offset'] = byte_offset
-        row['size'] = byte_size
-
-    def __create_event_line(self, line_dict):
-        columns = [str(line_dict.get(colname, 'NA'))
-                for colname in self.event_file_column_names]
-        line = ' '.join(columns)
-        return line
+        stats.save()
 
 
 class BlktraceResultInMem(object):
@@ -210,6 +189,8 @@ class BlktraceResultInMem(object):
 
     def create_event_file(self):
         prepare_dir_for_path(self.parsed_output_path)
+        stats = TraceStatsBuilder(self.parsed_output_path,
+                self.event_file_column_names, self.sector_size)
         out = open(self.parsed_output_path, 'w')
         for row_dict in self.__parsed_table:
             if row_dict['type'] == 'blkparse':
@@ -218,10 +199,12 @@ class BlktraceResultInMem(object):
                 raise NotImplementedError()
 
             out.write( line + '\n' )
+            stats.add_line(line)
 
         out.flush()
         os.fsync(out)
         out.close()
+        stats.save()
 
     def get_duration(self):
         return float(self.__parsed_table[-1]['timestamp']) - \
@@ -243,11 +226,439 @@ class BlktraceResultInMem(object):
         return size_mb / duration
 
 
+class BlktraceResultExternalSort(object):
+    """
+    Parse blkparse output and sort it by timestamp with bounded memory.
+
+    The raw file is read in runs of lines_per_run data lines. Each run is
+    sorted and spilled to a temporary file, then the runs are merged and
+    pre_wait_time is computed while the event file is written. The output
+    is the same as BlktraceResultInMem.create_event_file().
+
+    With n_workers > 1, the raw file is split into byte ranges and the runs
+    of each range are sorted by a separate process.
+    """
+    def __init__(self, sector_size, event_file_column_names,
+            raw_blkparse_file_path, parsed_output_path,
+            padding_bytes=0, do_sort=True, lines_per_run=100000,
+            max_runs_per_merge=64, n_workers=1):
+        self.raw_blkparse_file_path = raw_blkparse_file_path
+        self.parsed_output_path = parsed_output_path
+        self.sector_size = sector_size
+        self.event_file_column_names = event_file_column_names
+        self.do_sort = do_sort
+        self.lines_per_run = lines_per_run
+        self.max_runs_per_merge = max_runs_per_merge
+        self.n_workers = n_workers
+
+        # event offset + padding_bytes = blktrace addr
+        self.padding_bytes = padding_bytes
+
+    def create_event_file(self):
+        prepare_dir_for_path(self.parsed_output_path)
+        tmpdir = tempfile.mkdtemp(prefix='blkparse-runs-',
+                dir=os.path.dirname(os.path.abspath(self.parsed_output_path)))
+        try:
+            if self.do_sort is True:
+                run_paths = self.__write_sorted_runs(tmpdir)
+                run_paths = self.__reduce_runs(run_paths, tmpdir)
+                records = heapq.merge(*[_read_run(path)
+                    for path in run_paths])
+            else:
+                records = _iter_run_records(self.raw_blkparse_file_path,
+                        self.sector_size, self.padding_bytes,
+                        self.event_file_column_names)
+            self.__write_events(records)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def __write_sorted_runs(self, tmpdir):
+        shards = [(self.raw_blkparse_file_path, start, end,
+                   self.sector_size, self.padding_bytes,
+                   self.event_file_column_names, self.lines_per_run, tmpdir)
+                  for start, end in shard_byte_ranges(
+                      self.raw_blkparse_file_path, self.n_workers)]
+        run_paths_of_shards = map_on_workers(_write_sorted_runs_of_shard,
+                shards, self.n_workers)
+
+        return [path for paths in run_paths_of_shards for path in paths]
+
+    def __reduce_runs(self, run_paths, tmpdir):
+        """
+        Merge runs in groups until they can be merged with one open file
+        per run.
+        """
+        while len(run_paths) > self.max_runs_per_merge:
+            merged_paths = []
+            for i in range(0, len(run_paths), self.max_runs_per_merge):
+                group = run_paths[i:i + self.max_runs_per_merge]
+                fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+                with os.fdopen(fd, 'w') as f:
+                    _dump_run(heapq.merge(*[_read_run(p) for p in group]), f)
+                for p in group:
+                    os.remove(p)
+                merged_paths.append(path)
+            run_paths = merged_paths
+
+        return run_paths
+
+    def __write_events(self, records):
+        if 'pre_wait_time' in self.event_file_column_names:
+            wait_col = self.event_file_column_names.index('pre_wait_time')
+        else:
+            wait_col = None
+
+        stats = TraceStatsBuilder(self.parsed_output_path,
+                self.event_file_column_names, self.sector_size)
+        out = open(self.parsed_output_path, 'w')
+        prev_timestamp = None
+        for timestamp, _, columns in records:
+            if prev_timestamp is None:
+                pre_wait_time = 0
+            else:
+                pre_wait_time = timestamp - prev_timestamp
+                if self.do_sort is True:
+                    assert pre_wait_time >= 0, \
+                        "data is {}".format(pre_wait_time)
+            prev_timestamp = timestamp
+
+            if wait_col is not None:
+                columns[wait_col] = str(pre_wait_time)
+            out.write(' '.join(columns) + '\n')
+            stats.add_columns(columns)
+
+        out.flush()
+        os.fsync(out)
+        out.close()
+        stats.save()
+
+
+class BlktraceLiveConverter(object):
+    """
+    Convert blkparse lines to event lines while blktrace is still running.
+
+    Data lines are held in a heap of at most reorder_window lines and
+    released in timestamp order, so lines that blkparse delivers slightly
+    out of order are sorted. If every line arrives within the window, the
+    event lines are the same as those of BlktraceResultExternalSort. A line
+    older than one already released gets pre_wait_time 0.
+    """
+    def __init__(self, sector_size, event_file_column_names,
+            padding_bytes=0, reorder_window=1024):
+        self.sector_size = sector_size
+        self.event_file_column_names = event_file_column_names
+        self.padding_bytes = padding_bytes
+        self.reorder_window = reorder_window
+
+        self.get_columns = record_columns_getter(event_file_column_names)
+        self.i_timestamp = BLKPARSE_RECORD_FIELDS.index('timestamp')
+        if 'pre_wait_time' in event_file_column_names:
+            self.wait_col = event_file_column_names.index('pre_wait_time')
+        else:
+            self.wait_col = None
+
+        self.heap = []
+        self.seq = 0
+        self.prev_timestamp = None
+
+    def add_line(self, line):
+        """
+        Return the event lines released by adding this blkparse line
+        """
+        record = parse_data_line(line.strip(), self.sector_size,
+                self.padding_bytes)
+        if record is None:
+            return []
+
+        heapq.heappush(self.heap, (float(record[self.i_timestamp]),
+            self.seq, self.get_columns(record)))
+        self.seq += 1
+
+        released = []
+        while len(self.heap) > self.reorder_window:
+            released.append(self.__release(heapq.heappop(self.heap)))
+        return released
+
+    def flush(self):
+        "Return the event lines of all the lines held"
+        released = []
+        while len(self.heap) > 0:
+            released.append(self.__release(heapq.heappop(self.heap)))
+        return released
+
+    def __release(self, heap_item):
+        timestamp, _, columns = heap_item
+        if self.prev_timestamp is None:
+            pre_wait_time = 0
+            self.prev_timestamp = timestamp
+        elif timestamp < self.prev_timestamp:
+            pre_wait_time = 0.0
+        else:
+            pre_wait_time = timestamp - self.prev_timestamp
+            self.prev_timestamp = timestamp
+
+        if self.wait_col is not None:
+            columns[self.wait_col] = str(pre_wait_time)
+        return ' '.join(columns)
+
+
+# Sidecar index of an event file, written next to it when the event file is
+# created so that summaries do not need another pass over the trace:
+#   <event file>.stats.json   totals, duration, LBA footprint, per-second
+#                             bytes and the maximum NCQ depth
+#                             (bytes of events earlier than the first event
+#                             are counted in second 0)
+#   <event file>.ncq.txt      NCQ depth timeline, the table of
+#                             ftlcounter.EventNCQParser
+TRACE_STATS_VERSION = 2
+FOOTPRINT_BLOCK_SIZE = 4096
+EVENT_OPERATIONS = ('read', 'write', 'discard')
+
+def trace_stats_path(event_path):
+    return os.path.splitext(event_path)[0] + '.stats.json'
+
+def ncq_timeline_path(event_path):
+    return os.path.splitext(event_path)[0] + '.ncq.txt'
+
+class _BlockBitmap(object):
+    "Blocks touched, one bit per block"
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add_range(self, start, count):
+        end = start + count
+        need = (end + 7) / 8
+        if need > len(self.bits):
+            self.bits.extend(bytearray(max(need - len(self.bits),
+                len(self.bits))))
+        for block in xrange(start, end):
+            self.bits[block >> 3] |= 1 << (block & 7)
+
+    def count(self):
+        if len(self.bits) == 0:
+            return 0
+        return bin(int(binascii.hexlify(self.bits), 16)).count('1')
+
+
+class TraceStatsBuilder(object):
+    """
+    Build the sidecar index of an event file from its lines, in file order.
+    Call add_columns() with the columns of every event line, then save().
+    Nothing is built if the event file lacks the columns needed.
+    """
+    needed_columns = ('action', 'operation', 'offset', 'size', 'timestamp',
+            'pid')
+
+    def __init__(self, event_path, event_file_column_names, sector_size):
+        self.event_path = event_path
+        self.sector_size = sector_size
+        self.enabled = all(name in event_file_column_names
+                for name in self.needed_columns)
+        if not self.enabled:
+            return
+
+        self.i_action = event_file_column_names.index('action')
+        self.i_operation = event_file_column_names.index('operation')
+        self.i_offset = event_file_column_names.index('offset')
+        self.i_size = event_file_column_names.index('size')
+        self.i_timestamp = event_file_column_names.index('timestamp')
+        self.i_pid = event_file_column_names.index('pid')
+
+        self.n_events = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.n_out_of_order = 0
+        self.actions = {}
+        self.per_second = dict((op, []) for op in EVENT_OPERATIONS)
+        self.footprint = dict((op, _BlockBitmap())
+                for op in EVENT_OPERATIONS + ('all',))
+        self.min_offset = None
+        self.max_end = None
+
+        self.depth = 0
+        self.max_ncq_depth = 0
+        self.ncq_colnames = None
+        self.ncq_tmp_path = ncq_timeline_path(event_path) + '.tmp'
+        self.ncq_file = open(self.ncq_tmp_path, 'w')
+
+    def add_line(self, line):
+        self.add_columns(line.split())
+
+    def add_columns(self, columns):
+        if not self.enabled:
+            return
+
+        action = columns[self.i_action]
+        operation = columns[self.i_operation]
+        offset = int(columns[self.i_offset])
+        size = int(columns[self.i_size])
+        timestamp_str = columns[self.i_timestamp]
+        timestamp = float(timestamp_str)
+
+        self.n_events += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+
+        op_stats = self.actions.setdefault(action, {}).setdefault(operation,
+                {'count': 0, 'sectors': 0, 'bytes': 0})
+        op_stats['count'] += 1
+        op_stats['sectors'] += size / self.sector_size
+        op_stats['bytes'] += size
+
+        if action == 'D':
+            second = int(timestamp - self.first_timestamp)
+            if second < 0:
+                # issued before the first event, e.g. in an unsorted trace
+                self.n_out_of_order += 1
+                second = 0
+            hist = self.per_second[operation]
+            if second >= len(hist):
+                hist.extend([0] * (second + 1 - len(hist)))
+            hist[second] += size
+
+            if offset >= 0 and size > 0:
+                first_block = offset / FOOTPRINT_BLOCK_SIZE
+                last_block = (offset + size - 1) / FOOTPRINT_BLOCK_SIZE
+                for key in (operation, 'all'):
+                    self.footprint[key].add_range(first_block,
+                            last_block - first_block + 1)
+                if self.min_offset is None or offset < self.min_offset:
+                    self.min_offset = offset
+                if self.max_end is None or offset + size > self.max_end:
+                    self.max_end = offset + size
+
+        self.__add_ncq_row(action, operation, timestamp_str, offset, size,
+                int(columns[self.i_pid]))
+
+    def __add_ncq_row(self, action, operation, timestamp, offset, size, pid):
+        pre_depth = self.depth
+        if action == 'D':
+            self.depth += 1
+        elif action == 'C':
+            self.depth -= 1
+        else:
+            raise RuntimeError('action has to be D or C')
+        self.max_ncq_depth = max(self.max_ncq_depth, self.depth)
+
+        # same row as ftlcounter.EventNCQParser, operations as in commons
+        row = {'action': action,
+               'operation': 'OP_' + operation.upper(),
+               'timestamp': timestamp,
+               'offset': offset,
+               'size': size,
+               'pid': pid,
+               'pre_depth': pre_depth,
+               'post_depth': self.depth}
+        if self.ncq_colnames is None:
+            self.ncq_colnames = row.keys()
+            self.ncq_file.write(';'.join(self.ncq_colnames) + '\n')
+        self.ncq_file.write(';'.join(str(row[k])
+            for k in self.ncq_colnames) + '\n')
+
+    def get_stats(self):
+        if self.first_timestamp is None:
+            duration = 0
+        else:
+            duration = self.last_timestamp - self.first_timestamp
+
+        footprint = dict((op, bm.count() * FOOTPRINT_BLOCK_SIZE)
+                for op, bm in self.footprint.items())
+
+        return {
+                'version': TRACE_STATS_VERSION,
+                'sector_size': self.sector_size,
+                'n_events': self.n_events,
+                'first_timestamp': self.first_timestamp,
+                'last_timestamp': self.last_timestamp,
+                'duration': duration,
+                'n_out_of_order': self.n_out_of_order,
+                'actions': self.actions,
+                'per_second_bytes': self.per_second,
+                'footprint_bytes': footprint,
+                'min_offset': self.min_offset,
+                'max_end': self.max_end,
+                'max_ncq_depth': self.max_ncq_depth,
+                'ncq_depth_timeline': os.path.basename(
+                    ncq_timeline_path(self.event_path)),
+                }
+
+    def save(self):
+        if not self.enabled:
+            return
+
+        self.ncq_file.close()
+        os.rename(self.ncq_tmp_path, ncq_timeline_path(self.event_path))
+
+        stats_path = trace_stats_path(self.event_path)
+        with open(stats_path + '.tmp', 'w') as f:
+            json.dump(self.get_stats(), f, indent=4)
+        os.rename(stats_path + '.tmp', stats_path)
+
+    def discard(self):
+        if not self.enabled:
+            return
+
+        self.ncq_file.close()
+        os.remove(self.ncq_tmp_path)
+
+
+def build_trace_stats(event_path, event_file_column_names, sector_size):
+    "Build the sidecar index of an existing event file"
+    builder = TraceStatsBuilder(event_path, event_file_column_names,
+            sector_size)
+    try:
+        with open(event_path, 'r') as f:
+            for line in f:
+                builder.add_line(line)
+    except Exception:
+        builder.discard()
+        raise
+    builder.save()
+
+def load_trace_stats(event_path, event_file_column_names=None,
+        sector_size=None):
+    """
+    Return the sidecar index of the event file. If it is missing or older
+    than the event file, it is built first when column names and sector size
+    are given, otherwise None is returned.
+    """
+    stats_path = trace_stats_path(event_path)
+    fresh = os.path.exists(stats_path) and \
+            os.path.exists(ncq_timeline_path(event_path)) and \
+            (not os.path.exists(event_path) or
+             os.path.getmtime(stats_path) >= os.path.getmtime(event_path))
+    if not fresh:
+        if event_file_column_names is None or sector_size is None or \
+                not os.path.exists(event_path):
+            return None
+        try:
+            build_trace_stats(event_path, event_file_column_names,
+                    sector_size)
+        except (IOError, OSError):
+            # e.g. the trace is in a read-only directory
+            return None
+        if not os.path.exists(stats_path):
+            return None
+
+    with open(stats_path, 'r') as f:
+        stats = json.load(f)
+    if stats['version'] != TRACE_STATS_VERSION:
+        return None
+    return stats
+
+def get_bandwidth_mb(stats, operation):
+    "Issued MB/s of operation over the duration of the trace"
+    size_mb = stats['actions'].get('D', {}).get(operation,
+            {'bytes': 0})['bytes'] / float(MB)
+    return size_mb / stats['duration']
+
+
 class BlockTraceManager(object):
     "This class provides interfaces to interact with blktrace"
     def __init__(self, dev, event_file_column_names,
             resultpath, to_ftlsim_path, sector_size, padding_bytes=0,
-            do_sort=True):
+            do_sort=True, n_workers=1):
         self.dev = dev
         self.sector_size = sector_size
         self.event_file_column_names = event_file_column_names
@@ -256,20 +667,23 @@ class BlockTraceManager(object):
         self.sector_size = sector_size
         self.padding_bytes = padding_bytes
         self.do_sort = do_sort
+        self.n_workers = n_workers
 
-    def start_tracing_and_collecting(self, trace_filter=None):
-        self.proc = start_blktrace_on_bg(self.dev, self.resultpath, trace_filter)
+    def start_tracing_and_collecting(self, trace_filter=None, stream=False):
+        self.proc = start_blktrace_on_bg(self.dev, self.resultpath,
+                trace_filter, stream=stream)
 
     def stop_tracing_and_collecting(self):
         stop_blktrace_on_bg()
 
     def create_event_file_from_blkparse(self):
         if self.do_sort is True:
-            rawparser = BlktraceResultInMem(self.sector_size,
+            rawparser = BlktraceResultExternalSort(self.sector_size,
                     self.event_file_column_names,
                     self.resultpath, self.to_ftlsim_path,
                     padding_bytes=self.padding_bytes,
-                    do_sort=self.do_sort
+                    do_sort=self.do_sort,
+                    n_workers=self.n_workers
                     )
             rawparser.create_event_file()
 
@@ -278,12 +692,17 @@ class BlockTraceManager(object):
                     self.event_file_column_names,
                     self.resultpath, self.to_ftlsim_path,
                     padding_bytes=self.padding_bytes,
-                    do_sort=self.do_sort
+                    do_sort=self.do_sort,
+                    n_workers=self.n_workers
                     )
             rawparser.create_event_file()
 
 
-def start_blktrace_on_bg(dev, resultpath, trace_filter=None):
+def start_blktrace_on_bg(dev, resultpath, trace_filter=None, stream=False):
+    """
+    With stream=True, blkparse output is also available from the stdout of
+    the returned process while it is appended to resultpath.
+    """
     prepare_dir_for_path(resultpath)
     # cmd = "sudo blktrace -a write -a read -d {dev} -o - | blkparse -i - > "\
     # cmd = "sudo blktrace -a queue -d {dev} -o - | blkparse -a queue -i - > "\
@@ -294,12 +713,19 @@ def start_blktrace_on_bg(dev, resultpath, trace_filter=None):
     else:
         trace_filter = ' '.join(['-a ' + mask for mask in trace_filter])
 
+    if stream is True:
+        redirect = "| tee -a"
+        stdout = subprocess.PIPE
+    else:
+        redirect = ">>"
+        stdout = None
+
     cmd = "sudo blktrace {filtermask} -d {dev} -o - | "\
-            "blkparse {filtermask} -i - >> "\
+            "blkparse {filtermask} -i - {redirect} "\
         "{resultpath}".format(dev = dev, resultpath = resultpath,
-        filtermask = trace_filter)
+        filtermask = trace_filter, redirect = redirect)
     print cmd
-    p = subprocess.Popen(cmd, shell=True)
+    p = subprocess.Popen(cmd, shell=True, stdout=stdout)
     time.sleep(0.3) # wait to see if there's any immediate error.
 
     if p.poll() != None:
@@ -312,12 +738,186 @@ def stop_blktrace_on_bg():
     shcmd('pkill blktrace', ignore_error=True)
     shcmd('sync')
 
+DATA_LINE_RE = re.compile(r'\d+,\d+.*\d+\s+\+\s+\d+')
+
+# layout of the tuples returned by parse_data_line()
+BLKPARSE_RECORD_FIELDS = ('devid', 'cpuid', 'seqid', 'timestamp', 'pid',
+        'action', 'RWBS', 'sector_start', 'ignore1', 'sector_count',
+        'operation', 'sync', 'offset', 'size', 'type')
+
 def is_data_line(line):
     #                       devid    sector_start + nblocks
-    match_obj = re.match( r'\d+,\d+.*\d+\s+\+\s+\d+', line)
+    match_obj = DATA_LINE_RE.match(line)
     if match_obj == None:
         return False
     else:
         return True
 
+def parse_data_line(line, sector_size, padding_bytes=0):
+    """
+    Return a tuple laid out as BLKPARSE_RECORD_FIELDS, or None if line is
+    not a data line. The values are the same as the row dicts of
+    BlktraceResultInMem.
+    """
+    if DATA_LINE_RE.match(line) is None:
+        return None
+
+    items = line.split()
+    assert len(items) >= 10
+    rwbs = items[6]
+
+    if 'D' in rwbs:
+        operation = 'discard'
+    elif 'W' in rwbs:
+        operation = 'write'
+    elif 'R' in rwbs:
+        operation = 'read'
+    else:
+        raise RuntimeError('unknow operation ' + rwbs)
+
+    if 'S' in rwbs:
+        sync = 'True'
+    else:
+        sync = 'False'
+
+    offset = int(items[7]) * sector_size - padding_bytes
+    size = int(items[9]) * sector_size
+
+    return tuple(items[:10]) + (operation, sync, offset, size, 'blkparse')
+
+def record_columns_getter(column_names):
+    """
+    Return a function that turns a record of parse_data_line() into the
+    string columns of an event line. Columns that are not in the record,
+    such as pre_wait_time, are 'NA'.
+    """
+    indices = [BLKPARSE_RECORD_FIELDS.index(name)
+            if name in BLKPARSE_RECORD_FIELDS else None
+            for name in column_names]
+
+    def get_columns(record):
+        return ['NA' if i is None else str(record[i]) for i in indices]
+
+    return get_columns
+
+def shard_byte_ranges(path, n_shards):
+    """
+    Split the file into at most n_shards [start, end) byte ranges that
+    begin and end at line boundaries.
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            pos = max(file_size * i / n_shards, boundaries[-1])
+            if pos > 0:
+                f.seek(pos - 1)
+                f.readline()
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if start < end]
+
+def iter_lines_of_range(path, start, end):
+    "Yield (byte offset, line) of the lines starting in [start, end)"
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if line == '':
+                break
+            yield pos, line
+            pos += len(line)
+
+def map_on_workers(func, args_list, n_workers):
+    if n_workers <= 1 or len(args_list) <= 1:
+        return map(func, args_list)
+
+    pool = multiprocessing.Pool(min(n_workers, len(args_list)))
+    try:
+        return pool.map(func, args_list)
+    finally:
+        pool.close()
+        pool.join()
+
+def event_lines_of_range(path, start, end, sector_size, padding_bytes,
+        column_names):
+    "Yield the event lines of the data lines starting in [start, end)"
+    get_columns = record_columns_getter(column_names)
+    for _, line in iter_lines_of_range(path, start, end):
+        record = parse_data_line(line.strip(), sector_size, padding_bytes)
+        if record is None:
+            continue
+        yield ' '.join(get_columns(record)) + '\n'
+
+def _lines_of_file(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield line
+
+def _write_event_lines_of_shard(args):
+    path, start, end, sector_size, padding_bytes, column_names, tmpdir = args
+
+    fd, part_path = tempfile.mkstemp(suffix='.part', dir=tmpdir)
+    with os.fdopen(fd, 'w') as out_file:
+        for line in event_lines_of_range(path, start, end, sector_size,
+                padding_bytes, column_names):
+            out_file.write(line)
+
+    return part_path
+
+def _iter_run_records(path, sector_size, padding_bytes, column_names,
+        start=0, end=None):
+    """
+    Yield (timestamp, line offset, columns) for the data lines in [start,
+    end). The line offset keeps rows with equal timestamps in file order
+    when runs are merged, like a stable sort.
+    """
+    if end is None:
+        end = os.path.getsize(path)
+    get_columns = record_columns_getter(column_names)
+    i_timestamp = BLKPARSE_RECORD_FIELDS.index('timestamp')
+
+    for pos, line in iter_lines_of_range(path, start, end):
+        record = parse_data_line(line.strip(), sector_size, padding_bytes)
+        if record is None:
+            continue
+        yield (float(record[i_timestamp]), pos, get_columns(record))
+
+def _write_sorted_runs_of_shard(args):
+    path, start, end, sector_size, padding_bytes, column_names, \
+            lines_per_run, tmpdir = args
+
+    run_paths = []
+    run = []
+    for record in _iter_run_records(path, sector_size, padding_bytes,
+            column_names, start, end):
+        run.append(record)
+        if len(run) == lines_per_run:
+            run_paths.append(_spill_run(run, tmpdir))
+            run = []
+    if len(run) > 0:
+        run_paths.append(_spill_run(run, tmpdir))
+
+    return run_paths
+
+def _spill_run(records, tmpdir):
+    records.sort()
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'w') as f:
+        _dump_run(records, f)
+    return path
+
+def _dump_run(records, f):
+    # repr() round-trips the float timestamp exactly
+    for timestamp, pos, columns in records:
+        f.write('{} {} {}\n'.format(repr(timestamp), pos, ' '.join(columns)))
+
+def _read_run(path):
+    with open(path, 'r') as f:
+        for line in f:
+            timestamp, pos, columns = line.rstrip('\n').split(' ', 2)
+            yield (float(timestamp), int(pos), columns.split(' '))
 
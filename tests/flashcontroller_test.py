@@ -148,6 +148,54 @@ class TestControllerTranslation(unittest.TestCase):
         self.my_run()
 
 
+class TestControllerBatchTranslation(unittest.TestCase):
+    def setup_config(self):
+        self.conf = config.ConfigNewFlash()
+
+        self.conf['flash_config']['n_pages_per_block'] = 4
+        self.conf['flash_config']['n_blocks_per_plane'] = 3
+        self.conf['flash_config']['n_planes_per_chip'] = 2
+        self.conf['flash_config']['n_chips_per_package'] = 2
+        self.conf['flash_config']['n_packages_per_channel'] = 2
+        self.conf['flash_config']['n_channels_per_dev'] = 3
+
+    def test_main(self):
+        self.setup_config()
+        env = simpy.Environment()
+        controller = wiscsim.controller.Controller(env, self.conf)
+
+        ppns = range(controller.n_pages_per_dev)
+        # the first batch is translated with numpy if it is installed
+        for batch in (ppns, ppns[:5]):
+            columns = controller.physical_to_machine_pages(batch)
+            chip_columns = controller.physical_to_machine_pages(batch,
+                    levels = ['channel', 'chip'])
+            self.assertListEqual(sorted(chip_columns.keys()),
+                    ['channel', 'chip'])
+            for i, ppn in enumerate(batch):
+                addr = controller.physical_to_machine_page(ppn)
+                for name, n in zip(addr.names, addr.location):
+                    self.assertEqual(columns[name][i], n)
+                self.assertEqual(chip_columns['channel'][i], addr.channel)
+                self.assertEqual(chip_columns['chip'][i], addr.chip)
+
+    def test_lazy_address(self):
+        self.setup_config()
+        env = simpy.Environment()
+        controller = wiscsim.controller.Controller(env, self.conf)
+
+        req = controller.get_flash_requests_for_ppns(100, 1, 'read')[0]
+        addr = controller.physical_to_machine_page(100)
+        self.assertEqual(req.addr.channel, addr.channel)
+        self.assertListEqual(req.addr.location, addr.location)
+
+        req = controller.get_flash_requests_for_pbns(20, 1, 'erase')[0]
+        addr = controller.physical_to_machine_block(20)
+        self.assertEqual(req.addr.channel, addr.channel)
+        self.assertEqual(req.addr.block, addr.block)
+        self.assertEqual(req.addr.page, None)
+
+
 class TestControllerRequest(unittest.TestCase):
     def setup_config(self):
         self.conf = config.ConfigNewFlash()
@@ -441,6 +489,72 @@ class TestControllerTag(unittest.TestCase):
 
 
 
+class TestControllerRwPpns(unittest.TestCase):
+    def setup_config(self):
+        self.conf = config.ConfigNewFlash()
+
+        self.conf['flash_config']['n_pages_per_block'] = 2
+        self.conf['flash_config']['n_blocks_per_plane'] = 2
+        self.conf['flash_config']['n_planes_per_chip'] = 1
+        self.conf['flash_config']['n_chips_per_package'] = 1
+        self.conf['flash_config']['n_packages_per_channel'] = 1
+        self.conf['flash_config']['n_channels_per_dev'] = 2
+
+        set_exp_metadata(self.conf, save_data = False,
+                expname = 'default',
+                subexpname = 'default-sub')
+        runtime_update(self.conf)
+
+    def create_controller(self, env):
+        rec = wiscsim.recorder.Recorder(output_target = self.conf['output_target'],
+            output_directory = self.conf['result_dir'],
+            verbose_level = self.conf['verbose_level'],
+            print_when_finished = False
+            )
+        rec.enable()
+
+        return wiscsim.controller.Controller3(env, self.conf, rec)
+
+    def rw_ppns_one_by_one(self, env, controller, ppns, op, tag):
+        procs = [env.process(controller.rw_ppn_extent(ppn, 1, op, tag))
+                for ppn in ppns]
+        yield simpy.events.AllOf(env, procs)
+
+    def access(self, env, controller, rw_func, finish_times):
+        def proc(ppns, op, tag):
+            yield env.process(rw_func(ppns, op, tag))
+            finish_times.append(env.now)
+
+        p1 = env.process(proc([0, 5, 1, 4, 6], 'write', 'tag1'))
+        yield env.timeout(1)
+        p2 = env.process(proc([7, 2, 3], 'read', 'tag2'))
+        yield simpy.events.AllOf(env, [p1, p2])
+
+    def run_with(self, rw_func_name):
+        env = simpy.Environment()
+        controller = self.create_controller(env)
+        if rw_func_name == 'rw_ppns':
+            rw_func = controller.rw_ppns
+        else:
+            rw_func = lambda ppns, op, tag: self.rw_ppns_one_by_one(
+                    env, controller, ppns, op, tag)
+
+        finish_times = []
+        env.process(self.access(env, controller, rw_func, finish_times))
+        env.run()
+
+        return finish_times, controller.recorder.general_accumulator
+
+    def test_same_as_one_by_one(self):
+        self.setup_config()
+
+        times, counters = self.run_with('rw_ppns')
+        times_one_by_one, counters_one_by_one = self.run_with('one_by_one')
+
+        self.assertListEqual(times, times_one_by_one)
+        self.assertDictEqual(counters, counters_one_by_one)
+
+
 def main():
     unittest.main()
 
@@ -1,3 +1,4 @@
+import cPickle
 import unittest
 
 import wiscsim
@@ -118,6 +119,15 @@ class Test_LruCache(unittest.TestCase):
         self.assertEqual(d.victim_key(), 10)
         self.assertEqual(d.most_recently_used_key(), 9)
 
+    def test_add_to_least_used_empty(self):
+        d = LruCache()
+
+        d.add_as_least_used(1, 10)
+        d[2] = 20
+        self.assertListEqual(list(d), [2, 1])
+        self.assertEqual(d.victim_key(), 1)
+        self.assertEqual(d.most_recently_used_key(), 2)
+
     def _test_performance(self):
         d = LruDict()
         for i in range(2048):
@@ -226,6 +236,24 @@ class Test_LruDict(unittest.TestCase):
             v != 1
 
 
+class Test_LinkedListPickle(unittest.TestCase):
+    def test(self):
+        lrucache = LruCache()
+        for i in range(10000):
+            lrucache[i] = i * 10
+        lrucache[3] = 33
+
+        lrucache2 = cPickle.loads(cPickle.dumps(lrucache, 2))
+        self.assertListEqual(list(lrucache2.keys()), list(lrucache.keys()))
+        self.assertEqual(lrucache2.least_recently_used_key(), 0)
+        self.assertEqual(lrucache2.most_recently_used_key(), 3)
+        self.assertEqual(len(lrucache2.linked_list), 10000)
+
+        lrucache2[5] = 55
+        self.assertEqual(lrucache2.most_recently_used_key(), 5)
+        self.assertEqual(lrucache.most_recently_used_key(), 3)
+
+
 def has_key(d, key):
     return d.has_key(key)
 
@@ -1,8 +1,15 @@
+import multiprocessing
+import random
 import socket
+import subprocess
 import unittest
 import time
 import copy
+from collections import Counter
 import pprint
+import os
+import shutil
+import tempfile
 
 import workrunner
 import wiscsim
@@ -10,11 +17,17 @@ from utilities import utils
 from config import MountOption as MOpt
 from config import ConfigNCQFTL
 from workflow import run_workflow
+from workrunner.nonblockingreader import NonBlockingReader
 from wiscsim.simulator import GcLog
 from wiscsim.ftlsim_commons import Extent, random_channel_id
 from wiscsim.ftlcounter import LpnClassification, get_file_range_table, EventNCQParser
+from wiscsim import ftlcounter
 from wiscsim import hostevent
+from pyreuse.sysutils import blocktrace
 from config_helper.rule_parameter import EventFileSets
+from config_helper import sweep
+from config_helper import resultcache
+from config_helper import experiment
 from commons import *
 
 class TestCpuhandler(unittest.TestCase):
@@ -178,6 +191,45 @@ class TestLpnClassification(unittest.TestCase):
         classifier.classify()
 
 
+class TestLpnExtentCounts(unittest.TestCase):
+    @unittest.skipIf(ftlcounter.numpy is None, "needs numpy")
+    def test_same_as_counter(self):
+        rand = random.Random(1)
+        counts = ftlcounter.LpnExtentCounts(100, chunk_size=7)
+        counter = Counter()
+        for i in range(200):
+            # some extents go beyond the 100 LPNs
+            start = rand.randint(0, 110)
+            length = rand.randint(0, 16)
+            counts.add(start, length)
+            for lpn in range(start, start + length):
+                counter[lpn] += 1
+
+            if i % 50 == 0:
+                array = counts.counts()
+                self.assertEqual(dict((lpn, array[lpn])
+                    for lpn in array.nonzero()[0]), dict(counter))
+
+        array = counts.counts()
+        self.assertEqual(array.dtype, ftlcounter.numpy.uint32)
+        self.assertEqual(dict((lpn, array[lpn])
+            for lpn in array.nonzero()[0]), dict(counter))
+
+    @unittest.skipIf(ftlcounter.numpy is None, "needs numpy")
+    def test_counts_of_beyond_counted(self):
+        numpy = ftlcounter.numpy
+        writes = ftlcounter.LpnExtentCounts(10)
+        reads = ftlcounter.LpnExtentCounts(10)
+        # the write counter grows to 13 LPNs, the read counter stays at 10
+        writes.add(8, 5)
+        reads.add(-2, 3)
+        lpns = numpy.arange(-2, 13)
+        self.assertEqual(list(writes.counts_of(lpns)),
+                [0] * 10 + [1] * 5)
+        self.assertEqual(list(reads.counts_of(lpns)),
+                [1, 1, 1] + [0] * 12)
+
+
 class TestNCQParser(unittest.TestCase):
     def test(self):
         # blkparse-events-for-ftlsim.txt
@@ -200,6 +252,404 @@ class TestNCQParser(unittest.TestCase):
         self.assertEqual(table[1]['post_depth'], 0)
 
 
+class TestBinaryEventFile(unittest.TestCase):
+    attr_names = ['pid', 'action', 'operation', 'offset', 'size', 'timestamp',
+            'pre_wait_time', 'sync', 'sector', 'sector_count']
+
+    def assert_same_events(self, events1, events2):
+        self.assertEqual(len(events1), len(events2))
+        for event1, event2 in zip(events1, events2):
+            for name in self.attr_names:
+                self.assertEqual(getattr(event1, name), getattr(event2, name))
+
+    def test_same_events(self):
+        conf = ConfigNCQFTL()
+        text_path = 'tests/testdata/sqlitewal-update/subexp-7928737328932659543-ext4-10-07-23-50-10--2726320246496492803/blkparse-events-for-ftlsim.txt'
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tmp_text_path = os.path.join(tmp_dir, 'events.txt')
+            shutil.copy(text_path, tmp_text_path)
+            iterator = hostevent.event_iterator_of_file(conf, tmp_text_path)
+            self.assertIsInstance(iterator, hostevent.EventIterator)
+            text_events = list(iterator)
+
+            binary_path = hostevent.convert_event_file_to_binary(conf,
+                    tmp_text_path)
+            self.assertEqual(binary_path, os.path.join(tmp_dir, 'events.bin'))
+
+            iterator = hostevent.event_iterator_of_file(conf, tmp_text_path)
+            self.assertIsInstance(iterator, hostevent.MmapEventIterator)
+            mmap_events = list(iterator)
+            self.assert_same_events(text_events, mmap_events)
+            self.assertEqual(str(iterator[-1]), str(text_events[-1]))
+            iterator.close()
+
+            conf['mmap_event_file'] = False
+            iterator = hostevent.event_iterator_of_file(conf, tmp_text_path)
+            self.assertIsInstance(iterator, hostevent.BinaryEventIterator)
+            iterator.records_per_read = 7
+            binary_events = list(iterator)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assert_same_events(text_events, binary_events)
+
+    def test_convert_on_read(self):
+        conf = ConfigNCQFTL()
+        conf['binary_event_file'] = True
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            text_path = os.path.join(tmp_dir, 'events.txt')
+            with open(text_path, 'w') as f:
+                # timestamps are not in the 9-decimal format of blkparse
+                f.write('1 D write 0 4096 0.1 NA True\n')
+                f.write('1 D read 4096 8192 1.25 0.5 False\n')
+
+            iterator = hostevent.event_iterator_of_file(conf, text_path)
+            self.assertIsInstance(iterator, hostevent.MmapEventIterator)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir,
+                'events.bin')))
+            events = list(iterator)
+            # the map of the iteration is closed when it ends
+            self.assertIsNone(iterator._buffer)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual([e.timestamp for e in events],
+                ['0.100000000', '1.250000000'])
+        self.assertEqual([e.pre_wait_time for e in events], ['NA', 0.5])
+        self.assertEqual([e.sector_count for e in events], [8, 16])
+
+
+class TestEventCompactor(unittest.TestCase):
+    def event(self, offset, size, timestamp, pid=1, operation=OP_WRITE):
+        return hostevent.Event(512, pid, operation, offset, size,
+                timestamp=timestamp, pre_wait_time='NA', sync='False')
+
+    def compact(self, events):
+        conf = ConfigNCQFTL()
+        compactor = hostevent.EventCompactor(conf, events,
+                time_window=0.001, max_size=16*KB)
+        return compactor, list(compactor)
+
+    def test_merge(self):
+        events = [
+            self.event(0, 4*KB, '0.000100000'),
+            self.event(4*KB, 4*KB, '0.000200000'),
+            self.event(8*KB, 4*KB, '0.000300000'),
+            # too late
+            self.event(12*KB, 4*KB, '0.002000000'),
+            # other pid
+            self.event(16*KB, 4*KB, '0.002100000', pid=2),
+            # other operation
+            self.event(20*KB, 4*KB, '0.002200000', pid=2,
+                operation=OP_READ),
+            self.event(24*KB, 4*KB, '0.002300000', pid=2,
+                operation=OP_READ),
+            hostevent.ControlEvent(operation=OP_BARRIER),
+            self.event(28*KB, 8*KB, '0.002400000', pid=2,
+                operation=OP_READ),
+            self.event(36*KB, 8*KB, '0.002500000', pid=2,
+                operation=OP_READ),
+            # exceeds the size cap
+            self.event(44*KB, 4*KB, '0.002600000', pid=2,
+                operation=OP_READ),
+            ]
+        compactor, compacted = self.compact(events)
+
+        extents = [(e.offset, e.size, e.timestamp) if
+                isinstance(e, hostevent.Event) else e.operation
+                for e in compacted]
+        self.assertEqual(extents, [
+            (0, 12*KB, '0.000100000'),
+            (12*KB, 4*KB, '0.002000000'),
+            (16*KB, 4*KB, '0.002100000'),
+            (20*KB, 8*KB, '0.002200000'),
+            OP_BARRIER,
+            (28*KB, 16*KB, '0.002400000'),
+            (44*KB, 4*KB, '0.002600000'),
+            ])
+        self.assertEqual(compacted[0].sector_count, 24)
+        self.assertEqual(compactor.n_events_in, 10)
+        self.assertEqual(compactor.n_eliminated, 4)
+
+    def test_unchanged(self):
+        events = [self.event(0, 4*KB, None), self.event(4*KB, 4*KB, None),
+                self.event(16*KB, 4*KB, '0.1'),
+                self.event(24*KB, 4*KB, '0.1')]
+        compactor, compacted = self.compact(events)
+        self.assertEqual([id(e) for e in compacted], [id(e) for e in events])
+        self.assertEqual(compactor.n_eliminated, 0)
+
+
+class TestEventSampler(unittest.TestCase):
+    def events(self):
+        # 1 event per 0.1 second, 8KB each, walking through 64KB
+        events = [hostevent.ControlEvent(operation=OP_BARRIER)]
+        for i in range(20):
+            events.append(hostevent.Event(512, 1, OP_WRITE,
+                (i * 8*KB) % (64*KB), 8*KB, timestamp=str(i * 0.1),
+                pre_wait_time='NA', sync='False'))
+        return events
+
+    def sample(self, **kwargs):
+        sampler = hostevent.EventSampler(ConfigNCQFTL(), self.events(),
+                **kwargs)
+        return sampler, list(sampler)
+
+    def test_windows(self):
+        sampler, events = self.sample(start_time=0.45, end_time=1.25)
+        self.assertEqual([e.timestamp for e in events[1:]],
+                [str(i * 0.1) for i in range(5, 13)])
+        self.assertEqual(events[0].operation, OP_BARRIER)
+        self.assertEqual(sampler.scale_factors()['window_rw_bytes'], 64*KB)
+
+        sampler, events = self.sample(start_bytes=16*KB, max_bytes=24*KB)
+        self.assertEqual([e.timestamp for e in events[1:]],
+                [str(i * 0.1) for i in range(2, 5)])
+        factors = sampler.scale_factors()
+        self.assertEqual(factors['sampled_rw_bytes'], 24*KB)
+        self.assertAlmostEqual(factors['window_duration'], 0.2)
+
+    def test_lba_sampling(self):
+        sampler, events = self.sample(lba_sample_rate=0.5,
+                lba_region_size=4*KB, lba_bytes=64*KB)
+        factors = sampler.scale_factors()
+        n_kept = len(sampler.region_map)
+        self.assertEqual(factors['lba_sample_rate'], n_kept / 16.0)
+        self.assertEqual(factors['sampled_lba_bytes'], n_kept * 4*KB)
+        self.assertTrue(0 < n_kept < 16)
+
+        # every kept 4KB piece lands in the packed address space once per
+        # pass over the 64KB
+        pieces = [(e.offset, e.size) for e in events[1:]]
+        self.assertEqual(sorted(set(pieces)),
+                [(i * 4*KB, 4*KB) for i in range(n_kept)])
+        self.assertEqual(factors['events_in'], 20)
+        self.assertEqual(factors['events_out'], len(pieces))
+        self.assertEqual(factors['sampled_rw_bytes'], len(pieces) * 4*KB)
+        self.assertEqual(factors['window_rw_bytes'], 160*KB)
+
+    def test_device_fits_lba_sample(self):
+        conf = wiscsim.dftldes.Config()
+        conf['dev_size_mb'] = 64
+        conf['flash_config']['n_blocks_per_plane'] = 256
+        conf['lba_workload_configs'] = {'mkfs_event_path': None,
+                'ftlsim_event_path': None}
+        conf['stop_sim_on_bytes'] = 'inf'
+        conf['trace_sampling'] = {'lba_sample_rate': 0.25}
+        n_blocks = conf.n_blocks_per_dev
+
+        workrunner.lbaworkloadgenerator.BlktraceEvents(conf)
+        sampled_bytes = hostevent.EventSampler(conf, [],
+                **conf['trace_sampling']).sampled_lba_bytes
+        self.assertEqual(conf['trace_sampling']['lba_bytes'], 64*MB)
+        self.assertEqual(conf['dev_size_mb'] * MB, sampled_bytes)
+        self.assertTrue(conf.n_blocks_per_dev * 64*MB >=
+                n_blocks * sampled_bytes)
+
+        # the conf is not shrunk again
+        dev_size_mb = conf['dev_size_mb']
+        workrunner.lbaworkloadgenerator.BlktraceEvents(conf)
+        self.assertEqual(conf['dev_size_mb'], dev_size_mb)
+
+
+class TestDataGroupShard(unittest.TestCase):
+    def test_shards(self):
+        # 8KB writes walking through 64KB, data groups of 4KB
+        events = [hostevent.ControlEvent(operation=OP_BARRIER)]
+        for i in range(8):
+            events.append(hostevent.Event(512, 1, OP_WRITE, i * 8*KB, 8*KB))
+
+        pieces = []
+        for shard in range(3):
+            sharder = hostevent.DataGroupShard(ConfigNCQFTL(), events,
+                    shard, 3, group_bytes=4*KB)
+            shard_events = list(sharder)
+            self.assertEqual(shard_events[0].operation, OP_BARRIER)
+            # groups shard, shard + 3, ... are packed to the front
+            self.assertEqual([(e.offset, e.size) for e in shard_events[1:]],
+                    [(i * 4*KB, 4*KB) for i in range(len(shard_events) - 1)])
+            self.assertEqual(sharder.n_events_in, 8)
+            pieces.extend(shard_events[1:])
+
+        self.assertEqual(sum(e.size for e in pieces), 64*KB)
+
+
+class TestBlktraceConversion(unittest.TestCase):
+    def setUp(self):
+        self.conf = ConfigNCQFTL()
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # shuffle the trace and round timestamps so that sorting has
+        # out-of-order rows and ties to handle
+        with open('tests/testdata/blkparse-output.txt') as f:
+            lines = f.readlines()
+        random.Random(1).shuffle(lines)
+        self.raw_path = os.path.join(self.tmp_dir, 'blkparse-output.txt')
+        with open(self.raw_path, 'w') as f:
+            for line in lines:
+                items = line.split()
+                if blocktrace.is_data_line(line.strip()):
+                    items[3] = '{:.3f}'.format(float(items[3]))
+                f.write(' '.join(items) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, cls, name, **kwargs):
+        path = os.path.join(self.tmp_dir, name)
+        cls(self.conf['sector_size'], self.conf['event_file_column_names'],
+                self.raw_path, path, padding_bytes=4096,
+                **kwargs).create_event_file()
+        with open(path) as f:
+            return f.readlines()
+
+    def test_external_sort_same_as_in_mem(self):
+        in_mem_lines = self.convert(blocktrace.BlktraceResultInMem,
+                'in-mem.txt')
+        self.assertTrue(len(in_mem_lines) > 16 * 4)
+
+        for n_workers in (1, 3):
+            ext_sort_lines = self.convert(
+                    blocktrace.BlktraceResultExternalSort, 'ext-sort.txt',
+                    lines_per_run=16, max_runs_per_merge=4,
+                    n_workers=n_workers)
+            self.assertEqual(in_mem_lines, ext_sort_lines)
+
+        # no runs are left behind, only the event files and their indexes
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                ['blkparse-output.txt', 'ext-sort.ncq.txt',
+                 'ext-sort.stats.json', 'ext-sort.txt', 'in-mem.ncq.txt',
+                 'in-mem.stats.json', 'in-mem.txt'])
+
+    def test_sharded_conversion(self):
+        in_mem_lines = self.convert(blocktrace.BlktraceResultInMem,
+                'in-mem.txt', do_sort=False)
+        wait_col = self.conf['event_file_column_names'].index('pre_wait_time')
+        expected = []
+        for line in in_mem_lines:
+            items = line.split()
+            items[wait_col] = 'NA'
+            expected.append(' '.join(items) + '\n')
+
+        for n_workers in (1, 3, 7):
+            lines = self.convert(blocktrace.BlktraceResult, 'events.txt',
+                    do_sort=False, n_workers=n_workers)
+            self.assertEqual(lines, expected)
+
+    def test_live_converter(self):
+        ext_sort_lines = self.convert(blocktrace.BlktraceResultExternalSort,
+                'ext-sort.txt')
+
+        # the shuffled trace only comes out sorted with a window that holds
+        # every line
+        with open(self.raw_path) as f:
+            raw_lines = f.readlines()
+        converter = blocktrace.BlktraceLiveConverter(
+                self.conf['sector_size'], self.conf['event_file_column_names'],
+                padding_bytes=4096, reorder_window=len(raw_lines))
+        lines = []
+        for line in raw_lines:
+            self.assertEqual(converter.add_line(line), [])
+        lines.extend(converter.flush())
+        self.assertEqual([line + '\n' for line in lines], ext_sort_lines)
+
+        # late lines never get a negative pre_wait_time
+        converter = blocktrace.BlktraceLiveConverter(
+                self.conf['sector_size'], self.conf['event_file_column_names'],
+                padding_bytes=4096, reorder_window=8)
+        lines = []
+        for line in raw_lines:
+            lines.extend(converter.add_line(line))
+        lines.extend(converter.flush())
+        self.assertEqual(len(lines), len(ext_sort_lines))
+        wait_col = self.conf['event_file_column_names'].index('pre_wait_time')
+        for line in lines:
+            self.assertTrue(float(line.split()[wait_col]) >= 0)
+
+    def test_trace_stats(self):
+        in_mem = blocktrace.BlktraceResultInMem(self.conf['sector_size'],
+                self.conf['event_file_column_names'], self.raw_path,
+                os.path.join(self.tmp_dir, 'in-mem.txt'), padding_bytes=4096)
+        self.convert(blocktrace.BlktraceResultExternalSort, 'events.txt')
+        event_path = os.path.join(self.tmp_dir, 'events.txt')
+        stats = blocktrace.load_trace_stats(event_path)
+
+        self.assertAlmostEqual(stats['duration'], in_mem.get_duration())
+        for op in ('read', 'write', 'discard'):
+            self.assertEqual(stats['actions']['D'].get(op,
+                {'sectors': 0})['sectors'], in_mem.count_sectors(op))
+        self.assertEqual(sum(sum(hist) for hist in
+            stats['per_second_bytes'].values()),
+            sum(op['bytes'] for op in stats['actions']['D'].values()))
+        self.assertTrue(0 < stats['footprint_bytes']['write'] <=
+                stats['footprint_bytes']['all'])
+
+        # the NCQ depth timeline is the table of EventNCQParser
+        table = EventNCQParser(hostevent.EventIterator(self.conf,
+            hostevent.FileLineIterator(event_path))).parse()
+        with open(blocktrace.ncq_timeline_path(event_path)) as f:
+            self.assertEqual(f.read(), utils.table_to_str(table, width=0))
+        self.assertEqual(stats['max_ncq_depth'],
+                max(row['post_depth'] for row in table))
+
+        # a missing index is built from the event file
+        os.remove(blocktrace.trace_stats_path(event_path))
+        self.assertEqual(blocktrace.load_trace_stats(event_path), None)
+        self.assertEqual(blocktrace.load_trace_stats(event_path,
+            self.conf['event_file_column_names'], self.conf['sector_size']),
+            stats)
+
+    def test_trace_stats_unsorted(self):
+        event_path = os.path.join(self.tmp_dir, 'unsorted.txt')
+        builder = blocktrace.TraceStatsBuilder(event_path,
+                self.conf['event_file_column_names'], self.conf['sector_size'])
+        columns = self.conf['event_file_column_names']
+        for action, timestamp, size in [('D', '10.5', 4096),
+                ('D', '9.0', 8192), ('C', '9.1', 8192), ('D', '12.0', 512)]:
+            row = {'pid': '1', 'action': action, 'operation': 'write',
+                    'offset': '0', 'size': str(size), 'timestamp': timestamp,
+                    'pre_wait_time': '0', 'sync': 'False', 'sector': '0',
+                    'sector_count': str(size / 512)}
+            builder.add_columns([row[name] for name in columns])
+        stats = builder.get_stats()
+        builder.discard()
+
+        self.assertEqual(stats['n_out_of_order'], 1)
+        self.assertEqual(stats['per_second_bytes']['write'],
+                [4096 + 8192, 512])
+
+    def test_shard_byte_ranges(self):
+        ranges = blocktrace.shard_byte_ranges(self.raw_path, 5)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.raw_path))
+        with open(self.raw_path) as f:
+            data = f.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1], '\n')
+
+
+class TestNonBlockingReader(unittest.TestCase):
+    def test_pipe(self):
+        p = subprocess.Popen('cat tests/testdata/blkparse-output.txt',
+                shell=True, stdout=subprocess.PIPE)
+        reader = NonBlockingReader(f=p.stdout)
+        lines = []
+        while not reader.is_exhausted():
+            line = reader.readline()
+            if line is None:
+                time.sleep(0.01)
+            else:
+                lines.append(line)
+        p.wait()
+
+        with open('tests/testdata/blkparse-output.txt') as f:
+            self.assertEqual(lines, f.readlines())
+
+
 class TestEventFileSets(unittest.TestCase):
     def test(self):
         filesets = EventFileSets('tests/testdata/64mbfile')
@@ -210,6 +660,170 @@ class TestEventFileSets(unittest.TestCase):
 
 
 
+def fake_simulation(para, cache):
+    job = sweep.SweepJob(para, cache)
+    if cache.claim(job.digest) is False:
+        return None
+    time.sleep(para['sleep'])
+    result_dir = os.path.join(job.exp_dir, job.subexpname + '-fsnotset-x')
+    utils.prepare_dir_for_path(os.path.join(result_dir, 'recorder.json'))
+    utils.dump_json({'general_accumulator': {
+        'traffic_size': {'write': para['value'] * 10}}},
+        os.path.join(result_dir, 'recorder.json'))
+    cache.store(job.digest, result_dir, para)
+    cache.release(job.digest)
+    return result_dir
+
+
+class TestSweepRunner(unittest.TestCase):
+    def test(self):
+        expname = 'test-sweep-runner-{}'.format(os.getpid())
+        paras = [{'expname': expname, 'value': i, 'sleep': 0}
+                for i in range(3)]
+        paras.append({'expname': expname, 'value': 3, 'sleep': 30})
+        paras.append({'expname': expname, 'value': 4, 'sleep': 0})
+        cache = resultcache.ResultCache(tempfile.mkdtemp())
+
+        # the first subexp has been finished before
+        fake_simulation(paras[0], cache)
+        # and another process is simulating the last one
+        busy_digest = sweep.SweepJob(paras[4], cache).digest
+        self.assertTrue(cache.claim(busy_digest))
+
+        runner = sweep.SweepRunner(paras, n_workers=2, timeout=2,
+                run_func=fake_simulation, poll_interval=0.1, cache=cache)
+        try:
+            jobs = runner.run()
+            cache.release(busy_digest)
+            self.assertListEqual([job.status for job in jobs],
+                    [sweep.SKIPPED, sweep.DONE, sweep.DONE, sweep.TIMEOUT,
+                        sweep.BUSY])
+
+            with open(runner.results_path) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 6)
+            table = runner.results_table()
+            self.assertListEqual(
+                [row['general_accumulator.traffic_size.write'] for row in table],
+                [0, 10, 20, 'NA', 'NA'])
+
+            # resuming only reruns the subexp that did not finish
+            runner = sweep.SweepRunner(paras[:3] + paras[:1], n_workers=2,
+                    run_func=fake_simulation, poll_interval=0.1, cache=cache)
+            self.assertListEqual([job.status for job in runner.run()],
+                    [sweep.SKIPPED] * 4)
+        finally:
+            shutil.rmtree(runner.jobs[0].exp_dir)
+            shutil.rmtree(cache.cache_dir)
+
+
+class TestCheckpointPrefix(unittest.TestCase):
+    def setup_checkpoint(self, checkpoint_dir, **para):
+        para = dict(para, expname='checkpoint', lbabytes=16*MB,
+                cache_mapped_data_bytes=16*MB,
+                checkpoint_dir=checkpoint_dir, mkfs_path='mkfs.txt',
+                ftlsim_path='ftlsim.txt', dirty_bytes=None)
+        exp = experiment.ExistingTraceExperiment(
+                experiment.simulation_parameters(para))
+        exp.setup_environment()
+        exp.setup_workload()
+        exp.setup_flash()
+        exp.setup_ftl()
+        exp.setup_checkpoint()
+        return exp.conf
+
+    def test_stripe_size(self):
+        checkpoint_dir = tempfile.mkdtemp()
+        try:
+            conf = self.setup_checkpoint(checkpoint_dir, stripe_size=1)
+            path = conf['checkpoint_save_path']
+            open(path, 'w').close()
+
+            conf = self.setup_checkpoint(checkpoint_dir, stripe_size=1)
+            self.assertEqual(conf['checkpoint_restore_path'], path)
+
+            conf = self.setup_checkpoint(checkpoint_dir, stripe_size=4)
+            self.assertEqual(conf['checkpoint_restore_path'], None)
+            self.assertNotEqual(conf['checkpoint_save_path'], path)
+        finally:
+            shutil.rmtree(checkpoint_dir)
+
+
+class TestResultCache(unittest.TestCase):
+    def test_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            trace_path = os.path.join(tmpdir, 'trace.txt')
+            with open(trace_path, 'w') as f:
+                f.write('0.1 write 0 4096\n')
+            para = {'expname': 'a', 'ftl': 'dftldes', 'ftlsim_path': trace_path,
+                    'segment_bytes': 2*MB, 'appconfs': [{'name': 'x'}]}
+            other = dict(reversed(para.items()))
+            other['expname'] = 'b'
+
+            digest = resultcache.para_digest(para)
+            self.assertEqual(len(digest), 40)
+            self.assertEqual(digest, resultcache.para_digest(other))
+
+            other['segment_bytes'] = 4*MB
+            self.assertNotEqual(digest, resultcache.para_digest(other))
+
+            copy_path = os.path.join(tmpdir, 'copy.txt')
+            shutil.copy(trace_path, copy_path)
+            other = dict(para, ftlsim_path=copy_path)
+            self.assertEqual(digest, resultcache.para_digest(other))
+            with open(copy_path, 'a') as f:
+                f.write('0.2 write 4096 4096\n')
+            self.assertNotEqual(digest, resultcache.para_digest(other))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_claim(self):
+        cache = resultcache.ResultCache(tempfile.mkdtemp())
+        try:
+            self.assertEqual(cache.lookup('abc'), None)
+            self.assertTrue(cache.claim('abc'))
+            self.assertFalse(cache.claim('abc'))
+            cache.release('abc')
+            self.assertTrue(cache.claim('abc'))
+            cache.release('abc')
+
+            # the owner of the lock is gone
+            with open(cache._lock_path('abc'), 'w') as f:
+                f.write('{} {}'.format(socket.gethostname(), 2**22 + 1))
+            self.assertTrue(cache.claim('abc'))
+            cache.release('abc')
+
+            # only one of the processes that find a lock file left by a
+            # dead owner takes it over
+            with open(cache._lock_path('abc'), 'w') as f:
+                f.write('{} {}'.format(socket.gethostname(), 2**22 + 1))
+            other = resultcache.ResultCache(cache.cache_dir)
+            self.assertTrue(other.claim('abc'))
+            self.assertFalse(cache.claim('abc'))
+            cache.release('abc')
+            self.assertTrue(os.path.exists(cache._lock_path('abc')))
+            other.release('abc')
+            self.assertTrue(cache.claim('abc'))
+            cache.release('abc')
+
+            # a claim is released when its process exits
+            p = multiprocessing.Process(target=cache.claim, args=('abc',))
+            p.start()
+            p.join()
+            self.assertTrue(cache.claim('abc'))
+            cache.release('abc')
+
+            result_dir = os.path.join(cache.cache_dir, 'result')
+            os.makedirs(result_dir)
+            cache.store('abc', result_dir)
+            self.assertEqual(cache.lookup('abc'), None)
+            utils.dump_json({}, os.path.join(result_dir, 'recorder.json'))
+            self.assertEqual(cache.lookup('abc'), result_dir)
+        finally:
+            shutil.rmtree(cache.cache_dir)
+
+
 def main():
     unittest.main()
 
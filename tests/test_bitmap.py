@@ -1,8 +1,9 @@
+import random
 import unittest
 
 import wiscsim
 from utilities import utils
-from wiscsim.bitmap import FlashBitmap2
+from wiscsim.bitmap import FlashBitmap2, BucketedFlashBitmap
 
 def create_config():
     conf = wiscsim.dftldes.Config()
@@ -67,6 +68,65 @@ class TestBitmap(unittest.TestCase):
         self.assertEqual(bitmap.block_valid_ratio(0),
                 1 - 1.0/conf.n_pages_per_block)
 
+    def test_block_counters(self):
+        conf = create_config()
+        bitmap = create_bitmap(conf)
+        rand = random.Random(0)
+        n_pages = conf.n_pages_per_block
+
+        def count_by_scan(blocknum, is_state):
+            start, end = conf.block_to_page_range(blocknum)
+            return sum(1 for ppn in range(start, end) if is_state(ppn))
+
+        for i in range(3000):
+            op = rand.choice(['validate', 'invalidate', 'validate', 'erase'])
+            if op == 'erase':
+                bitmap.erase_block(rand.randrange(4))
+            else:
+                ppn = rand.randrange(4 * n_pages)
+                if op == 'validate':
+                    bitmap.validate_page(ppn)
+                else:
+                    bitmap.invalidate_page(ppn)
+
+        for blocknum in range(4):
+            n_valid = count_by_scan(blocknum, bitmap.is_page_valid)
+            n_invalid = count_by_scan(blocknum, bitmap.is_page_invalid)
+            n_erased = count_by_scan(blocknum, bitmap.is_page_erased)
+
+            self.assertEqual(bitmap.block_valid_count(blocknum), n_valid)
+            self.assertEqual(bitmap.block_invalid_count(blocknum), n_invalid)
+            self.assertEqual(bitmap.block_erased_count(blocknum), n_erased)
+            self.assertEqual(bitmap.block_valid_ratio(blocknum),
+                    n_valid / float(n_pages))
+            self.assertEqual(bitmap.block_invalid_ratio(blocknum),
+                    (n_pages - n_valid) / float(n_pages))
+            self.assertEqual(bitmap.block_erased_ratio(blocknum),
+                    n_erased / float(n_pages))
+
+    def test_valid_count_buckets(self):
+        conf = create_config()
+        bitmap = BucketedFlashBitmap(conf)
+        n_pages = conf.n_pages_per_block
+
+        self.assertEqual(len(bitmap.blocks_with_valid_count(0)), 0)
+
+        start, _ = conf.block_to_page_range(1)
+        for ppn in range(start, start + 3):
+            bitmap.validate_page(ppn)
+        self.assertIn(1, bitmap.blocks_with_valid_count(3))
+
+        bitmap.invalidate_page(start)
+        self.assertNotIn(1, bitmap.blocks_with_valid_count(3))
+        self.assertIn(1, bitmap.blocks_with_valid_count(2))
+
+        bitmap.validate_block(2)
+        self.assertIn(2, bitmap.blocks_with_valid_count(n_pages))
+
+        bitmap.erase_block(1)
+        for n_valid in range(n_pages + 1):
+            self.assertNotIn(1, bitmap.blocks_with_valid_count(n_valid))
+
 
 def main():
     unittest.main()
@@ -44,7 +44,7 @@ class TestMultiChannelBlockPool(unittest.TestCase):
 
         pool.change_tag(0, src=TFREE, dst=TDATA)
         blocks = pool.get_blocks_of_tag(tag=TDATA)
-        self.assertListEqual(blocks, [0])
+        self.assertListEqual(list(blocks), [0])
 
     def test_change_tag_2(self):
         pool = MultiChannelBlockPool(
@@ -63,6 +63,32 @@ class TestMultiChannelBlockPool(unittest.TestCase):
         for block in blocks:
             pool.change_tag(block, src=TDATA, dst=TFREE)
 
+    def test_blocks_of_tags_view(self):
+        pool = MultiChannelBlockPool(
+                n_channels=4,
+                n_blocks_per_channel=16,
+                n_pages_per_block=32,
+                tags=[TDATA, TTRANS])
+
+        pool.change_tag(3, src=TFREE, dst=TDATA)
+        pool.change_tag(20, src=TFREE, dst=TTRANS)
+
+        used = pool.get_blocks_of_tags([TDATA, TTRANS])
+        self.assertEqual(len(used), 2)
+        self.assertIn(3, used)
+        self.assertIn(20, used)
+        self.assertNotIn(4, used)
+        self.assertNotIn(4*16, used)
+        self.assertListEqual(list(used), [3, 20])
+
+        self.assertIn(20, pool.get_blocks_of_tag(TTRANS, channel_id=1))
+        self.assertNotIn(20, pool.get_blocks_of_tag(TTRANS, channel_id=0))
+
+        # the view follows later changes
+        pool.change_tag(3, src=TDATA, dst=TFREE)
+        self.assertNotIn(3, used)
+        self.assertEqual(len(used), 1)
+
     def test_pick_and_move(self):
         pool = MultiChannelBlockPool(
                 n_channels=8,
@@ -75,7 +101,7 @@ class TestMultiChannelBlockPool(unittest.TestCase):
         self.assertEqual(pool.count_blocks(tag=TDATA), 1)
 
         datablocks = pool.get_blocks_of_tag(TDATA)
-        self.assertListEqual(datablocks, [blocknum])
+        self.assertListEqual(list(datablocks), [blocknum])
 
     def test_pick(self):
         pool = MultiChannelBlockPool(
@@ -1,19 +1,24 @@
 import unittest
+import os
 import random
+import shutil
 import simpy
+import tempfile
 
 from wiscsim import ftlsim_commons
+from wiscsim import checkpoint, hostevent
 
 from utilities import utils
 import wiscsim
 from wiscsim.ftlsim_commons import Extent
 from wiscsim.dftldes import LpnTable, LpnTableMvpn, UNINITIATED, \
-        split_ext_by_segment
+        split_ext_by_segment, USED, USED_AND_HOLD, USED_AND_LOCKED
 from config import WLRUNNER, LBAGENERATOR, LBAMULTIPROC
 from commons import *
 from utilities.utils import get_expname
 import collections
 from workflow import run_workflow
+from workrunner.lbaworkloadgenerator import BarrierGen
 
 class FtlTest(wiscsim.dftldes.Ftl):
     def get_mappings(self):
@@ -859,6 +864,41 @@ class TestWrite(unittest.TestCase):
         self.assertEqual(rec.get_count_me("Mapping_Cache", "hit"),
                 objs['conf'].n_mapping_entries_per_page * 2 - 2)
 
+    def test_write_larger2_batched(self):
+        conf = create_config()
+        conf['stripe_size'] = 1
+        conf['batch_metadata_update'] = True
+        objs = create_obj_set(conf)
+        env = objs['env']
+
+        dftl = wiscsim.dftldes.Ftl(objs['conf'], objs['rec'],
+                objs['flash_controller'], objs['env'])
+
+        env.process(self.proc_test_write_larger2(objs, dftl,
+            Extent(0, 4)))
+        env.run()
+
+    def test_write_2vpn_batched(self):
+        conf = create_config()
+        conf['stripe_size'] = 1
+        conf['batch_metadata_update'] = True
+        # make sure no cache miss in this test
+        conf.n_cache_entries = conf.n_mapping_entries_per_page * 100
+
+        objs = create_obj_set(conf)
+        env = objs['env']
+
+        dftl = wiscsim.dftldes.Ftl(objs['conf'], objs['rec'],
+                objs['flash_controller'], objs['env'])
+
+        ext = Extent(0, conf.n_mapping_entries_per_page * 2)
+        env.process(self.proc_test_write_2vpn(objs, dftl, ext))
+        env.run()
+
+        new_mappings = dftl._mappings._lpn_table.get_m_vpn_mappings(1)
+        for lpn, ppn in new_mappings.items():
+            self.assertEqual(dftl.oob.ppn_to_lpn_mvpn[ppn], lpn)
+
     def test_write_outofspace(self):
         conf = create_config()
         conf['stripe_size'] = 1
@@ -1100,6 +1140,93 @@ class TestLpnTable(unittest.TestCase):
         self.assertEqual(table.n_used_rows(), 2)
         self.assertEqual(table.n_locked_used_rows(), 1)
 
+    def test_state_counters(self):
+        table = LpnTable(8)
+
+        locked_rows = table.lock_free_rows(3)
+        table.add_lpns(locked_rows, {1:11, 2:22, 3:33}, False)
+        table.lock_lpn(1)
+        table.hold_used_row(locked_rows[1])
+        rowid = table.delete_lpn_and_lock(3)
+        table.unlock_free_row(rowid)
+
+        self.assertEqual(table.stats(), table._count_states())
+        self.assertEqual(table.n_free_rows(), 6)
+
+        # all free rows can be locked, including the returned one
+        locked_rows = table.lock_free_rows(8)
+        self.assertEqual(len(locked_rows), 6)
+        self.assertIn(rowid, locked_rows)
+        self.assertEqual(table.lock_free_row(), None)
+        self.assertEqual(table.stats(), table._count_states())
+
+
+class TestLpnTableMvpn(unittest.TestCase):
+    def lru_victim_row(self, table, avoid_m_vpns):
+        for lpn, row in table.least_to_most_lpn_items():
+            if row.state == USED and \
+                    not table.conf.lpn_to_m_vpn(lpn) in avoid_m_vpns:
+                return row
+        return None
+
+    def test_victim_row_matches_lru_walk(self):
+        conf = create_config()
+        conf.n_cache_entries = 32
+        conf['translation_page_entry_bytes'] = conf.page_size / 4
+        table = LpnTableMvpn(conf)
+        rand = random.Random(1)
+
+        for i in range(2000):
+            op = rand.randint(0, 5)
+            lpn = rand.randint(0, 63)
+            row = table._lpn_to_row.peek(lpn) if table.has_lpn(lpn) else None
+
+            if op == 0 and row is None:
+                rowid = table.lock_free_row()
+                if rowid is not None:
+                    table.add_lpn(rowid, lpn, lpn * 10, False,
+                            as_least_recent = rand.randint(0, 1) == 1)
+            elif op == 1 and row is not None:
+                table.lpn_to_ppn(lpn)
+            elif op == 2 and row is not None and row.state == USED:
+                table.overwrite_lpn(lpn, lpn * 100, True)
+            elif op == 3 and row is not None:
+                if row.state == USED:
+                    table.hold_used_row(row.rowid)
+                elif row.state == USED_AND_HOLD:
+                    table.unhold_used_row(row.rowid)
+            elif op == 4 and row is not None:
+                if row.state == USED:
+                    table.lock_lpn(lpn)
+                elif row.state == USED_AND_LOCKED:
+                    table.unlock_lpn(lpn)
+            elif op == 5 and row is not None and row.state == USED:
+                rowid = table.delete_lpn_and_lock(lpn)
+                table.unlock_free_row(rowid)
+
+            avoid_m_vpns = rand.sample(range(16), rand.randint(0, 3))
+            self.assertIs(table.victim_row(avoid_m_vpns),
+                    self.lru_victim_row(table, avoid_m_vpns))
+
+    def test_m_vpn_index(self):
+        conf = create_config()
+        conf.n_cache_entries = 32
+        conf['translation_page_entry_bytes'] = conf.page_size / 4
+        table = LpnTableMvpn(conf)
+
+        locked_rows = table.lock_free_rows(4)
+        table.add_lpns(locked_rows, {1:11, 2:22, 5:55, 9:99}, False)
+        table.unlock_free_row(table.delete_lpn_and_lock(2))
+
+        self.assertDictEqual(table.get_m_vpn_mappings(0), {1:11})
+        self.assertDictEqual(table.get_m_vpn_mappings(1), {5:55})
+        self.assertDictEqual(table.get_m_vpn_mappings(3), {})
+        self.assertEqual(table.needed_space_for_m_vpn(0), 3)
+        self.assertEqual(table.needed_space_for_m_vpn(3), 4)
+        self.assertSetEqual(table.get_un_cached_lpn_of_m_vpn(0),
+                set([0, 2, 3]))
+        self.assertListEqual(table.row_ids_of_m_vpn(2), [locked_rows[3]])
+
 
 class TestLockPool(unittest.TestCase):
     def access_vpn(self, env, respool, vpn):
@@ -1576,6 +1703,95 @@ class TestVictimBlocks(unittest.TestCase):
 
         self.assertListEqual(victims, [block1, block0, block2])
 
+    def test_never_programmed_block(self):
+        """
+        used blocks that have not been programmed since their erasure are
+        not victims
+        """
+        conf = create_config()
+        conf['flash_config']['n_channels_per_dev'] = 1
+        conf['stripe_size'] = 'infinity'
+        block_pool = create_blockpool(conf)
+        oob = create_oob(conf)
+
+        n = conf.n_pages_per_block
+        ppns = block_pool.next_n_data_pages_to_program_striped(n)
+        block, _ = conf.page_to_block_off(ppns[0])
+        for ppn in ppns:
+            oob.states.validate_page(ppn)
+        oob.invalidate_ppns(ppns)
+
+        unprogrammed_block = block_pool.pop_a_free_block_to_data()
+        self.assertIn(unprogrammed_block, block_pool.data_usedblocks)
+
+        # use one more
+        ppns = block_pool.next_n_data_pages_to_program_striped(1)
+
+        vbs = wiscsim.dftldes.VictimBlocks(conf, block_pool, oob)
+        self.assertListEqual(list(vbs.iterator()), [block])
+
+    def test_cur_block_opened_during_pass(self):
+        """
+        a current block opened between two batches of one pass is not a
+        victim
+        """
+        conf = create_config()
+        conf['flash_config']['n_channels_per_dev'] = 1
+        conf['stripe_size'] = 'infinity'
+        block_pool = create_blockpool(conf)
+        oob = create_oob(conf)
+
+        # full blocks with 1 and 2 valid pages
+        n = conf.n_pages_per_block
+        blocks = []
+        for n_valid in (1, 2):
+            ppns = block_pool.next_n_data_pages_to_program_striped(n)
+            blocks.append(conf.page_to_block_off(ppns[0])[0])
+            for ppn in ppns:
+                oob.states.validate_page(ppn)
+            oob.invalidate_ppns(ppns[n_valid:])
+
+        vbs = wiscsim.dftldes.VictimBlocks(conf, block_pool, oob)
+        victim_iter = vbs.iterator()
+        self.assertEqual(next(victim_iter), blocks[0])
+
+        # a new current block with 2 valid pages, like the old one
+        ppns = block_pool.next_n_data_pages_to_program_striped(2)
+        cur_block = conf.page_to_block_off(ppns[0])[0]
+        for ppn in ppns:
+            oob.states.validate_page(ppn)
+        self.assertIn(cur_block, block_pool.current_blocks())
+
+        self.assertListEqual(list(victim_iter), [blocks[1]])
+
+    def test_max_victim_valid_ratio(self):
+        conf = create_config()
+        conf['flash_config']['n_channels_per_dev'] = 1
+        conf['stripe_size'] = 'infinity'
+        conf['max_victim_valid_ratio'] = 0.5
+        block_pool = create_blockpool(conf)
+        oob = create_oob(conf)
+
+        n = conf.n_pages_per_block
+        blocks = []
+        for n_invalid in (n - 1, 1, n / 2):
+            ppns = block_pool.next_n_data_pages_to_program_striped(n)
+            block, _ = conf.page_to_block_off(ppns[0])
+            blocks.append(block)
+            for ppn in ppns:
+                oob.states.validate_page(ppn)
+            oob.invalidate_ppns(ppns[:n_invalid])
+
+        # use one more
+        ppns = block_pool.next_n_data_pages_to_program_striped(1)
+
+        vbs = wiscsim.dftldes.VictimBlocks(conf, block_pool, oob)
+        victims = list(vbs.iterator_verbose())
+
+        self.assertListEqual(victims, [
+            (1.0/n, vbs.TYPE_DATA, blocks[0]),
+            (0.5, vbs.TYPE_DATA, blocks[2])])
+
     def test_valid_ratio_stats(self):
         vbs = create_victimblocks()
         conf = vbs._conf
@@ -2561,6 +2777,128 @@ class TestFTLSegmentedWrite(unittest.TestCase):
         self.assertEqual(n_used2 - n_used, 5)
 
 
+class TestCheckpoint(unittest.TestCase):
+    def create_config(self):
+        conf = create_config()
+        conf['SSDFramework']['ncq_depth'] = 4
+        conf['simulator_class'] = 'SimulatorDESNew'
+        conf.mapping_cache_bytes = 64 * conf.n_mapping_entries_per_page \
+                * conf['cache_entry_bytes']
+        return conf
+
+    def events(self, conf, prefix, checkpoint_path=None, fork=False):
+        rand = random.Random(1)
+        barriergen = BarrierGen(conf.ssd_ncq_depth())
+
+        def random_event(op):
+            return hostevent.Event(512, 0, op,
+                    rand.randint(0, 16000) * 4096, rand.randint(1, 8) * 4096)
+
+        yield hostevent.ControlEvent(OP_DISABLE_RECORDER)
+        for i in range(200):
+            event = random_event(OP_WRITE)
+            if prefix is True:
+                yield event
+        if checkpoint_path is not None:
+            for event in barriergen.checkpoint_events(checkpoint_path):
+                yield event
+        if fork is True:
+            for event in barriergen.fork_events():
+                yield event
+
+        yield hostevent.ControlEvent(OP_ENABLE_RECORDER)
+        for event in barriergen.barrier_events():
+            yield event
+        yield hostevent.ControlEvent(OP_REC_TIMESTAMP, arg1='start')
+        for i in range(200):
+            yield random_event(rand.choice([OP_WRITE, OP_READ]))
+        for event in barriergen.barrier_events():
+            yield event
+        yield hostevent.ControlEvent(OP_REC_TIMESTAMP, arg1='end')
+
+    def run_simulator(self, conf, events):
+        random.seed(1)
+        sim = wiscsim.simulator.SimulatorDESNew(conf, events)
+        sim.run()
+        return sim.recorder.get_result_summary()
+
+    def test_restore(self):
+        path = os.path.join(tempfile.mkdtemp(), 'prefix.checkpoint')
+        try:
+            conf = self.create_config()
+            result = self.run_simulator(conf, self.events(conf, True, path))
+            self.assertTrue(os.path.exists(path))
+
+            conf = self.create_config()
+            conf['checkpoint_restore_path'] = path
+            restored = self.run_simulator(conf, self.events(conf, False))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+        for key in ('start', 'end', 'general_accumulator'):
+            self.assertEqual(result[key], restored[key])
+        self.assertTrue(result['general_accumulator']['traffic']['write'] > 0)
+
+    def test_layout_mismatch(self):
+        path = os.path.join(tempfile.mkdtemp(), 'prefix.checkpoint')
+        try:
+            conf = self.create_config()
+            self.run_simulator(conf, self.events(conf, True, path))
+
+            conf = self.create_config()
+            conf.mapping_cache_bytes = conf.mapping_cache_bytes * 2
+            conf['checkpoint_restore_path'] = path
+            with self.assertRaises(checkpoint.CheckpointError):
+                wiscsim.simulator.SimulatorDESNew(conf, [])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_fork_variants(self):
+        result_dir = tempfile.mkdtemp()
+        try:
+            conf = self.create_config()
+            conf['result_dir'] = result_dir
+            conf['fork_variants'] = [{}, {'n_gc_procs': 2}]
+            result = self.run_simulator(conf, self.events(conf, True,
+                fork=True))
+
+            table_path = os.path.join(result_dir, 'fork-variants.txt')
+            self.assertTrue(os.path.exists(table_path))
+            with open(table_path) as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+            variant = utils.load_json(os.path.join(result_dir, 'variant-0',
+                'recorder.json'))
+            variant_conf = utils.load_json(os.path.join(result_dir,
+                'variant-1', 'config.json'))
+        finally:
+            shutil.rmtree(result_dir)
+
+        for key in ('start', 'end', 'general_accumulator'):
+            self.assertEqual(result[key], variant[key])
+        self.assertEqual(variant_conf['n_gc_procs'], 2)
+
+    def test_fork_variant_stripe_size(self):
+        result_dir = tempfile.mkdtemp()
+        try:
+            conf = self.create_config()
+            conf['result_dir'] = result_dir
+            conf['stripe_size'] = 'infinity'
+            conf['fork_variants'] = [{'stripe_size': 1}]
+            result = self.run_simulator(conf, self.events(conf, True,
+                fork=True))
+
+            variant = utils.load_json(os.path.join(result_dir, 'variant-0',
+                'recorder.json'))
+        finally:
+            shutil.rmtree(result_dir)
+
+        # writes of the variant are spread over the channels
+        self.assertEqual(result['general_accumulator']['traffic'],
+                variant['general_accumulator']['traffic'])
+        self.assertNotEqual(result['end'], variant['end'])
+
+
 def main():
     unittest.main()
 
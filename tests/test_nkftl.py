@@ -1,6 +1,9 @@
 import unittest
+import os
 import random
+import shutil
 import simpy
+import tempfile
 from collections import namedtuple
 
 from wiscsim.nkftl2 import *
@@ -13,6 +16,8 @@ from utilities.utils import choose_exp_metadata, runtime_update
 from workflow import run_workflow
 from config import LBAGENERATOR
 from wiscsim.ftlsim_commons import *
+from wiscsim import hostevent
+from workrunner.lbaworkloadgenerator import BarrierGen
 
 TDATA = 'TDATA'
 TLOG = 'TLOG'
@@ -3571,6 +3576,77 @@ class TestBlockIter(unittest.TestCase):
 
 
 
+class TestDataGroupParallel(unittest.TestCase):
+    def events(self, conf):
+        rand = random.Random(1)
+        barriergen = BarrierGen(conf.ssd_ncq_depth())
+
+        yield hostevent.ControlEvent(OP_ENABLE_RECORDER)
+        for i in range(400):
+            op = rand.choice([OP_WRITE, OP_WRITE, OP_READ])
+            yield hostevent.Event(512, 0, op, rand.randint(0, 4000) * 4096,
+                    rand.randint(1, 8) * 4096)
+        for event in barriergen.barrier_events():
+            yield event
+
+    def run_simulator(self, n_shards):
+        conf = create_config()
+        conf['SSDFramework']['ncq_depth'] = 4
+        conf['simulator_class'] = 'SimulatorDESNew'
+        conf['result_dir'] = tempfile.mkdtemp()
+        conf['nkftl_parallel_data_groups'] = n_shards
+        try:
+            sim = wiscsim.simulator.create_simulator(conf['simulator_class'],
+                    conf, self.events(conf))
+            sim.run()
+            self.assertEqual(os.path.exists(os.path.join(conf['result_dir'],
+                'shard-1', 'recorder.json')), n_shards is not None)
+            return utils.load_json(os.path.join(conf['result_dir'],
+                'recorder.json'))
+        finally:
+            shutil.rmtree(conf['result_dir'])
+
+    def test_traffic(self):
+        result = self.run_simulator(None)
+        sharded = self.run_simulator(2)
+
+        self.assertEqual(sharded['data_group_shards'], 2)
+        self.assertEqual(result['general_accumulator']['traffic'],
+                sharded['general_accumulator']['traffic'])
+        self.assertTrue(sharded['general_accumulator']['traffic']['write'] > 0)
+
+    def test_merge_results(self):
+        def shard_result(write, start, dur, compacted, gc_duration):
+            return {'general_accumulator': {'traffic': {'write': write}},
+                    'interest_workload_start': start,
+                    'interest_workload_end': start + dur,
+                    'workload_duration_nsec': dur,
+                    'compacted_events': compacted,
+                    'gc_duration': gc_duration,
+                    'blkparse_duration': 7}
+        shards = [shard_result(2*MB, 0, SEC, 3, 5),
+                  shard_result(4*MB, 10, 2*SEC, 4, 6)]
+        merged = wiscsim.simulator.merge_shard_results(shards)
+
+        self.assertEqual(merged['general_accumulator']['traffic']['write'],
+                6*MB)
+        self.assertEqual(merged['compacted_events'], 7)
+        self.assertEqual(merged['gc_duration'], 6)
+        self.assertEqual(merged['blkparse_duration'], 7)
+        # from the start of shard 0 to the end of shard 1
+        self.assertEqual(merged['workload_duration_nsec'], 2*SEC + 10)
+        self.assertAlmostEqual(merged['write_bandwidth'], 3.0)
+
+    def test_no_stream_blktrace(self):
+        conf = create_config()
+        conf['simulator_class'] = 'SimulatorDESNew'
+        conf['nkftl_parallel_data_groups'] = 2
+        conf['stream_blktrace'] = True
+        with self.assertRaises(RuntimeError):
+            wiscsim.simulator.create_simulator(conf['simulator_class'],
+                    conf, self.events(conf))
+
+
 # Add test without lpn overlap
 
 def main():
@@ -1,3 +1,4 @@
+import random
 import unittest
 from wiscsim.tagblockpool import *
 
@@ -24,6 +25,20 @@ class TestTagBlockPool(unittest.TestCase):
         self.assertEqual(pool.count_blocks(tag=TDATA), 0)
         self.assertEqual(pool.count_blocks(tag=TFREE), 100)
 
+    def test_changing_tag_keeps_order(self):
+        pool = TagBlockPool(10, [TDATA])
+
+        for blocknum in [5, 2, 7]:
+            pool.change_tag(blocknum, src=TFREE, dst=TDATA)
+        pool.change_tag(2, src=TDATA, dst=TFREE)
+
+        self.assertListEqual(list(pool.get_blocks_of_tag(TDATA)), [5, 7])
+        self.assertListEqual(list(pool.get_blocks_of_tag(TFREE)),
+                [0, 1, 3, 4, 6, 8, 9, 2])
+
+        with self.assertRaises(ValueError):
+            pool.change_tag(2, src=TDATA, dst=TFREE)
+
     def test_changing_to_multiple_tags(self):
         pool = TagBlockPool(100, [TDATA, TTRANS])
         pool.change_tag(blocknum=0, src=TFREE, dst=TDATA)
@@ -132,6 +147,35 @@ class TestTagBlockPool(unittest.TestCase):
 
         self.assertEqual(least_used, 9)
 
+    def test_pick_matches_sorting_all_blocks(self):
+        pool = TagBlockPool(50, [TDATA, TTRANS])
+        rand = random.Random(1)
+
+        def brute_force(tag, choice):
+            blocks = pool.get_blocks_of_tag(tag)
+            if len(blocks) == 0:
+                return None
+            if choice == LEAST_ERASED:
+                key = lambda b: (pool.get_erasure_count(b), -b)
+            else:
+                key = lambda b: (-pool.get_erasure_count(b), b)
+            return min(blocks, key=key)
+
+        for i in range(2000):
+            src, dst = rand.choice([(TFREE, TDATA), (TFREE, TTRANS),
+                (TDATA, TFREE), (TTRANS, TFREE), (TTRANS, TDATA)])
+            choice = rand.choice([LEAST_ERASED, MOST_ERASED])
+            expected = brute_force(src, choice)
+            self.assertEqual(pool.pick(src, choice=choice), expected)
+            if expected is not None:
+                pool.change_tag(expected, src, dst)
+
+        most = pool.get_least_or_most_erased_blocks(TFREE,
+                choice=MOST_ERASED, nblocks=3)
+        expected = sorted(pool.get_blocks_of_tag(TFREE),
+                key=lambda b: (-pool.get_erasure_count(b), b))[:3]
+        self.assertListEqual(most, expected)
+
     def test_getting_count_distribution(self):
         pool = TagBlockPool(5, [TDATA, TTRANS])
 
@@ -1,3 +1,4 @@
+import collections
 import copy
 import itertools
 import json
@@ -56,6 +57,42 @@ def table_to_file(table, filepath, adddic=None, width=32):
             return
         f.write( table_to_str(table, adddic=adddic, width=width) )
 
+def flatten_result_dict(result_dict):
+    """
+    Keep the scalars of recorder.json, including the counters in
+    general_accumulator, as {'name.key': value}
+    """
+    flat = {}
+    for name, value in result_dict.items():
+        if isinstance(value, dict):
+            for key, v in value.items():
+                if isinstance(v, dict):
+                    for k, vv in v.items():
+                        if not isinstance(vv, (dict, list)):
+                            flat['.'.join([name, key, str(k)])] = vv
+                elif not isinstance(v, list):
+                    flat['.'.join([name, str(key)])] = v
+        elif not isinstance(value, list):
+            flat[name] = value
+    return flat
+
+def rows_to_table(rows):
+    """
+    Return a table (see table_to_file()) with the columns of all rows.
+    Missing values are 'NA'.
+    """
+    colnames = []
+    for row in rows:
+        for name in row.keys():
+            if not name in colnames:
+                colnames.append(name)
+
+    table = []
+    for row in rows:
+        table.append(collections.OrderedDict(
+            (name, row.get(name, 'NA')) for name in colnames))
+    return table
+
 def load_json(fpath):
     decoded = json.load(open(fpath, 'r'))
     return decoded
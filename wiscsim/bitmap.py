@@ -1,3 +1,5 @@
+import array
+
 import bitarray
 import config
 
@@ -18,6 +20,19 @@ class FlashBitmap2(object):
         self.bitmap = bitarray.bitarray(2 * conf.total_num_pages())
         self.bitmap.setall(0)
 
+        # Number of valid and erased pages of each block. They are
+        # updated when page states change, so the block ratio queries
+        # do not have to scan the pages of a block.
+        self._n_pages_per_block = conf.n_pages_per_block
+        self._n_blocks = (conf.total_num_pages() + self._n_pages_per_block - 1) \
+                / self._n_pages_per_block
+        self._reset_block_counters()
+
+    def _reset_block_counters(self):
+        self._valid_cnt = array.array('l', [0]) * self._n_blocks
+        self._erased_cnt = array.array('l', [self._n_pages_per_block]) \
+                * self._n_blocks
+
     def pagenum_to_slice_range(self, pagenum):
         "2 is the number of bits representing the state of a page"
         return 2 * pagenum, 2 * (pagenum + 1)
@@ -34,10 +49,23 @@ class FlashBitmap2(object):
 
     def validate_page(self, pagenum):
         s, e = self.pagenum_to_slice_range(pagenum)
+        old_state = self.bitmap[s:e]
+        if old_state != self.VALID:
+            blocknum = pagenum / self._n_pages_per_block
+            self._valid_cnt[blocknum] += 1
+            if old_state == self.ERASED:
+                self._erased_cnt[blocknum] -= 1
         self.bitmap[s:e] = self.VALID
 
     def invalidate_page(self, pagenum):
         s, e = self.pagenum_to_slice_range(pagenum)
+        old_state = self.bitmap[s:e]
+        if old_state != self.INVALID:
+            blocknum = pagenum / self._n_pages_per_block
+            if old_state == self.VALID:
+                self._valid_cnt[blocknum] -= 1
+            else:
+                self._erased_cnt[blocknum] -= 1
         self.bitmap[s:e] = self.INVALID
 
     def validate_block(self, blocknum):
@@ -53,35 +81,31 @@ class FlashBitmap2(object):
     def erase_block(self, blocknum):
         s, e = self.blocknum_to_slice_range(blocknum)
         self.bitmap[s:e] = 0
+        self._valid_cnt[blocknum] = 0
+        self._erased_cnt[blocknum] = self._n_pages_per_block
 
-    def block_invalid_ratio(self, blocknum):
-        start, end = self.conf.block_to_page_range(blocknum)
-        cnt = 0
-        for pg in range(start, end):
-            if not self.is_page_valid(pg):
-                cnt += 1
+    def block_valid_count(self, blocknum):
+        return self._valid_cnt[blocknum]
 
-        return cnt / float(self.conf.n_pages_per_block)
+    def block_erased_count(self, blocknum):
+        return self._erased_cnt[blocknum]
 
-    def block_valid_ratio(self, blocknum):
-        start, end = self.conf.block_to_page_range(blocknum)
-        cnt = 0
-        for pg in range(start, end):
-            if self.is_page_valid(pg):
-                cnt += 1
+    def block_invalid_count(self, blocknum):
+        return self._n_pages_per_block - self._valid_cnt[blocknum] \
+                - self._erased_cnt[blocknum]
 
-        ret = cnt / float(self.conf.n_pages_per_block)
-        return ret
+    def block_invalid_ratio(self, blocknum):
+        """
+        Note that erased pages are counted as invalid here (not valid).
+        """
+        cnt = self._n_pages_per_block - self._valid_cnt[blocknum]
+        return cnt / float(self._n_pages_per_block)
 
-    def block_erased_ratio(self, blocknum):
-        start, end = self.conf.block_to_page_range(blocknum)
-        cnt = 0
-        for pg in range(start, end):
-            if self.is_page_erased(pg):
-                cnt += 1
+    def block_valid_ratio(self, blocknum):
+        return self._valid_cnt[blocknum] / float(self._n_pages_per_block)
 
-        ret = cnt / float(self.conf.n_pages_per_block)
-        return ret
+    def block_erased_ratio(self, blocknum):
+        return self._erased_cnt[blocknum] / float(self._n_pages_per_block)
 
     def is_page_valid(self, pagenum):
         s, e = self.pagenum_to_slice_range(pagenum)
@@ -128,5 +152,60 @@ class FlashBitmap2(object):
         """ this method should be called in FTL """
         # set the state of all pages to ERASED
         self.bitmap.setall(0)
+        self._reset_block_counters()
+
+
+class BucketedFlashBitmap(FlashBitmap2):
+    """
+    FlashBitmap2 that also keeps blocks in buckets by their number of
+    valid pages, so the greedy cleaner can find the blocks with the fewest
+    valid pages without scanning all blocks.
+
+    Only blocks that have been programmed or invalidated since their last
+    erasure are in a bucket.
+    """
+    NOT_IN_BUCKET = -1
 
+    def __init__(self, conf):
+        super(BucketedFlashBitmap, self).__init__(conf)
+        self._reset_buckets()
+
+    def _reset_buckets(self):
+        # _buckets[i] is the set of blocks with i valid pages
+        self._buckets = [set() for _ in range(self._n_pages_per_block + 1)]
+        self._bucket_of_block = array.array('l', [self.NOT_IN_BUCKET]) \
+                * self._n_blocks
+
+    def _update_bucket(self, blocknum):
+        old = self._bucket_of_block[blocknum]
+        new = self._valid_cnt[blocknum]
+        if old != new:
+            if old != self.NOT_IN_BUCKET:
+                self._buckets[old].discard(blocknum)
+            self._buckets[new].add(blocknum)
+            self._bucket_of_block[blocknum] = new
+
+    def validate_page(self, pagenum):
+        super(BucketedFlashBitmap, self).validate_page(pagenum)
+        self._update_bucket(pagenum / self._n_pages_per_block)
 
+    def invalidate_page(self, pagenum):
+        super(BucketedFlashBitmap, self).invalidate_page(pagenum)
+        self._update_bucket(pagenum / self._n_pages_per_block)
+
+    def erase_block(self, blocknum):
+        super(BucketedFlashBitmap, self).erase_block(blocknum)
+        old = self._bucket_of_block[blocknum]
+        if old != self.NOT_IN_BUCKET:
+            self._buckets[old].discard(blocknum)
+            self._bucket_of_block[blocknum] = self.NOT_IN_BUCKET
+
+    def blocks_with_valid_count(self, n_valid):
+        """
+        Return the blocks that have n_valid valid pages. Do not modify it.
+        """
+        return self._buckets[n_valid]
+
+    def initialize(self):
+        super(BucketedFlashBitmap, self).initialize()
+        self._reset_buckets()
@@ -41,10 +41,8 @@ class BlockPool(object):
 
     @property
     def used_blocks(self):
-        blocks1 = self.pool.get_blocks_of_tag(tag=TDATA)
-        blocks2 = self.pool.get_blocks_of_tag(tag=TTRANS)
-
-        return blocks1 + blocks2
+        blocks = self.pool.get_blocks_of_tags(tags=[TDATA, TTRANS])
+        return blocks
 
     def get_wear_status(self):
         return self.pool.get_wear_status()
@@ -0,0 +1,176 @@
+"""
+Checkpoint and restore the simulated SSD.
+
+A checkpoint is taken when the SSD holds all NCQ slots (see OP_CHECKPOINT
+in Ssd._process), so no request or GC is in flight. The FTL object graph
+(block pool, OOB, mappings, mapping cache, GTD, ...) is pickled, except the
+objects that belong to one simulation run: the simpy environment and
+resources, the flash controller, the recorder and the config. Those are
+saved as their attribute paths in the FTL and restored as the objects at the
+same paths of a freshly built FTL. A restored run therefore uses its own
+config, which may differ from the saved one in knobs that do not change the
+layout of the device, such as GC thresholds.
+"""
+import contextlib
+import copy_reg
+import cPickle
+import gc
+import os
+import random
+import types
+
+import simpy
+
+import config
+import controller
+import recorder
+from ftlsim_commons import LockPool
+
+CHECKPOINT_VERSION = 1
+
+# config keys that must be the same in the saving and the restoring runs
+LAYOUT_KEYS = ('ftl_type', 'flash_config', 'mapping_cache_bytes')
+
+# objects of these types are not saved, the restoring run provides them
+RUNTIME_TYPES = (simpy.Environment, simpy.resources.base.BaseResource,
+        simpy.events.Event, config.Config, controller.Controller,
+        recorder.Recorder, LockPool)
+
+
+class CheckpointError(RuntimeError):
+    pass
+
+
+def _reduce_method(method):
+    # FTL objects keep bound methods as callbacks, such as the state
+    # observers of mapping cache rows
+    return getattr, (method.im_self, method.im_func.__name__)
+
+copy_reg.pickle(types.MethodType, _reduce_method)
+
+
+@contextlib.contextmanager
+def _gc_disabled():
+    """
+    The FTL has millions of objects, the cyclic garbage collector would
+    scan all of them many times while they are pickled or unpickled.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _is_simulator_object(obj):
+    # nodes of linked lists hold no runtime objects and there are many
+    module = type(obj).__module__
+    return hasattr(obj, '__dict__') and module.split('.')[0] == 'wiscsim' \
+            and module != 'wiscsim.lrulist'
+
+
+def walk_runtime_objects(root):
+    """
+    Yield (path, obj) of the runtime objects reachable from root through
+    attributes. path is like 'ftl._mappings.env'.
+    """
+    visited = set([id(root)])
+    queue = [('ftl', root)]
+    while len(queue) > 0:
+        path, obj = queue.pop(0)
+        for name in sorted(vars(obj).keys()):
+            value = vars(obj)[name]
+            value_path = path + '.' + name
+            if isinstance(value, RUNTIME_TYPES):
+                yield value_path, value
+            elif _is_simulator_object(value) and not id(value) in visited:
+                visited.add(id(value))
+                queue.append((value_path, value))
+
+
+def save_checkpoint(path, ssd, meta):
+    """
+    ssd is ssdframework.Ssd. meta is a dict describing the run, it is saved
+    in the checkpoint and checked when restoring.
+    """
+    with _gc_disabled():
+        _save_checkpoint(path, ssd, meta)
+
+
+def _save_checkpoint(path, ssd, meta):
+    paths = {}
+    for obj_path, obj in walk_runtime_objects(ssd.ftl):
+        paths.setdefault(id(obj), obj_path)
+
+    def persistent_id(obj):
+        if isinstance(obj, RUNTIME_TYPES):
+            if not id(obj) in paths:
+                raise CheckpointError("{} is not an attribute of a simulator "
+                    "object, cannot checkpoint it".format(type(obj).__name__))
+            return paths[id(obj)]
+        return None
+
+    header = {
+            'version': CHECKPOINT_VERSION,
+            'meta': meta,
+            'now': ssd.env.now,
+            'random_state': random.getstate(),
+            'recorder': ssd.recorder.get_state(),
+            'gc_sleep_timer': ssd.gc_sleep_timer,
+            }
+
+    # parallel runs may save the same checkpoint
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        cPickle.dump(header, f, cPickle.HIGHEST_PROTOCOL)
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        # unlike persistent_id, it is not called for ints, lists, dicts...
+        pickler.inst_persistent_id = persistent_id
+        pickler.dump(ssd.ftl)
+    os.rename(tmp_path, path)
+
+
+def read_checkpoint_header(path):
+    """
+    Return the header of the checkpoint at path, without loading the FTL.
+    The restoring run starts its simpy environment at header['now'].
+    """
+    with open(path, 'rb') as f:
+        header = cPickle.load(f)
+    if header['version'] != CHECKPOINT_VERSION:
+        raise CheckpointError("checkpoint version {} is not supported".format(
+            header['version']))
+    return header
+
+
+def load_checkpoint(path, ssd):
+    """
+    Return (header, ftl) of the checkpoint at path. ssd is a freshly built
+    ssdframework.Ssd, its FTL provides the runtime objects of the restored
+    FTL.
+    """
+    objects = dict(walk_runtime_objects(ssd.ftl))
+
+    def persistent_load(pid):
+        try:
+            return objects[pid]
+        except KeyError:
+            raise CheckpointError("{} is not in the new FTL, the checkpoint "
+                "does not match this FTL".format(pid))
+
+    with open(path, 'rb') as f, _gc_disabled():
+        header = cPickle.load(f)
+        unpickler = cPickle.Unpickler(f)
+        unpickler.persistent_load = persistent_load
+        ftl = unpickler.load()
+
+    if header['version'] != CHECKPOINT_VERSION:
+        raise CheckpointError("checkpoint version {} is not supported".format(
+            header['version']))
+    return header, ftl
+
+
+def layout_of_conf(conf):
+    return dict((key, conf.get(key, None)) for key in LAYOUT_KEYS)
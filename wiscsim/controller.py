@@ -3,6 +3,14 @@ import wiscsim
 from collections import Counter
 from commons import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# numpy is slower than lists for translating fewer pages
+NUMPY_MIN_BATCH = 64
+
 class FlashAddress(object):
     def __init__(self):
         self.page_index = 5
@@ -64,6 +72,37 @@ class FlashAddress(object):
         self.location[self.channel_index] = value
 
 
+class LazyFlashAddress(object):
+    """
+    The address of a page, or of a block if is_block is True. Only the
+    channel is known at first, which is all the controller needs. The
+    full FlashAddress is translated when another level is accessed.
+    """
+    def __init__(self, controller, page_no, channel, is_block = False):
+        self.channel = channel
+        self._controller = controller
+        self._page_no = page_no
+        self._is_block = is_block
+        self._addr = None
+
+    def full_address(self):
+        if self._addr is None:
+            addr = self._controller.physical_to_machine_page(self._page_no)
+            if self._is_block:
+                addr.page = None
+            self._addr = addr
+        return self._addr
+
+    def __getattr__(self, name):
+        # only called for attributes we do not have, like 'block'
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.full_address(), name)
+
+    def __str__(self):
+        return str(self.full_address())
+
+
 class FlashRequest(object):
     # OP_READ, OP_WRITE, OP_ERASE = 'OP_READ', 'OP_WRITE', 'OP_ERASE'
     def __init__(self):
@@ -131,9 +170,14 @@ class Controller(object):
         Mapping pbn seen by FTL to hierarchical address used by flash
         controller
         """
+        pages = [block * self.n_pages_per_block
+                for block in range(block_start, block_start + block_count)]
+        channels = self._channels_of_pages(pages)
+
         ret_requests = []
-        for block in range(block_start, block_start + block_count):
-            machine_block_addr = self.physical_to_machine_block(block)
+        for page, channel in zip(pages, channels):
+            machine_block_addr = LazyFlashAddress(self, page,
+                    channel = channel, is_block = True)
             flash_req = create_flashrequest( machine_block_addr, op = op)
             ret_requests.append(flash_req)
 
@@ -155,26 +199,67 @@ class Controller(object):
         """
         op can be 'read', 'write', and 'erase'
         """
+        pages = range(page_start, page_start + page_count)
+        channels = self._channels_of_pages(pages)
+
         ret_requests = []
-        for page in range(page_start, page_start + page_count):
-            machine_page_addr = self.physical_to_machine_page(page)
+        for page, channel in zip(pages, channels):
+            machine_page_addr = LazyFlashAddress(self, page,
+                    channel = channel)
             flash_req = create_flashrequest(machine_page_addr, op = op)
             ret_requests.append(flash_req)
 
         return ret_requests
 
+    def _channels_of_pages(self, pages):
+        channels = self.physical_to_machine_pages(pages,
+                levels = ['channel'])['channel']
+        if numpy is not None and isinstance(channels, numpy.ndarray):
+            # the channels index python lists
+            channels = channels.tolist()
+        return channels
+
     def physical_to_machine_page(self, page_no):
         addr = FlashAddress()
 
         # page_hierarchy has [channel, package, ..., block]
         # location has       [channel, package, ..., block, page]
+        location = addr.location
         for i, count in enumerate(self.page_hierarchy):
-            addr.location[i] = page_no / count
-            page_no = page_no % count
-        addr.location[-1] = page_no
+            location[i], page_no = divmod(page_no, count)
+        location[-1] = page_no
 
         return addr
 
+    def physical_to_machine_pages(self, page_nos, levels = None):
+        """
+        Translate many pages at once. It returns a dict like
+        {'channel': [...], 'package': [...], ..., 'page': [...]}, the i-th
+        item of each is the address of page_nos[i]. Only the levels in
+        levels (e.g. ['channel']) are translated, all of them by default.
+        The items are numpy arrays if numpy is installed and there are at
+        least NUMPY_MIN_BATCH pages, otherwise lists.
+        """
+        names = FlashAddress().names
+        if levels is None:
+            levels = names
+        depth = max(names.index(level) for level in levels) + 1
+
+        columns = {}
+        if numpy is not None and len(page_nos) >= NUMPY_MIN_BATCH:
+            remains = numpy.asarray(page_nos, dtype = numpy.int64)
+            for name, count in zip(names, self.page_hierarchy)[:depth]:
+                columns[name], remains = numpy.divmod(remains, count)
+        else:
+            remains = list(page_nos)
+            for name, count in zip(names, self.page_hierarchy)[:depth]:
+                columns[name] = [page_no / count for page_no in remains]
+                remains = [page_no % count for page_no in remains]
+        if depth == len(names):
+            columns[names[-1]] = remains
+
+        return dict((level, columns[level]) for level in levels)
+
     def rw_ppn_extent(self, ppn_start, ppn_count, op):
         """
         op is 'read' or 'write'
@@ -273,10 +358,28 @@ class Controller3(Controller):
             self.channels[addr.channel].erase_block(tag = tag, addr = None))
 
     def rw_ppns(self, ppns, op, tag):
+        """
+        Pages of the same channel are done back to back by one process of
+        the channel, as they would be if we had one process for each page.
+        """
+        flash_op = create_flashrequest(addr = None, op = op).operation
+
+        channel_counts = Counter()
+        channel_order = []
+        for channel_id in self._channels_of_pages(ppns):
+            if channel_counts[channel_id] == 0:
+                channel_order.append(channel_id)
+            channel_counts[channel_id] += 1
+
+        if len(channel_order) > 0:
+            self.recorder.add_to_general_accumulater('flash_ops', flash_op,
+                    len(ppns))
+
         procs = []
-        for ppn in ppns:
+        for channel_id in channel_order:
             p = self.env.process(
-                    self.rw_ppn_extent(ppn, 1, op, tag))
+                    self.channels[channel_id].rw_pages(flash_op,
+                        channel_counts[channel_id], tag = tag))
             procs.append(p)
 
         yield simpy.events.AllOf(self.env, procs)
@@ -480,3 +583,35 @@ class Channel3(Channel2):
             self._write_channel_timeline(channel_id=self.channel_id,
                     start_time=s, end_time=e, tag=tag)
 
+    def rw_pages(self, operation, n_pages, tag):
+        """
+        Read or write n_pages pages back to back. It is the same as starting
+        n_pages read_page() or write_page() at the same time, since their
+        requests would be queued together, but the channel is only
+        requested once.
+        """
+        if operation == OP_READ:
+            op_time = self.read_time
+            op_name = 'read'
+        elif operation == OP_WRITE:
+            op_time = self.program_time
+            op_name = 'write'
+        else:
+            raise RuntimeError("operation {} is not supported".format(
+                operation))
+
+        with self.resource.request() as request:
+            yield request
+            s = self.env.now
+            yield self.env.timeout( op_time * n_pages )
+            e = self.env.now
+            self.recorder.add_to_timer(
+                self.counter_set_name(),
+                "channel_{id}-{op}-{tag}".format(id = self.channel_id,
+                    op = op_name, tag = self.recorder.tag_group(tag)),
+                e - s)
+            for i in range(n_pages):
+                self._write_channel_timeline(channel_id=self.channel_id,
+                        start_time=s + i * op_time,
+                        end_time=s + (i + 1) * op_time, tag=tag)
+
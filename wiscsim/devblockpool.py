@@ -42,18 +42,19 @@ class MultiChannelBlockPoolBase(object):
         return total
 
     def get_blocks_of_tag(self, tag, channel_id=None):
-        ret = []
+        return self.get_blocks_of_tags([tag], channel_id)
 
+    def get_blocks_of_tags(self, tags, channel_id=None):
+        """
+        Return a set-like view of the global block numbers of tags. It
+        does not copy the block numbers.
+        """
         if channel_id is None:
-            channels =  self._channel_pool
+            channel_ids = None
         else:
-            channels =  [self._channel_pool[channel_id]]
-
-        for pool in channels:
-            blocks = pool.get_blocks_of_tag(tag)
-            ret.extend(self._blocks_channel_to_global(pool.channel_id, blocks))
+            channel_ids = [channel_id]
 
-        return ret
+        return TaggedBlocksView(self, tags, channel_ids)
 
     def get_erasure_count_dist(self):
         aggregated_dist = Counter()
@@ -102,25 +103,27 @@ class MultiChannelBlockPoolBase(object):
             return False
 
     def get_least_or_most_erased_blocks(self, tag, choice, nblocks):
-        global_counter = self.get_erasure_count()
+        # each channel gives its own nblocks candidates, the global
+        # candidates are among them.
+        candidates = []
+        for pool in self._channel_pool:
+            blocks = pool.get_least_or_most_erased_blocks(tag, choice, nblocks)
+            for blocknum in blocks:
+                global_blocknum = self._channel_to_global(
+                    pool.channel_id, blocknum)
+                cnt = pool.get_erasure_count(blocknum)
+                candidates.append((cnt, global_blocknum))
+
+        # break ties the same way as reversed(most_common()) and
+        # most_common() do
         if choice == LEAST_ERASED:
-            blocks_by_cnt = reversed(global_counter.most_common())
+            candidates.sort(key=lambda x: (x[0], -x[1]))
         elif choice == MOST_ERASED:
-            blocks_by_cnt = global_counter.most_common()
+            candidates.sort(key=lambda x: (-x[0], x[1]))
         else:
             raise NotImplementedError
 
-        tag_blocks = self.get_blocks_of_tag(tag)
-
-        # iterate from least used to most used
-        blocks = []
-        for blocknum, count in blocks_by_cnt:
-            if blocknum in tag_blocks:
-                blocks.append(blocknum)
-                if len(blocks) == nblocks:
-                    break
-
-        return blocks
+        return [blocknum for _, blocknum in candidates[:nblocks]]
 
     def get_erasure_count(self):
         global_counter = Counter()
@@ -184,6 +187,51 @@ class MultiChannelBlockPoolBase(object):
         return [self._ppn_channel_to_global(channel_id, ppn) for ppn in ppns]
 
 
+class TaggedBlocksView(object):
+    """
+    Read-only view of the global block numbers of some tags. Membership
+    tests and len() are answered by the channel subpools, so callers can
+    do 'blocknum in view' without building a global block list.
+
+    Iteration order is tag by tag, and channel by channel within a tag.
+    """
+    def __init__(self, pool, tags, channel_ids=None):
+        self._pool = pool
+        self._tags = tags
+        if channel_ids is None:
+            self._channel_ids = range(pool.n_channels)
+        else:
+            self._channel_ids = channel_ids
+
+    def __contains__(self, blocknum):
+        if not 0 <= blocknum < self._pool.total_blocks:
+            return False
+
+        channel_id, block_off = self._pool._global_to_channel(blocknum)
+        if not channel_id in self._channel_ids:
+            return False
+
+        channel_pool = self._pool._channel_pool[channel_id]
+        for tag in self._tags:
+            if block_off in channel_pool.get_blocks_of_tag(tag):
+                return True
+        return False
+
+    def __iter__(self):
+        for tag in self._tags:
+            for channel_id in self._channel_ids:
+                channel_pool = self._pool._channel_pool[channel_id]
+                for block_off in channel_pool.get_blocks_of_tag(tag):
+                    yield self._pool._channel_to_global(channel_id, block_off)
+
+    def __len__(self):
+        return sum(self._pool.count_blocks(tag, self._channel_ids)
+                for tag in self._tags)
+
+    def __repr__(self):
+        return "TaggedBlocksView({})".format(list(self))
+
+
 class MultiChannelBlockPool(MultiChannelBlockPoolBase):
     """
     This is for DFTL
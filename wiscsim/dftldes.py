@@ -15,13 +15,13 @@ import bidict
 import config
 import flash
 import ftlbuilder
-from lrulist import LruDict, SegmentedLruCache, LruCache
+from lrulist import LruDict, SegmentedLruCache, LruCache, LinkedList, Node
 import recorder
 from utilities import utils
 from commons import *
 from ftlsim_commons import *
 from .blkpool import BlockPool, MOST_ERASED, LEAST_ERASED
-from .bitmap import FlashBitmap2
+from .bitmap import BucketedFlashBitmap
 
 
 
@@ -220,6 +220,12 @@ class Ftl(object):
         """
         This may be parallelized.
         """
+        if self.conf['batch_metadata_update'] is True:
+            yield self.env.process(
+                self._update_metadata_for_relocating_lpns_batched(
+                    lpns, new_ppns, tag))
+            return
+
         old_ppns = yield self.env.process(
                 self._mappings.lpns_to_ppns(lpns, tag))
 
@@ -228,6 +234,24 @@ class Ftl(object):
                 self._update_metadata_for_relocating_lpn(
                     lpn, old_ppn, new_ppn, tag))
 
+    def _update_metadata_for_relocating_lpns_batched(self, lpns, new_ppns,
+            tag=None):
+        """
+        lpns must belong to the same m_vpn. It makes the same changes as
+        _update_metadata_for_relocating_lpn() on each lpn, but the whole
+        group is translated and updated by one process of the mapping cache,
+        which holds the m_vpn until it is done.
+        """
+        # mappings in cache
+        old_ppns = yield self.env.process(
+                self._mappings.relocate_lpns(lpns, new_ppns, tag))
+
+        # oob state
+        # oob ppn->lpn/vpn
+        for lpn, old_ppn, new_ppn in zip(lpns, old_ppns, new_ppns):
+            self.oob.relocate_data_page(lpn=lpn, old_ppn=old_ppn,
+                    new_ppn=new_ppn, update_time=True)
+
     def _update_metadata_for_relocating_lpn(self, lpn, old_ppn, new_ppn,
             tag=None):
         """
@@ -354,6 +378,15 @@ class Ftl(object):
     def is_cleaning_needed(self):
         return self._cleaner.is_cleaning_needed()
 
+    def reload_conf(self):
+        """
+        Apply the GC knobs of self.conf after it is changed in the middle of
+        a simulation. GC thresholds and the stripe size are read from conf on
+        use.
+        """
+        self._cleaner.assert_threshold_sanity()
+        self._cleaner.set_n_cleaners(self.conf['n_gc_procs'])
+
     def is_wear_leveling_needed(self):
         factor, diff = self.block_pool.get_wear_status()
         self.recorder.append_to_value_list('wear_diff', diff)
@@ -738,17 +771,25 @@ class MappingCache(FlashTransmitMixin, InsertMixin, LoadMixin, FlushMixin):
         req = self._m_vpn_interface_lock.get_request(m_vpn)
         yield req
 
+        if not self.__update_in_cache(lpn, ppn):
+            yield self.env.process(self._insert_new_mapping(lpn, ppn, tag))
+
+        self._m_vpn_interface_lock.release_request(m_vpn, req)
+
+    def __update_in_cache(self, lpn, ppn):
+        """
+        Return False if there is no room for lpn and we have to evict.
+        """
         if self._lpn_table.has_lpn(lpn):
             self.recorder.count_me('translation', 'overwrite-in-cache')
             self._lpn_table.overwrite_lpn(lpn, ppn, dirty=True)
+        elif self._lpn_table.n_free_rows() > 0:
+            self.recorder.count_me('translation', 'insert-to-free')
+            self._add_to_free(lpn, ppn)
         else:
-            if self._lpn_table.n_free_rows() > 0:
-                self.recorder.count_me('translation', 'insert-to-free')
-                self._add_to_free(lpn, ppn)
-            else:
-                yield self.env.process(self._insert_new_mapping(lpn, ppn, tag))
+            return False
 
-        self._m_vpn_interface_lock.release_request(m_vpn, req)
+        return True
 
     def lpns_to_ppns(self, lpns, tag=None):
         """
@@ -787,6 +828,47 @@ class MappingCache(FlashTransmitMixin, InsertMixin, LoadMixin, FlushMixin):
         self._m_vpn_interface_lock.release_request(m_vpn, req)
         self.env.exit(ppn)
 
+    def relocate_lpns(self, lpns, new_ppns, tag=None):
+        """
+        Map lpns, which must be of the same m_vpn, to new_ppns and return
+        their old ppns.
+
+        Same as lpns_to_ppns() followed by update() of each lpn, but the
+        m_vpn is locked once for the whole group and we only start another
+        process when we have to access flash.
+        """
+        m_vpn = self.conf.lpn_to_m_vpn(lpns[0])
+
+        req = self._m_vpn_interface_lock.get_request(m_vpn)
+        yield req
+
+        old_ppns = []
+        n_hits = 0
+        for lpn in lpns:
+            ppn = self._lpn_table.lpn_to_ppn(lpn)
+            if ppn == MISS:
+                loaded, ppn = yield self.env.process(
+                    self._load_missing(m_vpn, wanted_lpn=lpn, tag=tag))
+                assert ppn != MISS
+                if loaded == True:
+                    self.recorder.count_me("Mapping_Cache", "miss")
+                else:
+                    n_hits += 1
+            else:
+                n_hits += 1
+            old_ppns.append(ppn)
+
+        if n_hits > 0:
+            self.recorder.add_to_general_accumulater("Mapping_Cache", "hit",
+                    n_hits)
+
+        for lpn, ppn in zip(lpns, new_ppns):
+            if not self.__update_in_cache(lpn, ppn):
+                yield self.env.process(self._insert_new_mapping(lpn, ppn, tag))
+
+        self._m_vpn_interface_lock.release_request(m_vpn, req)
+        self.env.exit(old_ppns)
+
     def flush(self):
         yield self.env.process(self._flush())
 
@@ -798,11 +880,9 @@ class MappingCache(FlashTransmitMixin, InsertMixin, LoadMixin, FlushMixin):
             row.state = FREE
 
     def _victim_row(self, avoid_m_vpns):
-        for lpn, row in self._lpn_table.least_to_most_lpn_items():
-            if row.state == USED:
-                m_vpn = self.conf.lpn_to_m_vpn(lpn)
-                if not m_vpn in avoid_m_vpns:
-                    return row
+        row = self._lpn_table.victim_row(avoid_m_vpns)
+        if row is not None:
+            return row
         raise RuntimeError("Cannot find a victim. Current stats: {}"\
                 ", avoid_m_vpns: {}.\n"
                 .format(str(self._lpn_table.stats()), avoid_m_vpns))
@@ -817,6 +897,14 @@ class LpnTable(object):
 
         self._rows = self._fresh_rows()
 
+        # Number of rows in each state, and a stack of rows that may be
+        # FREE. They are maintained by _row_state_changed() so we don't
+        # need to scan all rows to count or find free rows.
+        # The stack is lazy: a row may have left FREE after being pushed,
+        # we check the state when popping.
+        self._state_counter = Counter({FREE: self._n_rows})
+        self._free_row_stack = [row.rowid for row in reversed(self._rows)]
+
         # lpns to Row instances, it is a dict
         # {lpn1: row1, lpn2: row2, ...}
         # self._lpn_to_row = SegmentedLruCache(n_rows, 0.5)
@@ -825,9 +913,16 @@ class LpnTable(object):
 
     def _fresh_rows(self):
          return [
-            Row(lpn = None, ppn = None, dirty = False, state = FREE, rowid = i)
+            Row(lpn = None, ppn = None, dirty = False, state = FREE, rowid = i,
+                state_observer = self._row_state_changed)
             for i in range(self._n_rows) ]
 
+    def _row_state_changed(self, row, old_state, new_state):
+        self._state_counter[old_state] -= 1
+        self._state_counter[new_state] += 1
+        if new_state == FREE:
+            self._free_row_stack.append(row.rowid)
+
     def rows(self):
         return self._rows
 
@@ -841,20 +936,21 @@ class LpnTable(object):
         return counter
 
     def n_free_rows(self):
-        return self._count_states()[FREE]
+        return self._state_counter[FREE]
 
     def n_locked_free_rows(self):
-        return self._count_states()[FREE_AND_LOCKED]
+        return self._state_counter[FREE_AND_LOCKED]
 
     def n_used_rows(self):
-        return self._count_states()[USED]
+        return self._state_counter[USED]
 
     def n_locked_used_rows(self):
-        return self._count_states()[USED_AND_LOCKED]
+        return self._state_counter[USED_AND_LOCKED]
 
     def lock_free_row(self):
         """FREE TO FREE_AND_LOCKED"""
-        for row in self._rows:
+        while len(self._free_row_stack) > 0:
+            row = self._rows[self._free_row_stack.pop()]
             if row.state == FREE:
                 row.state = FREE_AND_LOCKED
                 return row.rowid
@@ -878,15 +974,11 @@ class LpnTable(object):
 
     def lock_free_rows(self, n):
         row_ids = []
-        got = 0
-        for row in self._rows:
-            if row.state == FREE:
-                row.state = FREE_AND_LOCKED
-                row_ids.append(row.rowid)
-                got += 1
-
-                if got == n:
-                    break
+        while len(row_ids) < n:
+            rowid = self.lock_free_row()
+            if rowid is None:
+                break
+            row_ids.append(rowid)
         return row_ids
 
     def unlock_free_row(self, rowid):
@@ -993,7 +1085,9 @@ class LpnTable(object):
             return True
 
     def stats(self):
-        return self._count_states()
+        # only states with rows, as _count_states() returns
+        return Counter({state: cnt for state, cnt in self._state_counter.items()
+            if cnt > 0})
 
 
 class LpnTableMvpn(LpnTable):
@@ -1004,12 +1098,68 @@ class LpnTableMvpn(LpnTable):
         super(LpnTableMvpn, self).__init__(conf.n_cache_entries)
         self.conf = conf
 
+        # the recency of lpns is only kept in self._evictable_rows
+        self._lpn_to_row = RowDict()
+        # USED rows, in recency order
+        self._evictable_rows = EvictableRows(conf)
+
+        # m_vpn -> {lpn: row}, for all cached lpns
+        self._m_vpn_rows = {}
+
+    def _row_state_changed(self, row, old_state, new_state):
+        super(LpnTableMvpn, self)._row_state_changed(row, old_state, new_state)
+
+        if new_state == USED:
+            self._evictable_rows.link(row.lpn, row)
+        elif old_state == USED and row.lpn is not None:
+            # locked or held. Rows being deleted have been forgotten in
+            # delete_lpn_and_lock().
+            self._evictable_rows.unlink(row.lpn)
+
+    def add_lpn(self, rowid, lpn, ppn, dirty, as_least_recent = False):
+        self._evictable_rows.touch(lpn, as_least_recent)
+        super(LpnTableMvpn, self).add_lpn(rowid, lpn, ppn, dirty,
+                as_least_recent)
+
+        m_vpn = self.conf.lpn_to_m_vpn(lpn)
+        self._m_vpn_rows.setdefault(m_vpn, {})[lpn] = self._rows[rowid]
+
+    def lpn_to_ppn(self, lpn):
+        ppn = super(LpnTableMvpn, self).lpn_to_ppn(lpn)
+        if ppn != MISS:
+            self._evictable_rows.touch(lpn)
+        return ppn
+
+    def overwrite_lpn(self, lpn, ppn, dirty):
+        super(LpnTableMvpn, self).overwrite_lpn(lpn, ppn, dirty)
+        self._evictable_rows.touch(lpn)
+
+    def delete_lpn_and_lock(self, lpn):
+        self._evictable_rows.forget(lpn)
+        rowid = super(LpnTableMvpn, self).delete_lpn_and_lock(lpn)
+
+        m_vpn = self.conf.lpn_to_m_vpn(lpn)
+        rows = self._m_vpn_rows[m_vpn]
+        del rows[lpn]
+        if len(rows) == 0:
+            del self._m_vpn_rows[m_vpn]
+
+        return rowid
+
+    def victim_row(self, avoid_m_vpns):
+        """
+        Return the least recently used USED row that does not belong to
+        avoid_m_vpns. Return None if there is no such row.
+        """
+        return self._evictable_rows.victim_row(avoid_m_vpns)
+
     def least_to_most_lpn_items(self):
-        return self._lpn_to_row.least_to_most_items()
+        return [(lpn, self._lpn_to_row[lpn])
+                for lpn in self._evictable_rows.least_to_most_lpns()]
 
     def needed_space_for_m_vpn(self, m_vpn):
-        cached_mappings = self.get_m_vpn_mappings(m_vpn)
-        return self.conf.n_mapping_entries_per_page - len(cached_mappings)
+        n_cached = len(self._m_vpn_rows.get(m_vpn, ()))
+        return self.conf.n_mapping_entries_per_page - n_cached
 
     def get_m_vpn_mappings(self, m_vpn):
         """ return all the mappings of m_vpn that are in cache
@@ -1031,25 +1181,199 @@ class LpnTableMvpn(LpnTable):
         return row_ids
 
     def _rows_of_m_vpn(self, m_vpn):
-        lpns = self.conf.m_vpn_to_lpns(m_vpn)
-        rows = []
-        for lpn in lpns:
-            try:
-                row = self._lpn_to_row.peek(lpn)
-            except KeyError:
-                pass
-            else:
-                rows.append(row)
+        """
+        Cached rows of m_vpn, in lpn order
+        """
+        rows = self._m_vpn_rows.get(m_vpn, None)
+        if rows is None:
+            return []
 
-        return rows
+        return [rows[lpn] for lpn in sorted(rows.keys())]
 
     def get_un_cached_lpn_of_m_vpn(self, m_vpn):
         lpns = self.conf.m_vpn_to_lpns(m_vpn)
-        cached_dict = self.get_m_vpn_mappings(m_vpn)
-        uncached_lpns = set(lpns) - set(cached_dict.keys())
+        cached_rows = self._m_vpn_rows.get(m_vpn, {})
+        uncached_lpns = set(lpn for lpn in lpns if not lpn in cached_rows)
         return uncached_lpns
 
 
+class RowDict(dict):
+    """
+    lpn -> row, with the interface of LruCache that LpnTable uses but
+    without keeping the recency.
+    """
+    peek = dict.__getitem__
+
+    def add_as_least_used(self, key, value):
+        self[key] = value
+
+
+class EvictableRows(object):
+    """
+    Eviction candidates (USED rows) of the mapping cache.
+
+    Each cached lpn has a recency stamp, a larger stamp is more recent.
+    Rows of an m_vpn are kept in a linked list ordered by stamp, and the
+    m_vpns are kept in a heap by the stamp of their least recently used
+    row. So finding the least recently used row that is not in some
+    avoided m_vpns does not walk rows that are locked, held or avoided.
+
+    The heap is lazy: an entry (stamp, m_vpn) is stale if stamp is not
+    the one in self._heap_stamp.
+    """
+    def __init__(self, conf):
+        self._n_entries_per_page = conf.n_mapping_entries_per_page
+
+        self._newest_stamp = 0
+        self._oldest_stamp = 0
+
+        # lpn -> Node, for all cached lpns. node.stamp is the recency
+        # stamp, node.linked tells if the node is in self._lists
+        self._nodes = {}
+        self._lists = {} # m_vpn -> LinkedList, head is the most recent
+
+        self._heap = []
+        self._heap_stamp = {} # m_vpn -> stamp of its live heap entry
+
+    def touch(self, lpn, as_least_recent = False):
+        """
+        Mark lpn as the most (or least) recently used.
+        """
+        if as_least_recent:
+            self._oldest_stamp -= 1
+            stamp = self._oldest_stamp
+        else:
+            self._newest_stamp += 1
+            stamp = self._newest_stamp
+
+        node = self._nodes.get(lpn, None)
+        if node is None:
+            node = Node(key = lpn)
+            node.linked = False
+            self._nodes[lpn] = node
+        node.stamp = stamp
+
+        if node.linked:
+            m_vpn = lpn / self._n_entries_per_page
+            linked_list = self._lists[m_vpn]
+            linked_list.delete(node)
+            if as_least_recent:
+                linked_list.add_to_tail(node)
+            else:
+                linked_list.add_to_head(node)
+            self._update_heap(m_vpn)
+
+    def link(self, lpn, row):
+        """
+        Make the row of lpn an eviction candidate. touch() must have been
+        called for lpn.
+        """
+        node = self._nodes[lpn]
+        assert node.linked is False
+        node.value = row
+        node.linked = True
+
+        m_vpn = lpn / self._n_entries_per_page
+        linked_list = self._lists.get(m_vpn, None)
+        if linked_list is None:
+            linked_list = LinkedList()
+            self._lists[m_vpn] = linked_list
+
+        if len(linked_list) == 0 or node.stamp > linked_list.head().stamp:
+            linked_list.add_to_head(node)
+        elif node.stamp < linked_list.tail().stamp:
+            linked_list.add_to_tail(node)
+        else:
+            # a row comes back from locked or held, rare
+            for cur_node in linked_list:
+                if cur_node.stamp < node.stamp:
+                    linked_list.add_before2(node, cur_node)
+                    break
+
+        self._update_heap(m_vpn)
+
+    def unlink(self, lpn):
+        """
+        The row of lpn is no longer an eviction candidate. Its stamp is
+        kept.
+        """
+        node = self._nodes[lpn]
+        node.linked = False
+        node.value = None
+
+        m_vpn = lpn / self._n_entries_per_page
+        linked_list = self._lists[m_vpn]
+        linked_list.delete(node)
+        if len(linked_list) == 0:
+            del self._lists[m_vpn]
+        # the heap entry of m_vpn is fixed lazily in victim_row()
+
+    def forget(self, lpn):
+        if self._nodes[lpn].linked:
+            self.unlink(lpn)
+        del self._nodes[lpn]
+
+    def least_to_most_lpns(self):
+        """
+        All cached lpns, including those of locked and held rows. It sorts,
+        only use it for rare operations like flushing the cache.
+        """
+        return sorted(self._nodes.keys(), key = lambda lpn:
+                self._nodes[lpn].stamp)
+
+    def _update_heap(self, m_vpn):
+        """
+        Push a new heap entry if the least recently used row of m_vpn is
+        older than what the heap has. Newer ones are fixed lazily.
+        """
+        stamp = self._lists[m_vpn].tail().stamp
+        heap_stamp = self._heap_stamp.get(m_vpn, None)
+        if heap_stamp is None or stamp < heap_stamp:
+            self._push(stamp, m_vpn)
+
+    def _push(self, stamp, m_vpn):
+        self._heap_stamp[m_vpn] = stamp
+        heapq.heappush(self._heap, (stamp, m_vpn))
+
+        if len(self._heap) > 2 * len(self._heap_stamp) + 64:
+            self._heap = [(s, m) for m, s in self._heap_stamp.items()]
+            heapq.heapify(self._heap)
+
+    def victim_row(self, avoid_m_vpns):
+        avoid_m_vpns = set(avoid_m_vpns)
+        popped_entries = []
+        victim = None
+        while len(self._heap) > 0:
+            stamp, m_vpn = heapq.heappop(self._heap)
+            if self._heap_stamp.get(m_vpn, None) != stamp:
+                # stale
+                continue
+
+            linked_list = self._lists.get(m_vpn, None)
+            if linked_list is None:
+                # no candidate in this m_vpn any more
+                del self._heap_stamp[m_vpn]
+                continue
+
+            cur_stamp = linked_list.tail().stamp
+            if cur_stamp != stamp:
+                # the least recently used row has been used or unlinked
+                self._heap_stamp[m_vpn] = cur_stamp
+                heapq.heappush(self._heap, (cur_stamp, m_vpn))
+                continue
+
+            popped_entries.append((stamp, m_vpn))
+            if not m_vpn in avoid_m_vpns:
+                victim = linked_list.tail().value
+                break
+
+        # the entries are still valid
+        for entry in popped_entries:
+            heapq.heappush(self._heap, entry)
+
+        return victim
+
+
 class _Row(object):
     def __init__(self, lpn, ppn, dirty, state, rowid):
         self.lpn = lpn
@@ -1065,12 +1389,14 @@ class _Row(object):
 
 
 class Row(object):
-    def __init__(self, lpn, ppn, dirty, state, rowid):
+    def __init__(self, lpn, ppn, dirty, state, rowid, state_observer=None):
         self._lpn = lpn
         self._ppn = ppn
         self._dirty = dirty
         self._state = state
         self._rowid = rowid
+        # called as state_observer(row, old_state, new_state)
+        self._state_observer = state_observer
 
     def _assert_modification_allowed(self):
          assert self._state in (FREE_AND_LOCKED, USED, USED_AND_HOLD), \
@@ -1135,8 +1461,12 @@ class Row(object):
                     "current state {}".format(self._state)
         else:
             raise RuntimeError("{} is not a valid state".format(state_value))
+        old_state = self._state
         self._state = state_value
 
+        if self._state_observer is not None:
+            self._state_observer(self, old_state, state_value)
+
     @property
     def rowid(self):
         return self._rowid
@@ -1299,7 +1629,7 @@ class WearLevelingVictimBlocks(object):
         used_trans_blocks = self._block_pool.trans_usedblocks
 
         self._block_pool.remove_full_cur_blocks()
-        cur_blocks = self._block_pool.current_blocks()
+        cur_blocks = set(self._block_pool.current_blocks())
 
         # we need used data or trans block
         victim_cnt = 0
@@ -1337,62 +1667,83 @@ class VictimBlocks(object):
         return repr(list(self.iterator_verbose()))
 
     def iterator_verbose(self):
-        candidate_tuples = self._candidate_priorityq()
-        while True:
-            try:
-                valid_ratio, block_type, block_num = heapq.heappop(candidate_tuples)
-                yield valid_ratio, block_type, block_num
-            except IndexError:
-                # Out of victim blocks
-                raise StopIteration
-
-    def get_valid_ratio_counter_of_used_blocks(self):
-        used_blocks = self._block_pool.used_blocks
-        counter = Counter()
-        for block in used_blocks:
-            valid_ratio = self._oob.states.block_valid_ratio(block)
-            ratio_str = "{0:.2f}".format(valid_ratio)
-            counter[ratio_str] += 1
-        return counter
-
-    def _candidate_priorityq(self):
-        candidate_tuples = self._victim_candidates()
-        heapq.heapify(candidate_tuples)
-        return candidate_tuples
-
-    def _form_tuples(self, used_blocks, block_type):
-        assert block_type in (self.TYPE_DATA, self.TYPE_TRANS)
-
-        self._block_pool.remove_full_cur_blocks()
-        cur_blocks = self._block_pool.current_blocks()
+        """
+        Yield (valid_ratio, block_type, block_num) from the fewest valid
+        pages to the most. Blocks with the same number of valid pages are
+        yielded data blocks first, then by block number.
 
-        victim_candidates = []
-        for block in used_blocks:
-            if block in cur_blocks:
-                # skip current blocks
-                continue
+        Victims are taken lazily from the valid-count buckets of the OOB
+        bitmap, so the caller does not pay for blocks it does not consume.
+        """
+        n_pages = self._conf.n_pages_per_block
 
-            valid_ratio = self._oob.states.block_valid_ratio(block)
-            if valid_ratio == 1:
-                # skip all-valid blocks
-                continue
+        # all-valid blocks (n_pages valid pages) are never victims
+        for n_valid in range(n_pages):
+            valid_ratio = n_valid / float(n_pages)
             if valid_ratio > self._conf['max_victim_valid_ratio']:
                 # If valid ratio is too big, moving it does not provide
                 # too much benefit.
-                continue
+                break
 
-            victim_candidates.append( (valid_ratio, block_type, block) )
+            for victim_tuple in self._bucket_tuples(n_valid):
+                yield victim_tuple
 
-        return victim_candidates
+    def _bucket_tuples(self, n_valid):
+        blocks = self._oob.states.blocks_with_valid_count(n_valid)
+        if len(blocks) == 0:
+            return
 
-    def _victim_candidates(self):
         used_data_blocks = self._block_pool.data_usedblocks
         used_trans_blocks = self._block_pool.trans_usedblocks
 
-        candidate_tuples = self._form_tuples(used_data_blocks, self.TYPE_DATA) + \
-            self._form_tuples(used_trans_blocks, self.TYPE_TRANS)
+        data_blocks = []
+        trans_blocks = []
+        for block in blocks:
+            if block in used_data_blocks:
+                data_blocks.append(block)
+            elif block in used_trans_blocks:
+                trans_blocks.append(block)
+
+        candidates = [(self.TYPE_DATA, block) for block in sorted(data_blocks)]
+        candidates += [(self.TYPE_TRANS, block) for block in sorted(trans_blocks)]
+
+        for block_type, block in candidates:
+            # the caller may have changed the blocks between two yields,
+            # such as opening new current blocks
+            if self._is_victim(block_type, block):
+                valid_ratio = self._oob.states.block_valid_ratio(block)
+                yield valid_ratio, block_type, block
+
+    def _is_victim(self, block_type, block):
+        if block_type == self.TYPE_DATA:
+            if not block in self._block_pool.data_usedblocks:
+                return False
+        else:
+            if not block in self._block_pool.trans_usedblocks:
+                return False
 
-        return candidate_tuples
+        self._block_pool.remove_full_cur_blocks()
+        if block in self._block_pool.current_blocks():
+            # skip current blocks
+            return False
+
+        valid_ratio = self._oob.states.block_valid_ratio(block)
+        if valid_ratio == 1:
+            # skip all-valid blocks
+            return False
+        if valid_ratio > self._conf['max_victim_valid_ratio']:
+            return False
+
+        return True
+
+    def get_valid_ratio_counter_of_used_blocks(self):
+        used_blocks = self._block_pool.used_blocks
+        counter = Counter()
+        for block in used_blocks:
+            valid_ratio = self._oob.states.block_valid_ratio(block)
+            ratio_str = "{0:.2f}".format(valid_ratio)
+            counter[ratio_str] += 1
+        return counter
 
 
 class Cleaner(object):
@@ -1435,9 +1786,7 @@ class Cleaner(object):
 
         # limit number of cleaner processes
         # self.n_cleaners = self.conf.n_channels_per_dev * 64
-        self.n_cleaners = self.conf['n_gc_procs']
-        print 'n_cleaners:', self.n_cleaners
-        self._block_cleaner_res = simpy.Resource(self.env, capacity=self.n_cleaners)
+        self.set_n_cleaners(self.conf['n_gc_procs'])
 
         self.n_victim_per_batch = self.conf.n_channels_per_dev * 2
 
@@ -1446,6 +1795,12 @@ class Cleaner(object):
 
         self.gc_time_recorded = False
 
+    def set_n_cleaners(self, n_cleaners):
+        "No block can be being cleaned"
+        self.n_cleaners = n_cleaners
+        print 'n_cleaners:', self.n_cleaners
+        self._block_cleaner_res = simpy.Resource(self.env, capacity=self.n_cleaners)
+
     def assert_threshold_sanity(self):
         if self.conf['do_not_check_gc_setting'] is True:
             return
@@ -1515,11 +1870,12 @@ class Cleaner(object):
             self.gc_time_recorded = True
             print 'GC time recorded!........!'
 
-        all_victim_tuples = list(victim_blocks.iterator_verbose())
-        batches = utils.group_to_batches(all_victim_tuples, self.n_victim_per_batch)
-
-        for batch in batches:
-            if self.is_stopping_needed():
+        # victims are picked batch by batch, we stop picking as soon as
+        # we have cleaned enough
+        victim_iter = victim_blocks.iterator_verbose()
+        while not self.is_stopping_needed():
+            batch = list(itertools.islice(victim_iter, self.n_victim_per_batch))
+            if len(batch) == 0:
                 break
             yield self.env.process(self._clean_batch(batch, purpose=PURPOSE_GC))
 
@@ -1761,7 +2117,7 @@ class OutOfBandAreas(object):
         self.total_pages = self.flash_num_blocks * self.flash_npage_per_block
 
         # Key data structures
-        self.states = FlashBitmap2(confobj)
+        self.states = BucketedFlashBitmap(confobj)
         # ppn->lpn mapping stored in OOB, Note that for translation pages, this
         # mapping is ppn -> m_vpn
         self.ppn_to_lpn_mvpn = {}
@@ -1888,6 +2244,12 @@ class Config(config.ConfigNCQFTL):
             "mapping_cache_bytes": None, # cmt: cached mapping table
             "do_not_check_gc_setting": False,
             "write_gc_log": True,
+            # Translate and update the mappings of each m_vpn group of a
+            # write in one process, which is much faster for large writes.
+            # The group holds its m_vpn until it is done, so concurrent
+            # groups no longer interleave and results may differ from
+            # the per-lpn processes.
+            "batch_metadata_update": False,
             }
         self.update(local_itmes)
         self['segment_bytes'] = 1*TB
@@ -1366,7 +1366,7 @@ class GarbageCollector(object):
         """
         Calculate benefit/cost and put it to a priority queue
         """
-        current_blocks = self.block_pool.current_blocks()
+        current_blocks = set(self.block_pool.current_blocks())
         current_time = datetime.datetime.now()
         priority_q = Queue.PriorityQueue()
 
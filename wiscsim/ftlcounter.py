@@ -5,9 +5,14 @@ import datetime
 import random
 import os
 import Queue
+import shutil
 import sys
 
 import bidict
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import config
 import flash
@@ -36,7 +41,13 @@ class Config(config.ConfigNCQFTL):
             "GC_threshold_ratio": 0.95,
             "GC_low_threshold_ratio": 0.9,
             "over_provisioning": 1.28,
-            "mapping_cache_bytes": None # cmt: cached mapping table
+            "mapping_cache_bytes": None, # cmt: cached mapping table
+            # 'numpy' counts accesses in per-LPN arrays, 'counter' in
+            # Counters. numpy falls back to counter if numpy is missing.
+            "lpn_count_backend": "numpy",
+            # 'text' writes lpn.count, 'npz' writes lpn.count.npz with the
+            # arrays lpn, read, write and discard (numpy backend only)
+            "lpn_count_format": "text",
             }
         self.update(local_itmes)
 
@@ -114,9 +125,17 @@ class Ftl(ftlbuilder.FtlBuilder):
         self.n_sec_per_page = self.conf.page_size \
                 / self.conf['sector_size']
 
-        self.read_count = Counter()
-        self.write_count = Counter()
-        self.discard_count = Counter()
+        self.use_numpy = numpy is not None and \
+                self.conf.get('lpn_count_backend', 'numpy') == 'numpy'
+        if self.use_numpy:
+            n_lpns = self.conf.total_flash_bytes() / self.conf.page_size
+            self.read_count = LpnExtentCounts(n_lpns)
+            self.write_count = LpnExtentCounts(n_lpns)
+            self.discard_count = LpnExtentCounts(n_lpns)
+        else:
+            self.read_count = Counter()
+            self.write_count = Counter()
+            self.discard_count = Counter()
 
         self.total_write_bytes = 0
         self.total_read_bytes = 0
@@ -127,6 +146,10 @@ class Ftl(ftlbuilder.FtlBuilder):
 
         self.total_read_bytes += lpn_count * self.conf.page_size
 
+        if self.use_numpy:
+            self.read_count.add(lpn_start, lpn_count)
+            return
+
         for lpn in range(lpn_start, lpn_start + lpn_count):
             self.read_count[lpn] += 1
 
@@ -135,6 +158,10 @@ class Ftl(ftlbuilder.FtlBuilder):
 
         self.total_write_bytes += lpn_count * self.conf.page_size
 
+        if self.use_numpy:
+            self.write_count.add(lpn_start, lpn_count)
+            return
+
         for lpn in range(lpn_start, lpn_start + lpn_count):
             self.write_count[lpn] += 1
 
@@ -143,6 +170,10 @@ class Ftl(ftlbuilder.FtlBuilder):
 
         self.total_discard_bytes += lpn_count * self.conf.page_size
 
+        if self.use_numpy:
+            self.discard_count.add(lpn_start, lpn_count)
+            return
+
         for lpn in range(lpn_start, lpn_start + lpn_count):
             self.discard_count[lpn] += 1
 
@@ -182,6 +213,10 @@ class Ftl(ftlbuilder.FtlBuilder):
                 'traffic_size', 'discard', self.total_discard_bytes)
 
     def dump_counts(self, lpns):
+        if self.use_numpy:
+            self.dump_counts_numpy(lpns)
+            return
+
         counters = [self.read_count, self.write_count, self.discard_count]
 
         table = []
@@ -201,6 +236,23 @@ class Ftl(ftlbuilder.FtlBuilder):
 
         # self.clean_up()
 
+    def dump_counts_numpy(self, lpns):
+        lpns = numpy.array(lpns, dtype=numpy.int64)
+        columns = [lpns] + [counter.counts_of(lpns) for counter in
+                (self.read_count, self.write_count, self.discard_count)]
+
+        if self.conf['lpn_count_format'] == 'npz':
+            count_path = os.path.join(self.conf['result_dir'],
+                    'lpn.count.npz')
+            numpy.savez_compressed(count_path, lpn=columns[0],
+                    read=columns[1], write=columns[2], discard=columns[3])
+            return
+
+        count_path = os.path.join(self.conf['result_dir'], 'lpn.count')
+        with open(count_path, 'w') as f:
+            f.write('lpn read write discard\n')
+            numpy.savetxt(f, numpy.column_stack(columns), fmt='%d')
+
     def dump_lpn_sem(self, lpns):
         if self.conf['filesystem'] == 'ext4':
             self.dump_lpn_sem_ext4(lpns)
@@ -258,6 +310,20 @@ class Ftl(ftlbuilder.FtlBuilder):
 
 
     def get_lpns(self):
+        if self.use_numpy:
+            counters = (self.read_count, self.write_count,
+                    self.discard_count)
+            negative_lpns = set()
+            for counter in counters:
+                negative_lpns.update(counter.negative.keys())
+
+            touched = numpy.zeros(max(len(counter.counts())
+                for counter in counters), dtype=bool)
+            for counter in counters:
+                counts = counter.counts()
+                touched[:len(counts)] |= counts > 0
+            return sorted(negative_lpns) + numpy.nonzero(touched)[0].tolist()
+
         lpns = list(set(self.read_count.keys()
             + self.write_count.keys()
             + self.discard_count.keys()))
@@ -278,18 +344,97 @@ class Ftl(ftlbuilder.FtlBuilder):
         else:
             event_file_path = self.conf.get_ftlsim_events_output_path()
 
-        workload_line_iter = hostevent.FileLineIterator(event_file_path)
-        event_workload_iter = hostevent.EventIterator(self.conf, workload_line_iter)
+        ncq_depth_table_path = os.path.join(self.conf['result_dir'],
+                'ncq_depth_timeline.txt')
+
+        # the index of the event file has the same table
+        stats = blocktrace.load_trace_stats(event_file_path,
+                self.conf['event_file_column_names'],
+                self.conf['sector_size'])
+        if stats is not None:
+            shutil.copyfile(blocktrace.ncq_timeline_path(event_file_path),
+                    ncq_depth_table_path)
+            return
+
+        event_workload_iter = hostevent.event_iterator_of_file(self.conf,
+                event_file_path)
 
         parser = EventNCQParser(event_workload_iter)
         table = parser.parse()
 
-        ncq_depth_table_path = os.path.join(self.conf['result_dir'],
-                'ncq_depth_timeline.txt')
         with open(ncq_depth_table_path, 'w') as f:
             f.write(utils.table_to_str(table, width=0))
 
 
+class LpnExtentCounts(object):
+    """
+    Number of accesses of every LPN, counted from LPN extents.
+
+    Extents are buffered and added to a difference array in chunks, which
+    is summed up when the counts are needed. The arrays are uint32; the
+    difference array relies on its wraparound, which is exact as long as
+    no count exceeds 2**32 - 1. Negative LPNs, from requests in the
+    padding before the partition, are few and counted in a Counter.
+    """
+    def __init__(self, n_lpns, chunk_size=2**16):
+        self.diff = numpy.zeros(n_lpns + 1, dtype=numpy.uint32)
+        self.chunk_size = chunk_size
+        self.starts = []
+        self.lengths = []
+        self._counts = None
+        self.negative = Counter()
+
+    def add(self, lpn_start, lpn_count):
+        if lpn_start < 0:
+            for lpn in range(lpn_start, min(0, lpn_start + lpn_count)):
+                self.negative[lpn] += 1
+            lpn_count = max(0, lpn_start + lpn_count)
+            lpn_start = 0
+
+        self.starts.append(lpn_start)
+        self.lengths.append(lpn_count)
+        if len(self.starts) == self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self.starts) == 0:
+            return
+
+        starts = numpy.array(self.starts, dtype=numpy.int64)
+        ends = starts + numpy.array(self.lengths, dtype=numpy.int64)
+        self.starts = []
+        self.lengths = []
+
+        if ends.max() >= len(self.diff):
+            # LPNs beyond the device, grow to fit them
+            diff = numpy.zeros(ends.max() + 1, dtype=numpy.uint32)
+            diff[:len(self.diff)] = self.diff
+            self.diff = diff
+
+        numpy.add.at(self.diff, starts, 1)
+        numpy.subtract.at(self.diff, ends, 1)
+        self._counts = None
+
+    def counts(self):
+        "Array of the count of every LPN"
+        self._flush()
+        if self._counts is None:
+            self._counts = numpy.cumsum(self.diff,
+                    dtype=numpy.uint32)[:-1]
+        return self._counts
+
+    def counts_of(self, lpns):
+        "Counts of an array of LPNs, which may be negative or never counted"
+        counts = self.counts()
+        negative = lpns < 0
+        ret = numpy.zeros(len(lpns), dtype=numpy.uint32)
+        # LPNs past the last counted one were never accessed
+        counted = ~negative & (lpns < len(counts))
+        ret[counted] = counts[lpns[counted]]
+        ret[negative] = [self.negative[lpn] for lpn in lpns[negative]]
+        return ret
+
+
 class LpnClassification(object):
     def __init__(self, lpns, device_path, result_dir, flash_page_size):
         self.device_path = device_path
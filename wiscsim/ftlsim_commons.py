@@ -2,6 +2,8 @@ import simpy
 import random
 
 class Extent(object):
+    __slots__ = ('lpn_start', 'lpn_count')
+
     def __init__(self, lpn_start, lpn_count):
         assert lpn_count > 0
         self.lpn_start = lpn_start
@@ -32,6 +34,8 @@ class Extent(object):
 
 
 class CacheExtent(Extent):
+    __slots__ = ('in_cache',)
+
     def __init__(self, lpn_start, lpn_count, in_cache):
         super(CacheExtent, self).__init__(lpn_start, lpn_count)
         self.in_cache = in_cache
@@ -47,6 +51,8 @@ def display_extents(extent_list):
 
 
 class SSDRequest(CacheExtent):
+    __slots__ = ('operation',)
+
     def __init__(self, lpn_start, lpn_count, in_cache, operation):
         super(CacheExtent, self).__init__(lpn_start, lpn_count)
         self.operation = operation
@@ -7,6 +7,14 @@ class Host(object):
     def __init__(self, conf, simpy_env, event_iter):
         self.conf = conf
         self.env = simpy_env
+
+        if self.conf.get('compact_trace', False) is True:
+            self.compactor = hostevent.EventCompactor(self.conf, event_iter,
+                    time_window = self.conf['compact_trace_time_window'],
+                    max_size = self.conf['compact_trace_max_size'])
+            event_iter = self.compactor
+        else:
+            self.compactor = None
         self.event_iter = event_iter
 
         self._ncq = NCQSingleQueue(
@@ -1,7 +1,23 @@
+import mmap
+import os
+import struct
+
 from ftlsim_commons import Extent
 from commons import *
 
+# A process forked in the middle of a simulation shares the offsets of the
+# open event files with its parent. Event file readers reopen their files
+# when this changes, see note_fork().
+_fork_generation = [0]
+
+def note_fork():
+    "Call it in the child process after os.fork()"
+    _fork_generation[0] += 1
+
+
 class HostEventBase(object):
+    __slots__ = ()
+
     def get_operation(self):
         raise NotImplementedError
 
@@ -10,6 +26,10 @@ class HostEventBase(object):
 
 
 class ControlEvent(HostEventBase):
+    # token and token_req are set by the simulator
+    __slots__ = ('operation', 'arg1', 'arg2', 'arg3', 'action',
+            'token', 'token_req')
+
     def __init__(self, operation, arg1=None, arg2=None, arg3=None):
         self.operation = operation
         self.arg1 = arg1
@@ -29,6 +49,12 @@ class ControlEvent(HostEventBase):
 
 
 class Event(HostEventBase):
+    # millions of events can be in flight, so no __dict__ for them.
+    # token and token_req are set by the simulator
+    __slots__ = ('pid', 'operation', 'offset', 'size', 'sync', 'timestamp',
+            'pre_wait_time', 'action', 'sector', 'sector_count',
+            '_lpn_extent', 'token', 'token_req')
+
     def __init__(self, sector_size, pid, operation, offset, size,
             timestamp = None, pre_wait_time = None, sync = True, action = 'D'):
         self.pid = int(pid)
@@ -52,6 +78,8 @@ class Event(HostEventBase):
 
         self.sector_count = self.size / sector_size
 
+        self._lpn_extent = None
+
     def get_operation(self):
         return self.operation
 
@@ -59,9 +87,15 @@ class Event(HostEventBase):
         return 'Event'
 
     def get_lpn_extent(self, conf):
-        lpn_start, lpn_count = conf.off_size_to_page_range(
-                self.offset, self.size, force_alignment=False)
-        return Extent(lpn_start = lpn_start, lpn_count = lpn_count)
+        """
+        The extent is computed on the first call and kept. Do not change it.
+        """
+        if self._lpn_extent is None:
+            lpn_start, lpn_count = conf.off_size_to_page_range(
+                    self.offset, self.size, force_alignment=False)
+            self._lpn_extent = Extent(lpn_start = lpn_start,
+                    lpn_count = lpn_count)
+        return self._lpn_extent
 
     def __str__(self):
         return "Event pid:{pid}, operation:{operation}, offset:{offset}, "\
@@ -79,10 +113,27 @@ class FileLineIterator(object):
         self.file_path = file_path
 
     def __iter__(self):
-        with open(self.file_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                yield line
+        generation = _fork_generation[0]
+        offset = 0
+        f = open(self.file_path, 'r')
+        try:
+            lines = iter(f)
+            while True:
+                if generation != _fork_generation[0]:
+                    f.close()
+                    f = open(self.file_path, 'r')
+                    f.seek(offset)
+                    lines = iter(f)
+                    generation = _fork_generation[0]
+
+                try:
+                    line = next(lines)
+                except StopIteration:
+                    break
+                offset += len(line)
+                yield line.strip()
+        finally:
+            f.close()
 
 
 class EventIterator(object):
@@ -120,3 +171,551 @@ class EventIterator(object):
             yield self.str_to_event(line)
 
 
+
+
+# Binary event file
+#
+# The same events as a text event file, one fixed-width record per line of
+# the text file, after a header. Text columns are kept so that events read
+# from the binary file are the same as events read from the text file:
+#   timestamp      double, formatted back with 9 decimals like blkparse.
+#                  Timestamps with other precisions come back with 9
+#                  decimals too.
+#   pre_wait_time  double, NaN for 'NA'
+#   sync           bool, returned as 'True' or 'False'
+BINARY_EVENT_MAGIC = 'WISCEVT1'
+# pid, offset, size, timestamp, pre_wait_time, action, operation, sync
+BINARY_EVENT_RECORD = struct.Struct('<iqqddcB?')
+BINARY_EVENT_COLUMN_NAMES = ('pid', 'action', 'operation', 'offset', 'size',
+        'timestamp', 'pre_wait_time', 'sync')
+BINARY_EVENT_OPERATIONS = ('read', 'write', 'discard')
+
+def binary_event_path(text_path):
+    """
+    blkparse-events-for-ftlsim.txt -> blkparse-events-for-ftlsim.bin
+    """
+    return os.path.splitext(text_path)[0] + '.bin'
+
+
+def convert_event_file_to_binary(conf, text_path, binary_path=None):
+    """
+    Convert a text event file to the binary format. It is written to a
+    temporary file first, so a half-written binary file is never used and
+    parallel simulations may convert the same file.
+    """
+    if binary_path is None:
+        binary_path = binary_event_path(text_path)
+
+    column_names = conf['event_file_column_names']
+    if sorted(column_names) != sorted(BINARY_EVENT_COLUMN_NAMES):
+        raise RuntimeError("Binary event file does not support columns {}"\
+                .format(column_names))
+
+    op_codes = {op: i for i, op in enumerate(BINARY_EVENT_OPERATIONS)}
+    nan = float('nan')
+
+    tmp_path = '{}.{}.tmp'.format(binary_path, os.getpid())
+    with open(tmp_path, 'wb') as out_file:
+        out_file.write(BINARY_EVENT_MAGIC)
+        for line in FileLineIterator(text_path):
+            items = line.split()
+            if len(column_names) != len(items):
+                raise RuntimeError("Lengths not equal: {} {}".format(
+                    column_names, items))
+            dic = dict(zip(column_names, items))
+
+            timestamp = float(dic['timestamp'])
+            if dic['pre_wait_time'] == 'NA':
+                pre_wait_time = nan
+            else:
+                pre_wait_time = float(dic['pre_wait_time'])
+
+            assert dic['sync'] in ('True', 'False'), dic['sync']
+            # as Event() checks, since EventView does not
+            assert int(dic['offset']) % conf['sector_size'] == 0 and \
+                int(dic['size']) % conf['sector_size'] == 0, line
+
+            out_file.write(BINARY_EVENT_RECORD.pack(
+                int(dic['pid']), int(dic['offset']), int(dic['size']),
+                timestamp, pre_wait_time, dic['action'],
+                op_codes[dic['operation']], dic['sync'] == 'True'))
+
+    os.rename(tmp_path, binary_path)
+
+    return binary_path
+
+
+class BinaryEventIterator(object):
+    """
+    Iterate events of a binary event file
+    """
+    def __init__(self, conf, binary_path, records_per_read = 4096):
+        self.conf = conf
+        self.sector_size = self.conf['sector_size']
+        self.binary_path = binary_path
+        self.records_per_read = records_per_read
+
+        self._translation = {'read': OP_READ, 'write': OP_WRITE,
+                'discard':OP_DISCARD}
+        self._operations = [self._translation[op]
+                for op in BINARY_EVENT_OPERATIONS]
+
+    def __iter__(self):
+        record_size = BINARY_EVENT_RECORD.size
+        unpack_from = BINARY_EVENT_RECORD.unpack_from
+        sector_size = self.sector_size
+        operations = self._operations
+
+        generation = _fork_generation[0]
+        f = open(self.binary_path, 'rb')
+        try:
+            magic = f.read(len(BINARY_EVENT_MAGIC))
+            if magic != BINARY_EVENT_MAGIC:
+                raise RuntimeError("{} is not a binary event file".format(
+                    self.binary_path))
+            file_offset = len(magic)
+
+            while True:
+                if generation != _fork_generation[0]:
+                    f.close()
+                    f = open(self.binary_path, 'rb')
+                    f.seek(file_offset)
+                    generation = _fork_generation[0]
+
+                buf = f.read(record_size * self.records_per_read)
+                file_offset += len(buf)
+                if len(buf) % record_size != 0:
+                    raise RuntimeError("{} is truncated".format(
+                        self.binary_path))
+
+                for start in xrange(0, len(buf), record_size):
+                    yield EventView(unpack_from(buf, start), sector_size,
+                            operations)
+
+                if len(buf) < record_size * self.records_per_read:
+                    break
+        finally:
+            f.close()
+
+
+class EventView(Event):
+    """
+    An Event decoded from a record of a binary event file. The checks of
+    Event.__init__() were done when the file was converted.
+    """
+    __slots__ = ()
+
+    def __init__(self, fields, sector_size, operations):
+        self.pid, self.offset, self.size, timestamp, pre_wait_time, \
+            self.action, op_code, sync = fields
+
+        self.operation = operations[op_code]
+        self.timestamp = '{:.9f}'.format(timestamp)
+        if pre_wait_time != pre_wait_time:
+            # NaN
+            pre_wait_time = 'NA'
+        self.pre_wait_time = pre_wait_time
+        self.sync = 'True' if sync else 'False'
+
+        self.sector = self.offset / sector_size
+        self.sector_count = self.size / sector_size
+        self._lpn_extent = None
+
+
+class MmapEventIterator(object):
+    """
+    Events of a binary event file, read through a read-only memory map of
+    the file. Nothing is parsed up front, and simulations of the same trace
+    on one machine share the pages of the file in the page cache instead
+    of each reading its own copy.
+    """
+    def __init__(self, conf, binary_path):
+        self.conf = conf
+        self.sector_size = self.conf['sector_size']
+        self.binary_path = binary_path
+
+        translation = {'read': OP_READ, 'write': OP_WRITE,
+                'discard':OP_DISCARD}
+        self.operations = [translation[op] for op in BINARY_EVENT_OPERATIONS]
+
+        self._header_size = len(BINARY_EVENT_MAGIC)
+        # the map of __getitem__(), iterations map the file themselves
+        self._buffer = None
+
+    def _map(self):
+        with open(self.binary_path, 'rb') as f:
+            # mmap keeps its own reference to the file
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        if buf[:self._header_size] != BINARY_EVENT_MAGIC:
+            buf.close()
+            raise RuntimeError("{} is not a binary event file".format(
+                self.binary_path))
+        if (len(buf) - self._header_size) % BINARY_EVENT_RECORD.size != 0:
+            buf.close()
+            raise RuntimeError("{} is truncated".format(self.binary_path))
+        return buf
+
+    def _indexed_buffer(self):
+        if self._buffer is None:
+            self._buffer = self._map()
+        return self._buffer
+
+    def __len__(self):
+        return (os.path.getsize(self.binary_path) - self._header_size) / \
+                BINARY_EVENT_RECORD.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("event index {} out of range".format(i))
+        return EventView(BINARY_EVENT_RECORD.unpack_from(
+            self._indexed_buffer(),
+            self._header_size + i * BINARY_EVENT_RECORD.size),
+            self.sector_size, self.operations)
+
+    def __iter__(self):
+        unpack_from = BINARY_EVENT_RECORD.unpack_from
+        sector_size = self.sector_size
+        operations = self.operations
+
+        buf = self._map()
+        try:
+            for record_offset in xrange(self._header_size, len(buf),
+                    BINARY_EVENT_RECORD.size):
+                yield EventView(unpack_from(buf, record_offset),
+                        sector_size, operations)
+        finally:
+            buf.close()
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+
+def event_iterator_of_file(conf, text_path):
+    """
+    Events of a text event file. If its binary version exists and is not
+    older, events are read from the binary file instead, through a memory
+    map unless conf['mmap_event_file'] is False. With
+    conf['binary_event_file'], the binary version is created if it is
+    missing or older.
+    """
+    binary_path = binary_event_path(text_path)
+    if conf.get('binary_event_file', False) is True and \
+            os.path.exists(text_path) and \
+            (not os.path.exists(binary_path) or
+             os.path.getmtime(binary_path) < os.path.getmtime(text_path)):
+        convert_event_file_to_binary(conf, text_path, binary_path)
+
+    if os.path.exists(binary_path) and (not os.path.exists(text_path) or
+            os.path.getmtime(binary_path) >= os.path.getmtime(text_path)):
+        if conf.get('mmap_event_file', True) is True:
+            return MmapEventIterator(conf, binary_path)
+        else:
+            return BinaryEventIterator(conf, binary_path)
+
+    return EventIterator(conf, FileLineIterator(text_path))
+
+
+
+class EventCompactor(object):
+    """
+    Merge runs of contiguous requests before they reach the host.
+
+    An event is appended to the previous one if both are data events
+    (action 'D') of the same pid, operation and sync flag, it starts where
+    the previous one ends, it is issued within time_window seconds of the
+    previous one, and the merged size stays within max_size bytes. The
+    merged event keeps the timestamp and pre_wait_time of its first event.
+    Events without a timestamp are not merged. Control events and all other
+    events are passed through in order.
+    """
+    def __init__(self, conf, event_iter, time_window, max_size):
+        self.sector_size = conf['sector_size']
+        self.event_iter = event_iter
+        self.time_window = time_window
+        self.max_size = max_size
+
+        self.n_events_in = 0
+        self.n_events_out = 0
+
+    @property
+    def n_eliminated(self):
+        return self.n_events_in - self.n_events_out
+
+    def _can_start(self, event):
+        return isinstance(event, Event) and event.action == 'D' and \
+            event.offset >= 0 and event.timestamp is not None
+
+    def _can_append(self, first, end, last_timestamp, size, event):
+        if event.pid != first.pid or \
+                event.operation != first.operation or \
+                event.sync != first.sync or \
+                event.offset != end or \
+                size + event.size > self.max_size:
+            return False
+
+        gap = float(event.timestamp) - last_timestamp
+        return 0 <= gap <= self.time_window
+
+    def _merged(self, first, size):
+        if size == first.size:
+            return first
+        return Event(self.sector_size, first.pid, first.operation,
+                first.offset, size, timestamp = first.timestamp,
+                pre_wait_time = first.pre_wait_time, sync = first.sync,
+                action = first.action)
+
+    def __iter__(self):
+        first = None
+        for event in self.event_iter:
+            if isinstance(event, Event):
+                self.n_events_in += 1
+
+            if first is not None:
+                if self._can_start(event) and self._can_append(
+                        first, first.offset + size, last_timestamp, size,
+                        event):
+                    size += event.size
+                    last_timestamp = float(event.timestamp)
+                    continue
+
+                self.n_events_out += 1
+                yield self._merged(first, size)
+                first = None
+
+            if self._can_start(event):
+                first = event
+                size = event.size
+                last_timestamp = float(event.timestamp)
+                continue
+
+            if isinstance(event, Event):
+                self.n_events_out += 1
+            yield event
+
+        if first is not None:
+            self.n_events_out += 1
+            yield self._merged(first, size)
+
+
+def move_event_regions(event, sector_size, region_size, new_region):
+    """
+    Cut event at the boundaries of regions of region_size bytes and move the
+    piece in region r to region new_region(r), or drop it if that is None.
+    Return the pieces, which is [event] if it is not changed.
+    """
+    pieces = []
+    offset = event.offset
+    end = event.offset + event.size
+    while offset < end:
+        region = offset / region_size
+        region_end = min((region + 1) * region_size, end)
+        i = new_region(region)
+        if i is not None:
+            pieces.append(Event(sector_size, event.pid, event.operation,
+                offset - (region - i) * region_size,
+                region_end - offset, timestamp = event.timestamp,
+                pre_wait_time = event.pre_wait_time, sync = event.sync,
+                action = event.action))
+        offset = region_end
+
+    if len(pieces) == 1 and pieces[0].offset == event.offset and \
+            pieces[0].size == event.size:
+        return [event]
+    return pieces
+
+
+class EventSampler(object):
+    """
+    Pass a sample of the data events for approximate simulation.
+
+    Time window: events whose timestamp is in [start_time, end_time)
+    seconds after the first timestamped event.
+    Byte window: events after start_bytes of reads and writes, until
+    max_bytes more have been passed (discards are not counted).
+    LBA sampling: the address space of lba_bytes is cut into regions of
+    lba_region_size bytes and a hashed subset of lba_sample_rate of them is
+    kept. The kept regions are packed to the front of the address space,
+    so the sample runs on a device of sampled_lba_bytes. Requests that
+    cross regions are split.
+
+    Control events are passed through. scale_factors() reports what was
+    sampled so that results can be extrapolated.
+    """
+    def __init__(self, conf, event_iter, start_time=None, end_time=None,
+            start_bytes=0, max_bytes=None, lba_sample_rate=1.0,
+            lba_region_size=1*MB, lba_bytes=None):
+        self.sector_size = conf['sector_size']
+        self.event_iter = event_iter
+        self.start_time = start_time
+        self.end_time = end_time
+        self.start_bytes = start_bytes
+        self.max_bytes = max_bytes
+        self.lba_region_size = lba_region_size
+
+        if lba_sample_rate < 1.0:
+            if lba_bytes is None:
+                raise RuntimeError("lba_bytes is needed to sample LBAs")
+            assert lba_region_size % self.sector_size == 0
+            n_regions = (lba_bytes + lba_region_size - 1) / lba_region_size
+            threshold = int(lba_sample_rate * 2**32)
+            kept = [region for region in xrange(n_regions)
+                    if self._region_hash(region) < threshold]
+            # region -> index of the region in the sampled address space
+            self.region_map = dict((region, i)
+                    for i, region in enumerate(kept))
+            self.lba_sample_rate = len(kept) / float(n_regions)
+        else:
+            self.region_map = None
+            self.lba_sample_rate = 1.0
+
+        self.n_events_in = 0
+        self.n_events_out = 0
+        self.window_rw_bytes = 0
+        self.sampled_rw_bytes = 0
+        self.first_timestamp = None
+        self.window_first_timestamp = None
+        self.window_last_timestamp = None
+
+    def _region_hash(self, region):
+        # Knuth's multiplicative hash, spreads the kept regions evenly
+        return (region * 2654435761) & 0xffffffff
+
+    @property
+    def sampled_lba_bytes(self):
+        if self.region_map is None:
+            return None
+        return len(self.region_map) * self.lba_region_size
+
+    def scale_factors(self):
+        if self.window_first_timestamp is None:
+            window_duration = 0
+        else:
+            window_duration = self.window_last_timestamp - \
+                    self.window_first_timestamp
+
+        return {
+                'start_time': self.start_time,
+                'end_time': self.end_time,
+                'start_bytes': self.start_bytes,
+                'max_bytes': self.max_bytes,
+                'lba_sample_rate': self.lba_sample_rate,
+                'lba_region_size': self.lba_region_size,
+                'sampled_lba_bytes': self.sampled_lba_bytes,
+                'events_in': self.n_events_in,
+                'events_out': self.n_events_out,
+                'window_rw_bytes': self.window_rw_bytes,
+                'sampled_rw_bytes': self.sampled_rw_bytes,
+                'window_duration': window_duration,
+                }
+
+    def _in_time_window(self, event):
+        """
+        Return -1 before the window, 0 in it and 1 after it
+        """
+        if event.timestamp is None:
+            return 0
+
+        timestamp = float(event.timestamp)
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        t = timestamp - self.first_timestamp
+
+        if self.start_time is not None and t < self.start_time:
+            return -1
+        if self.end_time is not None and t >= self.end_time:
+            return 1
+        return 0
+
+    def _sample_lbas(self, event):
+        if self.region_map is None:
+            return [event]
+        return move_event_regions(event, self.sector_size,
+                self.lba_region_size, self.region_map.get)
+
+    def __iter__(self):
+        rw_bytes = 0
+        for event in self.event_iter:
+            if not isinstance(event, Event) or event.offset < 0:
+                yield event
+                continue
+
+            self.n_events_in += 1
+
+            position = self._in_time_window(event)
+            if position == -1:
+                continue
+            elif position == 1:
+                break
+
+            is_rw = event.operation in (OP_READ, OP_WRITE) and \
+                    event.action == 'D'
+            if rw_bytes < self.start_bytes:
+                if is_rw:
+                    rw_bytes += event.size
+                continue
+            if self.max_bytes is not None and \
+                    self.window_rw_bytes >= self.max_bytes:
+                break
+
+            if is_rw:
+                rw_bytes += event.size
+                self.window_rw_bytes += event.size
+            if event.timestamp is not None:
+                if self.window_first_timestamp is None:
+                    self.window_first_timestamp = float(event.timestamp)
+                self.window_last_timestamp = float(event.timestamp)
+
+            for piece in self._sample_lbas(event):
+                self.n_events_out += 1
+                if is_rw:
+                    self.sampled_rw_bytes += piece.size
+                yield piece
+
+
+class DataGroupShard(object):
+    """
+    Pass the data events of one shard of the address space, for simulating
+    the shards in parallel.
+
+    The address space is cut into groups of group_bytes (the data groups of
+    nkftl2) and group g belongs to shard g % n_shards. The groups of the
+    shard are packed to the front of the address space, so the shard runs
+    on a device of about 1/n_shards of the size. Requests that cross groups
+    are split. Control events are passed through.
+    """
+    def __init__(self, conf, event_iter, shard, n_shards, group_bytes):
+        assert 0 <= shard < n_shards
+        self.sector_size = conf['sector_size']
+        assert group_bytes % self.sector_size == 0
+        self.event_iter = event_iter
+        self.shard = shard
+        self.n_shards = n_shards
+        self.group_bytes = group_bytes
+
+        self.n_events_in = 0
+        self.n_events_out = 0
+
+    def _shard_group(self, group):
+        if group % self.n_shards != self.shard:
+            return None
+        return group / self.n_shards
+
+    def _shard_pieces(self, event):
+        return move_event_regions(event, self.sector_size, self.group_bytes,
+                self._shard_group)
+
+    def __iter__(self):
+        for event in self.event_iter:
+            if not isinstance(event, Event) or event.offset < 0:
+                yield event
+                continue
+
+            self.n_events_in += 1
+            for piece in self._shard_pieces(event):
+                self.n_events_out += 1
+                yield piece
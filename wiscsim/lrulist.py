@@ -17,6 +17,14 @@ class Node(object):
             next = self.__dict__.get('next', None),
             empty = self.__dict__.get('empty', None))
 
+    def __getstate__(self):
+        # prev and next are restored by the LinkedList of the node.
+        # Pickling them would recurse through the whole list.
+        state = dict(self.__dict__)
+        state.pop('prev', None)
+        state.pop('next', None)
+        return state
+
 class LinkedList(object):
     """
     Requirement for the node:
@@ -35,6 +43,20 @@ class LinkedList(object):
 
         self.size = 0
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_end_guard']
+        del state['_head']
+        state['nodes'] = list(self)
+        return state
+
+    def __setstate__(self, state):
+        nodes = state.pop('nodes')
+        self.__dict__.update(state)
+        LinkedList.__init__(self)
+        for node in nodes:
+            self.add_to_tail(node)
+
     def add_before(self, new_node, node):
         """
         add new_node before node
@@ -87,6 +109,9 @@ class LinkedList(object):
         self.add_before(node, old_head)
 
     def add_to_tail(self, node):
+        if self._head is self._end_guard:
+            # empty list, node is also the head
+            self._head = node
         self.add_before(node, self._end_guard)
 
     def move_toward_head_by_one(self, node):
@@ -63,6 +63,12 @@ class Config(config.ConfigNCQFTL):
                 "max_ratio_of_log_blocks": 2.0,
             },
             "write_gc_log": False,
+
+            # Approximate mode for fast what-if runs: simulate the data
+            # groups in this many processes, each with its share of the
+            # groups and of the flash blocks. Requests of different processes
+            # do not contend for channels. See SimulatorDataGroupParallel.
+            "nkftl_parallel_data_groups": None,
         }
         self.update(local_itmes)
 
@@ -217,25 +223,15 @@ class OutOfBandAreas(object):
         return lpns
 
     def is_any_page_valid(self, flash_block):
-        ppn_start, ppn_end = self.conf.block_to_page_range(flash_block)
-        for ppn in range(ppn_start, ppn_end):
-            if self.states.is_page_valid(ppn):
-                return True
-        return False
+        return self.states.block_valid_count(flash_block) > 0
 
     def are_all_pages_invalid(self, flash_block):
-        ppn_start, ppn_end = self.conf.block_to_page_range(flash_block)
-        for ppn in range(ppn_start, ppn_end):
-            if not self.states.is_page_invalid(ppn):
-                return False
-        return True
+        return self.states.block_invalid_count(flash_block) == \
+                self.conf.n_pages_per_block
 
     def are_all_pages_erased(self, flash_block):
-        ppn_start, ppn_end = self.conf.block_to_page_range(flash_block)
-        for ppn in range(ppn_start, ppn_end):
-            if not self.states.is_page_erased(ppn):
-                return False
-        return True
+        return self.states.block_erased_count(flash_block) == \
+                self.conf.n_pages_per_block
 
 
 
@@ -886,15 +882,19 @@ class GarbageCollector(object):
 
         self._cleaning_lock = simpy.Resource(self.env, capacity=1)
 
+        self.reload_conf()
+
+        self.gcid = 0
+        self.gc_time_recorded = False
+
+    def reload_conf(self):
+        "No GC can be running"
         self.decider = GcDecider(self.conf, self.block_pool, self.recorder)
 
         n_cleaners = self.conf['n_gc_procs']
         print 'n_cleaners:', n_cleaners
         self._cleaner_res = simpy.Resource(self.env, capacity=n_cleaners)
 
-        self.gcid = 0
-        self.gc_time_recorded = False
-
     def clean(self, forced=False, merge=True):
         req = self._cleaning_lock.request()
         yield req
@@ -2086,6 +2086,13 @@ class Ftl(ftlbuilder.FtlBuilder):
     def post_processing(self):
         pass
 
+    def reload_conf(self):
+        """
+        Apply the GC knobs of self.conf after it is changed in the middle of
+        a simulation.
+        """
+        self.garbage_collector.reload_conf()
+
     def clean(self, forced=False, merge=True):
         yield self.env.process(self.garbage_collector.clean(forced, merge=merge))
 
@@ -104,6 +104,37 @@ class Recorder(object):
         else:
             sys.stdout.write(line)
 
+    def flush(self):
+        self.log_handle.flush()
+        for _, file_handle in self.file_pool.items():
+            file_handle.flush()
+
+    def set_output_directory(self, output_directory):
+        """
+        Write the following records to output_directory, for example in a
+        forked process. flush() must have been called before the fork.
+        """
+        self.log_handle.close()
+        for _, file_handle in self.file_pool.items():
+            file_handle.close()
+        self.file_pool = {}
+        self.file_colnames = {}
+
+        self.output_directory = output_directory
+        self.__open_log_file()
+
+    def get_state(self):
+        "counters and results to be saved in a checkpoint"
+        return {'result_dict': self.result_dict,
+                'enabled': self.enabled,
+                'unique_num': self._unique_num}
+
+    def set_state(self, state):
+        self.result_dict = state['result_dict']
+        self.general_accumulator = self.result_dict['general_accumulator']
+        self.enabled = state['enabled']
+        self._unique_num = state['unique_num']
+
     def get_result_summary(self):
         return self.result_dict
 
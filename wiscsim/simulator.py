@@ -5,8 +5,12 @@ import random
 import simpy
 import sys
 import os
+import copy
 import csv
+import json
+import multiprocessing
 import pprint
+import traceback
 
 import config
 import ssdframework
@@ -17,6 +21,7 @@ import recorder
 import hostevent
 import dftldes
 import ftlcounter
+import checkpoint
 
 from commons import *
 from ftlsim_commons import *
@@ -62,18 +67,69 @@ class SimulatorDESNew(Simulator):
     def __init__(self, conf, event_iter):
         super(SimulatorDESNew, self).__init__(conf, event_iter)
 
-        self.env = simpy.Environment()
+        restore_path = self.conf.get('checkpoint_restore_path', None)
+        if restore_path is None:
+            self.env = simpy.Environment()
+        else:
+            header = checkpoint.read_checkpoint_header(restore_path)
+            self.env = simpy.Environment(initial_time=header['now'])
+
         self.host = Host(self.conf, self.env, event_iter)
         self.ssd = ssdframework.Ssd(self.conf, self.env,
                 self.host.get_ncq(), self.recorder)
 
+        if restore_path is not None:
+            self.ssd.restore_checkpoint(restore_path)
+
     def run(self):
         self.env.process(self.host.run())
         self.env.process(self.ssd.run())
 
-        self.env.run()
-
-        self.record_post_run_stats()
+        try:
+            self.env.run()
+            self.record_post_run_stats()
+        except Exception:
+            if self.ssd.fork_variant is None:
+                raise
+            traceback.print_exc()
+            sys.stdout.flush()
+            os._exit(1)
+
+        if self.ssd.fork_variant is not None:
+            # a forked process must not return to the caller of the parent
+            sys.stdout.flush()
+            os._exit(0)
+
+        if len(self.ssd.fork_children) > 0:
+            self.collect_fork_variants()
+
+    def collect_fork_variants(self):
+        """
+        Wait for the processes of conf['fork_variants'] and put their
+        results and the results of this one in fork-variants.txt
+        """
+        result_dir = self.conf['result_dir']
+        rows = [self._fork_variant_row('base', {}, 0, result_dir)]
+        for pid, i, variant_dir in self.ssd.fork_children:
+            _, status = os.waitpid(pid, 0)
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                    else -os.WTERMSIG(status)
+            rows.append(self._fork_variant_row('variant-{}'.format(i),
+                self.conf['fork_variants'][i], exit_code, variant_dir))
+
+        table_path = os.path.join(result_dir, 'fork-variants.txt')
+        utils.table_to_file(utils.rows_to_table(rows), table_path)
+        print 'Results of the fork variants are in', table_path
+
+    def _fork_variant_row(self, name, override, exit_code, result_dir):
+        # the table pads values with spaces, keep the override compact
+        row = {'variant': name, 'exit_code': exit_code,
+            'override': json.dumps(override, sort_keys=True,
+                separators=(',', ':'))}
+        result_path = os.path.join(result_dir, 'recorder.json')
+        if exit_code == 0 and os.path.exists(result_path):
+            row.update(utils.flatten_result_dict(utils.load_json(result_path)))
+        return row
 
     def get_sim_type(self):
         return "SimulatorDESNew"
@@ -81,6 +137,9 @@ class SimulatorDESNew(Simulator):
     def record_post_run_stats(self):
         self.recorder.set_result_by_one_key(
                 'simulation_duration', self.env.now)
+        if self.host.compactor is not None:
+            self.recorder.set_result_by_one_key(
+                    'compacted_events', self.host.compactor.n_eliminated)
         pprint.pprint(self.recorder.get_result_summary())
 
         self.recorder.close()
@@ -95,7 +154,148 @@ class SimulatorDESNew(Simulator):
             gclog.classify_lpn_in_gclog()
 
 
+class SimulatorDataGroupParallel(Simulator):
+    """
+    Simulate nkftl2 with the data groups sharded to
+    conf['nkftl_parallel_data_groups'] processes. Each process runs
+    SimulatorDESNew on its groups (see hostevent.DataGroupShard) and a
+    proportional slice of the flash blocks, in result_dir/shard-<i>. The
+    results are merged by merge_shard_results().
+
+    Every process iterates event_iter from the start, so it has to be an
+    iterable that reads the event files from their paths, such as
+    BlktraceEvents, or a generator that has not been started. The live
+    stream of conf['stream_blktrace'] can only be read once.
+
+    It is approximate: the shards have all channels to themselves and GC
+    of one shard cannot use the free blocks of another.
+    """
+    def __init__(self, conf, event_iter):
+        super(SimulatorDataGroupParallel, self).__init__(conf, event_iter)
+        if self.conf['ftl_type'] != 'nkftl2':
+            raise RuntimeError("only nkftl2 has independent data groups")
+        if self.conf.get('stream_blktrace', False) is True:
+            raise RuntimeError("the shards cannot share the live blktrace "
+                "stream, disable stream_blktrace")
+        self.n_shards = self.conf['nkftl_parallel_data_groups']
+
+    def shard_conf(self, shard):
+        conf = copy.deepcopy(self.conf)
+        conf['nkftl_parallel_data_groups'] = None
+        conf['result_dir'] = os.path.join(self.conf['result_dir'],
+                'shard-{}'.format(shard))
+
+        n_groups = self.conf.n_datagroups_per_dev()
+        n_shard_groups = len(range(shard, n_groups, self.n_shards))
+        if n_shard_groups == 0:
+            raise RuntimeError("{} data groups cannot be sharded to {} "
+                "processes".format(n_groups, self.n_shards))
+        fconf = conf['flash_config']
+        fconf['n_blocks_per_plane'] = (fconf['n_blocks_per_plane'] * \
+                n_shard_groups + n_groups - 1) / n_groups
+        if conf['dev_size_mb'] is not None:
+            conf['dev_size_mb'] = (conf['dev_size_mb'] * n_shard_groups + \
+                    n_groups - 1) / n_groups
+        return conf
+
+    def run(self):
+        group_bytes = self.conf.n_pages_per_data_group() * self.conf.page_size
+        processes = []
+        for shard in range(self.n_shards):
+            conf = self.shard_conf(shard)
+            event_iter = hostevent.DataGroupShard(self.conf, self.event_iter,
+                    shard, self.n_shards, group_bytes)
+            p = multiprocessing.Process(target=_simulate_shard,
+                    args=(conf, event_iter))
+            p.start()
+            processes.append((p, conf['result_dir']))
+
+        results = []
+        for p, result_dir in processes:
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError("shard in {} failed, exit code {}".format(
+                    result_dir, p.exitcode))
+            results.append(utils.load_json(
+                os.path.join(result_dir, 'recorder.json')))
+
+        result_dict = merge_shard_results(results)
+        result_dict['data_group_shards'] = self.n_shards
+        self.recorder.set_state({'result_dict': result_dict,
+            'enabled': True, 'unique_num': 0})
+        pprint.pprint(self.recorder.get_result_summary())
+        self.recorder.close()
+
+    def get_sim_type(self):
+        return "SimulatorDataGroupParallel"
+
+
+def _simulate_shard(conf, event_iter):
+    "This runs in the shard process"
+    hostevent.note_fork()
+    utils.prepare_dir(conf['result_dir'])
+    conf.dump_to_file(os.path.join(conf['result_dir'], 'config.json'))
+    log = open(os.path.join(conf['result_dir'], 'simulation.log'), 'w', 0)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+
+    SimulatorDESNew(conf, event_iter).run()
+
+
+def _add_counters(total, counters):
+    for key, value in counters.items():
+        if isinstance(value, dict):
+            _add_counters(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+# How merge_shard_results() merges the results of the shards, which run at
+# the same time. Other keys are taken from shard 0.
+SHARD_MAX_KEYS = ('simulation_duration', 'interest_workload_end',
+        'gc_start_timestamp', 'gc_duration', 'gc_duration_sec',
+        'non_merge_gc_duration', 'non_merge_gc_duration_sec')
+SHARD_MIN_KEYS = ('interest_workload_start', 'workload_start_time')
+SHARD_SUMMED_KEYS = ('compacted_events',)
+
+def merge_shard_results(result_dicts):
+    """
+    Merge the result_dict of recorders of shards simulated in parallel,
+    see SimulatorDataGroupParallel. The counters in general_accumulator are
+    added up and the workload bandwidth is computed again from them.
+    """
+    merged = copy.deepcopy(result_dicts[0])
+    merged['general_accumulator'] = {}
+    for result_dict in result_dicts:
+        _add_counters(merged['general_accumulator'],
+                result_dict['general_accumulator'])
+
+    for keys, merge in ((SHARD_MAX_KEYS, max), (SHARD_MIN_KEYS, min),
+            (SHARD_SUMMED_KEYS, sum)):
+        for key in keys:
+            values = [result_dict[key] for result_dict in result_dicts
+                    if key in result_dict]
+            if len(values) > 0:
+                merged[key] = merge(values)
+
+    if 'workload_duration_nsec' in merged:
+        # as OP_REC_BW does it
+        dur = merged['interest_workload_end'] - \
+                merged['interest_workload_start']
+        write_traffic = merged['general_accumulator'].get('traffic',
+                {}).get('write', 0) / MB
+        merged['workload_duration_nsec'] = dur
+        merged['workload_duration_sec'] = float(dur) / SEC
+        merged['write_bandwidth'] = float(write_traffic) / (float(dur) / SEC)
+    return merged
+
+
 def create_simulator(simulator_class, conf, event_iter):
+    if simulator_class == 'SimulatorDESNew' and \
+            conf.get('nkftl_parallel_data_groups', None):
+        simulator_class = 'SimulatorDataGroupParallel'
     cls = eval(simulator_class)
     return cls(conf, event_iter)
 
@@ -157,8 +357,10 @@ class SimulatorNonDES(Simulator):
             self.ftl.disable_recording()
         elif event.operation == OP_WORKLOADSTART:
             self.ftl.pre_workload()
+        elif event.operation == OP_REC_RESULT:
+            self.recorder.set_result_by_one_key(event.arg1, event.arg2)
         elif event.operation in ['finish', OP_BARRIER, OP_REC_TIMESTAMP, OP_CLEAN,
-                OP_NOOP]:
+                OP_NOOP, OP_CHECKPOINT, OP_FORK]:
             # ignore this
             pass
         else:
@@ -22,6 +22,7 @@ import hostevent
 import lrulist
 import recorder
 from utilities import utils
+import checkpoint
 import dftldes
 import nkftl2
 
@@ -61,6 +62,10 @@ class Ssd(SsdBase):
         self.gc_sleep_timer = 0
         self.gc_sleep_duration = 10
 
+        # set by fork_variants()
+        self.fork_variant = None
+        self.fork_children = [] # [(pid, variant index, result dir), ...]
+
     def _create_ftl(self):
         if self.conf['ftl_type'] == 'dftldes':
             return dftldes.Ftl(self.conf, self.recorder, self.flash_controller,
@@ -157,6 +162,19 @@ class Ssd(SsdBase):
                 self.recorder.set_result_by_one_key(host_event.arg1,
                         self.env.now)
 
+            elif operation == OP_REC_RESULT:
+                self.recorder.set_result_by_one_key(host_event.arg1,
+                        host_event.arg2)
+
+            elif operation == OP_CHECKPOINT:
+                # like OP_BARRIER, it needs OP_NOOPs around it
+                yield self.env.process(self._barrier())
+                self.save_checkpoint(host_event.arg1)
+
+            elif operation == OP_FORK:
+                yield self.env.process(self._barrier())
+                self.fork_variants()
+
             elif operation == OP_REC_FLASH_OP_CNT:
                 result_dict = self.recorder.get_result_summary()
                 flashops = copy.deepcopy(
@@ -243,6 +261,71 @@ class Ssd(SsdBase):
 
             self.ncq.slots.release(slot_req)
 
+    def save_checkpoint(self, path):
+        utils.prepare_dir_for_path(path)
+        checkpoint.save_checkpoint(path, self,
+                meta = checkpoint.layout_of_conf(self.conf))
+        print 'saved checkpoint to', path
+
+    def restore_checkpoint(self, path):
+        """
+        Replace the FTL by the one in the checkpoint. The simpy environment
+        must start at the time of the checkpoint.
+        """
+        header, ftl = checkpoint.load_checkpoint(path, self)
+        if header['meta'] != checkpoint.layout_of_conf(self.conf):
+            raise checkpoint.CheckpointError("checkpoint {} is saved with "
+                "{}, not {}".format(path, header['meta'],
+                    checkpoint.layout_of_conf(self.conf)))
+        assert self.env.now == header['now']
+
+        self.ftl = ftl
+        self.recorder.set_state(header['recorder'])
+        self.gc_sleep_timer = header['gc_sleep_timer']
+        random.setstate(header['random_state'])
+        print 'restored checkpoint from', path
+
+    def fork_variants(self):
+        """
+        Fork a process for each config override in conf['fork_variants'].
+        The forked processes share the simulated SSD with this one
+        copy-on-write and continue the simulation with their overrides. Their
+        results are in variant-<i> in result_dir.
+        """
+        self.recorder.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        result_dir = self.conf['result_dir']
+        for i, override in enumerate(self.conf['fork_variants']):
+            variant_dir = os.path.join(result_dir, 'variant-{}'.format(i))
+            pid = os.fork()
+            if pid == 0:
+                self._become_variant(i, override, variant_dir)
+                return
+            self.fork_children.append((pid, i, variant_dir))
+            print 'forked variant {} {} as process {}'.format(
+                    i, override, pid)
+
+    def _become_variant(self, i, override, variant_dir):
+        hostevent.note_fork()
+        self.fork_variant = i
+        self.fork_children = []
+
+        self.conf.update(override)
+        self.conf['fork_variants'] = None
+        self.conf['result_dir'] = variant_dir
+        utils.prepare_dir(variant_dir)
+        self.conf.dump_to_file(os.path.join(variant_dir, 'config.json'))
+
+        log = open(os.path.join(variant_dir, 'simulation.log'), 'w', 0)
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+
+        self.recorder.set_output_directory(variant_dir)
+        self.ftl.reload_conf()
+        print 'variant {}: {}'.format(i, override)
+
     def _end_all_processes(self):
         for i in range(self.n_processes):
             yield self.ncq.queue.put(
@@ -455,25 +538,25 @@ class SSDFramework(object):
         self.print_statistics()
 
     def record_blkparse_bw(self):
-        raw_blkparse_file_path = os.path.join(
-                self.conf['result_dir'], 'blkparse-output.txt')
+        # read from the index of the event file, built when the trace was
+        # converted, instead of parsing the raw blkparse output again
+        stats = blocktrace.load_trace_stats(
+                self.conf.get_ftlsim_events_output_path(),
+                self.conf['event_file_column_names'],
+                self.conf['sector_size'])
 
-        if not os.path.exists(raw_blkparse_file_path):
+        if stats is None or stats['duration'] == 0:
             return
 
-        blkresult = blocktrace.BlktraceResult(
-                self.conf['sector_size'],
-                self.conf['event_file_column_names'],
-                raw_blkparse_file_path, None)
         self.recorder.set_result_by_one_key(
                 'blkparse_read_bw',
-                blkresult.get_bandwidth_mb('read'))
+                blocktrace.get_bandwidth_mb(stats, 'read'))
         self.recorder.set_result_by_one_key(
                 'blkparse_write_bw',
-                blkresult.get_bandwidth_mb('write'))
+                blocktrace.get_bandwidth_mb(stats, 'write'))
         self.recorder.set_result_by_one_key(
                 'blkparse_duration',
-                blkresult.get_duration())
+                stats['duration'])
 
     def print_statistics(self):
         print '++++++++++++++++++++ statistics ++++++++++++++++++'
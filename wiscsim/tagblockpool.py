@@ -1,4 +1,5 @@
-from collections import Counter
+import heapq
+from collections import Counter, OrderedDict
 
 TFREE = 'TAGFREE'
 
@@ -6,10 +7,42 @@ LEAST_ERASED = 'least'
 MOST_ERASED = 'most'
 
 
+class BlockSet(object):
+    """
+    An insertion-ordered set of block numbers. It iterates in the same
+    order as the list it replaces (append at the end, remove from
+    anywhere), but membership tests and removals are O(1).
+    """
+    def __init__(self, blocks=()):
+        self._blocks = OrderedDict((block, None) for block in blocks)
+
+    def add(self, blocknum):
+        self._blocks[blocknum] = None
+
+    def remove(self, blocknum):
+        try:
+            del self._blocks[blocknum]
+        except KeyError:
+            # same as list.remove()
+            raise ValueError("block {} is not in the set".format(blocknum))
+
+    def __contains__(self, blocknum):
+        return blocknum in self._blocks
+
+    def __iter__(self):
+        return iter(self._blocks)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __repr__(self):
+        return "BlockSet({})".format(self._blocks.keys())
+
+
 class TagBlockPool(object):
     def __init__(self, n, tags):
-        self._tag_subpool = {tag:[] for tag in tags}
-        self._tag_subpool[TFREE] = range(n)
+        self._tag_subpool = {tag:BlockSet() for tag in tags}
+        self._tag_subpool[TFREE] = BlockSet(range(n))
 
         # {blocknum: count}
         self._erasure_cnt = Counter()
@@ -19,16 +52,88 @@ class TagBlockPool(object):
         for block in range(n):
             self._erasure_cnt[block] = 0
 
+        # Per-tag heaps of blocks ordered by erasure count, so we do not
+        # have to sort all blocks every time we pick one.
+        #   least heap entry: (count, -blocknum, version)
+        #   most heap entry:  (-count, blocknum, version)
+        # Ties are broken the same way as reversed(most_common()) and
+        # most_common() do. Entries are deleted lazily: an entry is stale
+        # if the block has changed tag since the entry was pushed
+        # (_version[blocknum] does not match).
+        self._version = [0] * n
+        self._least_heaps = {}
+        self._most_heaps = {}
+        for tag in self._tag_subpool.keys():
+            self._rebuild_heaps(tag)
+
+    def _rebuild_heaps(self, tag):
+        least_heap = []
+        most_heap = []
+        for blocknum in self._tag_subpool[tag]:
+            cnt = self._erasure_cnt[blocknum]
+            version = self._version[blocknum]
+            least_heap.append((cnt, -blocknum, version))
+            most_heap.append((-cnt, blocknum, version))
+        heapq.heapify(least_heap)
+        heapq.heapify(most_heap)
+        self._least_heaps[tag] = least_heap
+        self._most_heaps[tag] = most_heap
+
+    def _push_to_heaps(self, blocknum, tag):
+        cnt = self._erasure_cnt[blocknum]
+        version = self._version[blocknum]
+        heapq.heappush(self._least_heaps[tag], (cnt, -blocknum, version))
+        heapq.heappush(self._most_heaps[tag], (-cnt, blocknum, version))
+
+        # drop stale entries once they dominate the heap
+        if len(self._least_heaps[tag]) > 2 * len(self._tag_subpool[tag]) + 64:
+            self._rebuild_heaps(tag)
+
+    def _pop_valid_entry(self, heap, choice):
+        """
+        Pop stale entries until the top of heap is a valid one, and pop
+        and return the valid one. Return None if heap is exhausted.
+        """
+        while len(heap) > 0:
+            entry = heapq.heappop(heap)
+            if choice == LEAST_ERASED:
+                cnt, neg_blocknum, version = entry
+                blocknum = -neg_blocknum
+            else:
+                neg_cnt, blocknum, version = entry
+                cnt = -neg_cnt
+
+            if version != self._version[blocknum]:
+                # the block has left this tag since the entry was pushed
+                continue
+
+            cur_cnt = self._erasure_cnt[blocknum]
+            if cnt != cur_cnt:
+                # the count was changed outside of change_tag(), the
+                # entry is re-pushed with the current count
+                if choice == LEAST_ERASED:
+                    heapq.heappush(heap, (cur_cnt, -blocknum, version))
+                else:
+                    heapq.heappush(heap, (-cur_cnt, blocknum, version))
+                continue
+
+            return entry
+
+        return None
+
     def get_blocks_of_tag(self, tag):
         return self._tag_subpool[tag]
 
     def change_tag(self, blocknum, src, dst):
         self._tag_subpool[src].remove(blocknum)
-        self._tag_subpool[dst].append(blocknum)
+        self._tag_subpool[dst].add(blocknum)
 
         if dst == TFREE:
             self._erasure_cnt[blocknum] += 1
 
+        self._version[blocknum] += 1
+        self._push_to_heaps(blocknum, dst)
+
     def count_blocks(self, tag):
         return len(self._tag_subpool[tag])
 
@@ -61,21 +166,28 @@ class TagBlockPool(object):
 
     def get_least_or_most_erased_blocks(self, tag, choice, nblocks):
         if choice == LEAST_ERASED:
-            blocks_by_cnt = reversed(self._erasure_cnt.most_common())
+            heap = self._least_heaps[tag]
         elif choice == MOST_ERASED:
-            blocks_by_cnt = self._erasure_cnt.most_common()
+            heap = self._most_heaps[tag]
         else:
             raise NotImplementedError
 
-        tag_blocks = self.get_blocks_of_tag(tag)
+        # pop from least used to most used (or the opposite), and put
+        # the valid entries back afterwards
+        entries = []
+        while len(entries) < nblocks:
+            entry = self._pop_valid_entry(heap, choice)
+            if entry is None:
+                break
+            entries.append(entry)
 
-        # iterate from least used to most used
-        blocks = []
-        for blocknum, count in blocks_by_cnt:
-            if blocknum in tag_blocks:
-                blocks.append(blocknum)
-                if len(blocks) == nblocks:
-                    break
+        for entry in entries:
+            heapq.heappush(heap, entry)
+
+        if choice == LEAST_ERASED:
+            blocks = [-neg_blocknum for _, neg_blocknum, _ in entries]
+        else:
+            blocks = [blocknum for _, blocknum, _ in entries]
 
         return blocks
 
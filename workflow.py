@@ -17,11 +17,15 @@ def run_workflow(conf):
 class Workflow(object):
     def __init__(self, conf):
         self.conf = conf
+        self.wlrunner = None
 
     def run(self):
         self._save_conf()
         event_iter = self._run_workload()
-        self._run_simulator(event_iter)
+        try:
+            self._run_simulator(event_iter)
+        finally:
+            self._finish_workload()
 
     def run_simulator(self, event_iter):
         self._save_conf()
@@ -39,8 +43,8 @@ class Workflow(object):
     def _run_workload(self):
         workload_src = self.conf['workload_src']
         if workload_src == WLRUNNER:
-            runner = workrunner.wlrunner.WorkloadRunner(self.conf)
-            event_iter = runner.run()
+            self.wlrunner = workrunner.wlrunner.WorkloadRunner(self.conf)
+            event_iter = self.wlrunner.run()
         elif workload_src == LBAGENERATOR:
             classname = self.conf['lba_workload_class']
             cls = eval("workrunner.lbaworkloadgenerator.{}".format(classname))
@@ -57,6 +61,11 @@ class Workflow(object):
 
         return event_iter
 
+    def _finish_workload(self):
+        "Wait for a workload that runs while it is simulated"
+        if self.wlrunner is not None:
+            self.wlrunner.wait_for_streaming()
+
     def _run_simulator(self, event_iter):
         if self.conf['enable_simulation'] is not True:
             return
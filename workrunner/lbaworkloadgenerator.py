@@ -409,6 +409,22 @@ class BarrierGen(object):
         for i in range(self.n_ncq_slots):
             yield hostevent.ControlEvent(operation=OP_NOOP)
 
+    def checkpoint_events(self, path):
+        return self._exclusive_events(
+                hostevent.ControlEvent(operation=OP_CHECKPOINT, arg1=path))
+
+    def fork_events(self):
+        return self._exclusive_events(
+                hostevent.ControlEvent(operation=OP_FORK))
+
+    def _exclusive_events(self, control_event):
+        "control_event is processed when no other request is in the SSD"
+        for i in range(self.n_ncq_slots):
+            yield hostevent.ControlEvent(operation=OP_NOOP)
+        yield control_event
+        for i in range(self.n_ncq_slots):
+            yield hostevent.ControlEvent(operation=OP_NOOP)
+
 
 class BlktraceEvents(LBAWorkloadGenerator):
     def __init__(self, confobj):
@@ -427,14 +443,55 @@ class BlktraceEvents(LBAWorkloadGenerator):
         if str(self.stop_on_bytes).lower() in ('inf', 'infinity', 'infinit'):
             self.stop_on_bytes = float('inf')
 
+        # conf['trace_sampling'] has the keyword arguments of
+        # hostevent.EventSampler, such as end_time or lba_sample_rate
+        self.sampling = self.conf.get('trace_sampling', None)
+        if self.sampling is not None and \
+                self.sampling.get('lba_sample_rate', 1.0) < 1.0:
+            self._fit_device_to_lba_sample()
+
+    def _fit_device_to_lba_sample(self):
+        """
+        Shrink the device to the sampled address space, the way
+        SimulatorDataGroupParallel.shard_conf() shrinks it to a shard. The
+        simulator is created from conf after this. The original address
+        space is kept in conf['trace_sampling']['lba_bytes'].
+        """
+        self.sampling = dict(self.sampling)
+        self.sampling.setdefault('lba_bytes', self.conf['dev_size_mb'] * MB)
+        self.conf['trace_sampling'] = self.sampling
+
+        lba_bytes = self.sampling['lba_bytes']
+        sampled_bytes = self._sampler([]).sampled_lba_bytes
+        dev_size_mb = (sampled_bytes + MB - 1) / MB
+        if self.conf['dev_size_mb'] == dev_size_mb:
+            # fitted already
+            return
+
+        fconf = self.conf['flash_config']
+        fconf['n_blocks_per_plane'] = (fconf['n_blocks_per_plane'] * \
+                sampled_bytes + lba_bytes - 1) / lba_bytes
+        self.conf['dev_size_mb'] = dev_size_mb
+
     def __iter__(self):
         barriergen = BarrierGen(self.conf.ssd_ncq_depth())
 
         yield hostevent.ControlEvent(operation=OP_DISABLE_RECORDER)
 
-        # mkfs events
-        for event in self.prepfs_events():
-            yield event
+        # mkfs events, the checkpoint has the SSD after them
+        if self.conf.get('checkpoint_restore_path', None) is None:
+            for event in self.prepfs_events():
+                yield event
+
+        checkpoint_path = self.conf.get('checkpoint_save_path', None)
+        if checkpoint_path is not None:
+            for event in barriergen.checkpoint_events(checkpoint_path):
+                yield event
+
+        # the variants start from the SSD after the mkfs events
+        if self.conf.get('fork_variants', None):
+            for event in barriergen.fork_events():
+                yield event
 
         # target workload event
         for event in self.target_workload_events():
@@ -448,9 +505,20 @@ class BlktraceEvents(LBAWorkloadGenerator):
             yield req
         yield hostevent.ControlEvent(operation=OP_REC_BW)
 
+    def _sampler(self, event_iter, lba_only=False):
+        kwargs = dict(self.sampling)
+        if lba_only is True:
+            kwargs = dict((k, v) for k, v in kwargs.items()
+                    if k.startswith('lba_'))
+        return hostevent.EventSampler(self.conf, event_iter, **kwargs)
+
     def prepfs_events(self):
-        prepfs_line_iter = hostevent.FileLineIterator(self.mkfs_event_path)
-        event_prepfs_iter = hostevent.EventIterator(self.conf, prepfs_line_iter)
+        event_prepfs_iter = hostevent.event_iterator_of_file(self.conf,
+                self.mkfs_event_path)
+        if self.sampling is not None:
+            # mkfs events are in the same sampled LBA space as the workload
+            event_prepfs_iter = self._sampler(event_prepfs_iter,
+                    lba_only=True)
 
         for event in event_prepfs_iter:
             yield event
@@ -464,8 +532,11 @@ class BlktraceEvents(LBAWorkloadGenerator):
         yield hostevent.ControlEvent(operation=OP_REC_TIMESTAMP,
                 arg1='interest_workload_start')
 
-        workload_line_iter = hostevent.FileLineIterator(self.ftlsim_event_path)
-        event_workload_iter = hostevent.EventIterator(self.conf, workload_line_iter)
+        event_workload_iter = hostevent.event_iterator_of_file(self.conf,
+                self.ftlsim_event_path)
+        if self.sampling is not None:
+            sampler = self._sampler(event_workload_iter)
+            event_workload_iter = sampler
 
         total_rw_bytes = 0
         for event in event_workload_iter:
@@ -478,6 +549,10 @@ class BlktraceEvents(LBAWorkloadGenerator):
                     print 'break! stop on ', self.stop_on_bytes/MB
                     break
 
+        if self.sampling is not None:
+            yield hostevent.ControlEvent(operation=OP_REC_RESULT,
+                    arg1='trace_sampling', arg2=sampler.scale_factors())
+
         for req in barriergen.barrier_events():
             yield req
         yield hostevent.ControlEvent(operation=OP_REC_TIMESTAMP,
@@ -5,10 +5,16 @@ def enqueue_lines(f, line_queue):
         line_queue.put(line)
 
 class NonBlockingReader(object):
-    def __init__(self, file_path):
-        """Note that the thread is started once the instance is created"""
+    def __init__(self, file_path=None, f=None):
+        """
+        Note that the thread is started once the instance is created.
+        Read either the file at file_path or an opened file f, such as the
+        stdout pipe of a process.
+        """
         self.file_path = file_path
-        self.f = open(file_path, 'r')
+        if f is None:
+            f = open(file_path, 'r')
+        self.f = f
         self.q = Queue.Queue()
         self.t = threading.Thread(target=enqueue_lines,
             args=(self.f, self.q))
@@ -24,6 +30,13 @@ class NonBlockingReader(object):
         else:
             return line
 
+    def is_exhausted(self):
+        """
+        True if the file has reached its end and all lines have been read.
+        The thread has queued every line before it exits.
+        """
+        return not self.t.is_alive() and self.q.empty()
+
 
 if __name__ == '__main__':
     nb_reader = NonBlockingReader("/sys/kernel/debug/tracing/trace_pipe")
@@ -32,4 +45,3 @@ if __name__ == '__main__':
         line = nb_reader.readline()
         print line,
 
-
@@ -1,7 +1,9 @@
 import re
+import io
 import os
 import time
 import datetime
+import threading
 
 from pyreuse.sysutils import blocktrace
 from pyreuse.fsutils.ext4dumpextents import get_extents_of_dir
@@ -12,6 +14,7 @@ import fshelper
 from wiscsim import hostevent
 from utilities import utils
 import workload
+from nonblockingreader import NonBlockingReader
 
 from commons import *
 
@@ -34,6 +37,8 @@ class WorkloadRunner(object):
             raise TypeError("confobj is not of type class config.Config".
                 format(type(confobj).__name__()))
         self.conf = confobj
+        # the thread that writes the event file of run_with_blktrace_streaming()
+        self.drain_thread = None
 
         if self.conf.device_type == 'loop':
             # we don't pad loop
@@ -47,7 +52,8 @@ class WorkloadRunner(object):
             to_ftlsim_path = self.conf.get_ftlsim_events_output_path_mkfs(),
             sector_size = self.conf['sector_size'],
             padding_bytes = self.conf['dev_padding'],
-            do_sort = self.conf['sort_block_trace']
+            do_sort = self.conf['sort_block_trace'],
+            n_workers = self.conf.get('blkparse_workers', 1)
             )
 
         # blktracer for running workload
@@ -58,7 +64,8 @@ class WorkloadRunner(object):
             to_ftlsim_path = self.conf.get_ftlsim_events_output_path(),
             sector_size = self.conf['sector_size'],
             padding_bytes = self.conf['dev_padding'],
-            do_sort = self.conf['sort_block_trace']
+            do_sort = self.conf['sort_block_trace'],
+            n_workers = self.conf.get('blkparse_workers', 1)
             )
 
         self.aging_workload = eval("workload.{wlclass}(confobj = self.conf, " \
@@ -165,6 +172,8 @@ class WorkloadRunner(object):
         self.__set_linux_environment()
 
         if self.conf['enable_blktrace'] == True:
+            if self.conf.get('stream_blktrace', False) is True:
+                return self.run_with_blktrace_streaming()
             return self.run_with_blktrace()
         else:
             return self.run_without_blktrace()
@@ -198,38 +207,8 @@ class WorkloadRunner(object):
 
     def run_with_blktrace(self):
         try:
-            # Set number of CPUs
-            cpuhandler.set_cpus(self.conf['n_online_cpus'])
-
-            self.prepare_device()
-
-            # strat blktrace
-            # This is only for making and mounting file system, because we
-            # want to separate them with workloads.
-            if self.conf['trace_issue_and_complete'] is True:
-                trace_filter=['issue', 'complete']
-            else:
-                trace_filter=['issue']
-
-            self.blktracer_prepfs.start_tracing_and_collecting(trace_filter=trace_filter)
-            time.sleep(1)
-            while self.blktracer_prepfs.proc == None:
-                print 'Waiting for blktrace to start.....'
-                time.sleep(0.5)
-
-            self.build_fs()
-
-            # Age the file system
-            print '----------------------------------------------------'
-            print '---------Running Aging Workload-------------------'
-            print '----------------------------------------------------'
-            self.aging_workload.run()
-            utils.drop_caches()
-
-            time.sleep(1)
-            self.blktracer_prepfs.stop_tracing_and_collecting()
-            time.sleep(1)
-            self.blktracer_prepfs.create_event_file_from_blkparse()
+            trace_filter = self._trace_filter()
+            self._prepare_fs_with_blktrace(trace_filter)
 
             self.blktracer.start_tracing_and_collecting(trace_filter=trace_filter)
 
@@ -238,22 +217,7 @@ class WorkloadRunner(object):
                 print 'Waiting for blktrace to start.....'
                 time.sleep(0.5)
 
-            print 'Running workload ..................'
-            self._pre_target_workload()
-
-            print '----------------------------------------------------'
-            print '---------Running       TARGET workload-------------------'
-            print '----------------------------------------------------'
-            start_time = datetime.datetime.now()
-            self.workload.run()
-            end_time = datetime.datetime.now()
-
-            app_duration = end_time - start_time
-            print 'Application duration >>>>>>>>>', app_duration.total_seconds()
-            self.write_app_duration(app_duration.total_seconds())
-
-            self._post_target_workload()
-            time.sleep(1) # has to sleep here so the blktrace gets all the data
+            self._run_target_workload()
 
         except Exception:
             raise
@@ -268,6 +232,197 @@ class WorkloadRunner(object):
             # always try to clean up the blktrace processes
             self.blktracer.stop_tracing_and_collecting()
 
+    def run_with_blktrace_streaming(self):
+        """
+        Like run_with_blktrace(), but the target workload runs in a thread
+        and another thread converts its blkparse output to the event file
+        as it is produced. The returned iterator follows the event file, so
+        the simulator consumes events while the workload is running. Call
+        wait_for_streaming() after the simulation, whether or not all
+        events were consumed.
+        """
+        try:
+            trace_filter = self._trace_filter()
+            self._prepare_fs_with_blktrace(trace_filter)
+
+            self.blktracer.start_tracing_and_collecting(
+                    trace_filter=trace_filter, stream=True)
+
+            time.sleep(2)
+            while self.blktracer.proc == None:
+                print 'Waiting for blktrace to start.....'
+                time.sleep(0.5)
+        except Exception:
+            self.blktracer.stop_tracing_and_collecting()
+            raise
+
+        event_path = self.conf.get_ftlsim_events_output_path()
+        utils.prepare_dir_for_path(event_path)
+        event_file = open(event_path, 'w')
+
+        self.stream_errors = []
+        self.stream_done = threading.Event()
+        workload_thread = threading.Thread(target=self._stream_thread,
+                args=(self._run_target_workload,))
+        workload_thread.start()
+        self.drain_thread = threading.Thread(target=self._stream_thread,
+                args=(self._drain_blktrace_stream, workload_thread,
+                    event_file))
+        self.drain_thread.start()
+
+        return self.get_event_iterator(
+                workload_events=self.streamed_workload_events(event_path))
+
+    def wait_for_streaming(self):
+        """
+        Wait until the streamed workload is done and its event file is
+        complete. Raise the first error of the streaming threads.
+        """
+        if self.drain_thread is None:
+            return
+        self.drain_thread.join()
+        self.drain_thread = None
+        if len(self.stream_errors) > 0:
+            raise self.stream_errors[0]
+
+    def _stream_thread(self, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            self.stream_errors.append(e)
+            raise
+
+    def _drain_blktrace_stream(self, workload_thread, event_file):
+        """
+        Convert the live blkparse output to event_file until blktrace is
+        stopped, which is done once workload_thread finishes.
+        """
+        reader = NonBlockingReader(f=self.blktracer.proc.stdout)
+        if self.conf['sort_block_trace'] is True:
+            reorder_window = self.conf.get('live_blktrace_reorder_window',
+                    1024)
+        else:
+            reorder_window = 0
+        converter = blocktrace.BlktraceLiveConverter(
+                sector_size = self.conf['sector_size'],
+                event_file_column_names = self.conf['event_file_column_names'],
+                padding_bytes = self.conf['dev_padding'],
+                reorder_window = reorder_window)
+        stats = blocktrace.TraceStatsBuilder(event_file.name,
+                self.conf['event_file_column_names'], self.conf['sector_size'])
+        try:
+            tracing = True
+            while True:
+                line = reader.readline()
+                if line is None:
+                    # let the consumer see what has been converted
+                    event_file.flush()
+                    if tracing is True and not workload_thread.is_alive():
+                        # stopping blktrace closes the pipe after the last
+                        # lines are read
+                        utils.shcmd("sync")
+                        self.blktracer.stop_tracing_and_collecting()
+                        tracing = False
+                    elif reader.is_exhausted():
+                        break
+                    time.sleep(0.01)
+                    continue
+
+                for event_line in converter.add_line(line):
+                    event_file.write(event_line + '\n')
+                    stats.add_line(event_line)
+
+            for event_line in converter.flush():
+                event_file.write(event_line + '\n')
+                stats.add_line(event_line)
+        finally:
+            event_file.flush()
+            os.fsync(event_file)
+            event_file.close()
+            stats.save()
+            # always try to clean up the blktrace processes
+            self.blktracer.stop_tracing_and_collecting()
+            workload_thread.join()
+            self.stream_done.set()
+
+    def streamed_workload_events(self, event_path):
+        """
+        Events of the event file at event_path while it is being written by
+        _drain_blktrace_stream()
+        """
+        line_to_event = hostevent.EventIterator(self.conf, None).str_to_event
+        pending = ''
+        with io.open(event_path, 'rb') as f:
+            while True:
+                done = self.stream_done.is_set()
+                line = f.readline()
+                if line.endswith('\n'):
+                    yield line_to_event(pending + line)
+                    pending = ''
+                    continue
+
+                # at the end of what has been written so far
+                pending += line
+                if done is True:
+                    break
+                time.sleep(0.01)
+
+        if len(self.stream_errors) > 0:
+            raise self.stream_errors[0]
+
+    def _trace_filter(self):
+        if self.conf['trace_issue_and_complete'] is True:
+            return ['issue', 'complete']
+        else:
+            return ['issue']
+
+    def _prepare_fs_with_blktrace(self, trace_filter):
+        # Set number of CPUs
+        cpuhandler.set_cpus(self.conf['n_online_cpus'])
+
+        self.prepare_device()
+
+        # strat blktrace
+        # This is only for making and mounting file system, because we
+        # want to separate them with workloads.
+        self.blktracer_prepfs.start_tracing_and_collecting(trace_filter=trace_filter)
+        time.sleep(1)
+        while self.blktracer_prepfs.proc == None:
+            print 'Waiting for blktrace to start.....'
+            time.sleep(0.5)
+
+        self.build_fs()
+
+        # Age the file system
+        print '----------------------------------------------------'
+        print '---------Running Aging Workload-------------------'
+        print '----------------------------------------------------'
+        self.aging_workload.run()
+        utils.drop_caches()
+
+        time.sleep(1)
+        self.blktracer_prepfs.stop_tracing_and_collecting()
+        time.sleep(1)
+        self.blktracer_prepfs.create_event_file_from_blkparse()
+
+    def _run_target_workload(self):
+        print 'Running workload ..................'
+        self._pre_target_workload()
+
+        print '----------------------------------------------------'
+        print '---------Running       TARGET workload-------------------'
+        print '----------------------------------------------------'
+        start_time = datetime.datetime.now()
+        self.workload.run()
+        end_time = datetime.datetime.now()
+
+        app_duration = end_time - start_time
+        print 'Application duration >>>>>>>>>', app_duration.total_seconds()
+        self.write_app_duration(app_duration.total_seconds())
+
+        self._post_target_workload()
+        time.sleep(1) # has to sleep here so the blktrace gets all the data
+
     def write_app_duration(self, secs):
         path = os.path.join(self.conf['result_dir'], 'app_duration.txt')
         with open(path, 'w') as f:
@@ -311,7 +466,7 @@ class WorkloadRunner(object):
 
         utils.table_to_file(extents_list, extent_path, width=0)
 
-    def get_event_iterator(self):
+    def get_event_iterator(self, workload_events=None):
         barriergen = BarrierGen(self.conf.ssd_ncq_depth())
 
         yield hostevent.ControlEvent(operation=OP_DISABLE_RECORDER)
@@ -321,7 +476,7 @@ class WorkloadRunner(object):
             yield event
 
         # target workload event
-        for event in self.target_workload_events():
+        for event in self.target_workload_events(workload_events):
             yield event
 
         # may send gc trigger
@@ -333,14 +488,17 @@ class WorkloadRunner(object):
         yield hostevent.ControlEvent(operation=OP_REC_BW)
 
     def prepfs_events(self):
-        prepfs_line_iter = hostevent.FileLineIterator(
+        event_prepfs_iter = hostevent.event_iterator_of_file(self.conf,
             self.conf.get_ftlsim_events_output_path_mkfs())
-        event_prepfs_iter = hostevent.EventIterator(self.conf, prepfs_line_iter)
 
         for event in event_prepfs_iter:
             yield event
 
-    def target_workload_events(self):
+    def target_workload_events(self, workload_events=None):
+        """
+        workload_events are the events of the target workload. They are read
+        from the event file if it is None.
+        """
         # special event indicates the start of workload
         barriergen = BarrierGen(self.conf.ssd_ncq_depth())
         yield hostevent.ControlEvent(operation=OP_ENABLE_RECORDER)
@@ -349,11 +507,11 @@ class WorkloadRunner(object):
         yield hostevent.ControlEvent(operation=OP_REC_TIMESTAMP,
                 arg1='interest_workload_start')
 
-        workload_line_iter = hostevent.FileLineIterator(
-            self.conf.get_ftlsim_events_output_path())
-        event_workload_iter = hostevent.EventIterator(self.conf, workload_line_iter)
+        if workload_events is None:
+            workload_events = hostevent.event_iterator_of_file(self.conf,
+                self.conf.get_ftlsim_events_output_path())
 
-        for event in event_workload_iter:
+        for event in workload_events:
             yield event
 
         for req in barriergen.barrier_events():